@@ -0,0 +1,740 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+2D histogram analysis used by the Beam Analysis widget, without GUI dependencies.
+"""
+
+from collections import OrderedDict
+
+import numpy
+
+
+def integrated_profiles(xz):
+    """
+    Integrated profiles of a 2D histogram, as summed by the Beam Analysis widget: the first
+    column is left out of the vertical profile and the first row out of the horizontal one.\n
+    :xz: 2D histogram, shape (len(z_axis), len(x_axis))
+    :return: z_int, x_int
+    """
+    xz = numpy.asarray(xz, dtype=float)
+    z_int = xz[:, 1:].sum(axis=1)
+    # columns are copied contiguous so that they are summed in the same (pairwise) order as numpy.sum(xz[1:,j])
+    x_int = numpy.ascontiguousarray(xz[1:, :].T).sum(axis=1)
+    return z_int, x_int
+
+def find_peak(xz):
+    """
+    Position of the maximum of a 2D histogram (first one in row order; [0, 0] if no value is positive).\n
+    :return: xmax = [row index, maximum], zmax = [column index, maximum]
+    """
+    xz = numpy.asarray(xz)
+    k = int(numpy.argmax(xz))
+    value = xz.flat[k]
+    if not value > 0:
+        return [0, 0], [0, 0]
+    i, j = numpy.unravel_index(k, xz.shape)
+    return [int(i), value], [int(j), value]
+
+def nearest_index(axis, value):
+    return numpy.abs(axis - value).argmin()
+
+def extract_cuts(xz, x_axis, z_axis, cut, x_pos=0.0, z_pos=0.0, profiles=None, peak=None, mean=None, sat=None, band=None):
+    """
+    Horizontal and vertical profiles shown by the Beam Analysis widget.\n
+    :cut: 0 = integrated, 1 = cut at 0, 2 = cut at peak, 3 = cut at mean value, 4 = cut at (x_pos, z_pos),
+          5 = integrated over the bands of the rectangle band
+    :profiles: (z_int, x_int) from integrated_profiles, calculated if None
+    :peak: (xmax, zmax) from find_peak, calculated if None
+    :mean: (x_mean, z_mean), calculated if None
+    :sat: SummedAreaTable of xz, used (or built) for cut 5
+    :band: (x_min, x_max, z_min, z_max) for cut 5
+    :return: x_cut, z_cut, x_cut_coord, z_cut_coord
+    """
+    x_cut_coord = 0.0
+    z_cut_coord = 0.0
+    x_step = x_axis[int(len(x_axis)/2 + 1)] - x_axis[int(len(x_axis)/2)]
+    z_step = z_axis[int(len(z_axis)/2 + 1)] - z_axis[int(len(z_axis)/2)]
+
+    if cut == 0: # integrated distribution
+        z_int, x_int = integrated_profiles(xz) if profiles is None else profiles
+        return x_int*z_step, z_int*x_step, x_cut_coord, z_cut_coord
+
+    if cut == 5: # integrated over bands
+        x_band, z_band = (SummedAreaTable(xz, x_axis, z_axis) if sat is None else sat).band_profiles(*band)
+        return x_band*z_step, z_band*x_step, x_cut_coord, z_cut_coord
+
+    if cut == 1:
+        j, i = nearest_index(x_axis, 0.0), nearest_index(z_axis, 0.0)
+    elif cut == 2:
+        xmax, zmax = find_peak(xz) if peak is None else peak
+        j, i = zmax[0], xmax[0]
+    elif cut == 3:
+        if mean is None:
+            z_int, x_int = integrated_profiles(xz) if profiles is None else profiles
+            mean = (numpy.average(x_axis, weights=x_int), numpy.average(z_axis, weights=z_int))
+        j, i = nearest_index(x_axis, mean[0]), nearest_index(z_axis, mean[1])
+    else:
+        j, i = nearest_index(x_axis, x_pos), nearest_index(z_axis, z_pos)
+
+    if cut != 1:
+        x_cut_coord, z_cut_coord = x_axis[j], z_axis[i]
+    return xz[i, :], xz[:, j], x_cut_coord, z_cut_coord
+
+
+# working memory per ray of one chunk (columns read and temporaries), used to size the chunks
+CHUNK_BYTES_PER_RAY = 128
+
+def chunk_rays(memory_limit):
+    """
+    Number of rays per chunk for a working memory ceiling in MB.
+    """
+    return max(1000, int(memory_limit*1e6/CHUNK_BYTES_PER_RAY))
+
+def beam_chunks(beam, chunk_size=None):
+    """
+    Yields (start, stop, chunk) over the rays of a beam, chunk being a Shadow.Beam whose rays are a
+    view of beam.rays[start:stop] (no copy), so that any column can be read with getshcol.
+    RetracedBeam chunks are retraced copies.\n
+    :beam: Shadow.Beam or RetracedBeam
+    :chunk_size: rays per chunk, None for a single chunk (the beam itself)
+    """
+    import Shadow
+
+    if isinstance(beam, RetracedBeam):
+        yield from beam.chunks(chunk_size)
+        return
+    nrays = len(beam.rays)
+    if chunk_size is None or chunk_size >= nrays:
+        yield 0, nrays, beam
+        return
+    for start in range(0, nrays, chunk_size):
+        chunk = Shadow.Beam()
+        chunk.rays = beam.rays[start:start + chunk_size]
+        yield start, min(start + chunk_size, nrays), chunk
+
+def beam_nrays(beam):
+    """
+    Number of rays of a Shadow.Beam or RetracedBeam.
+    """
+    return beam.nrays() if isinstance(beam, RetracedBeam) else len(beam.rays)
+
+def ray_statistics(beam, chunk_size=None):
+    """
+    Number of rays, good rays and intensity of the good rays, read chunk by chunk.
+    """
+    good_rays, intensity = 0, 0.0
+    for start, stop, chunk in beam_chunks(beam, chunk_size):
+        flag, weight = chunk.getshcol((10, 23))
+        good = flag == 1.0
+        good_rays += int(numpy.count_nonzero(good))
+        intensity += numpy.sum(weight[good])
+    return {'nrays': beam_nrays(beam), 'good_rays': good_rays, 'intensity': intensity}
+
+def ray_selection(flag, nolost=0):
+    """
+    Mask of the rays used by Shadow.Beam.histo2: all (nolost = 0), good (1) or lost (2).
+    """
+    if nolost == 1:
+        return flag == 1.0
+    if nolost == 2:
+        return flag != 1.0
+    return numpy.ones(len(flag), dtype=bool)
+
+def good_range(rmin, rmax):
+    """
+    Default histogram range of Shadow.Beam.get_good_range: the data range [rmin, rmax] enlarged by 5%
+    (None if there is no data).
+    """
+    if rmin is None:
+        return [-1.0, 1.0]
+    rmin = rmin*0.95 if rmin > 0.0 else rmin*1.05
+    rmax = rmax*0.95 if rmax < 0.0 else rmax*1.05
+    if rmin == rmax:
+        rmin, rmax = rmin*0.95, rmax*1.05
+        if rmin == 0.0:
+            rmin, rmax = -1.0, 1.0
+    return [rmin, rmax]
+
+def axis_bin_index(values, edges):
+    """
+    Bin of each value as numpy.histogramdd assigns it (the last edge belongs to the last bin), -1 outside.
+    """
+    index = numpy.searchsorted(edges, values, side='right')
+    index[values == edges[-1]] -= 1
+    index -= 1
+    index[(index < 0) | (index >= len(edges) - 1)] = -1
+    return index
+
+def linear_binning(h, v, weights, centers_h, centers_v):
+    """
+    Linear (cloud-in-cell) binning: each ray is shared between the 4 nearest grid points with
+    bilinear weights. Rays between the outer edges and the outer centres go to the outer centres.\n
+    :weights: weights of the rays, None for 1
+    :return: grid, shape (len(centers_h), len(centers_v))
+    """
+    nh, nv = len(centers_h), len(centers_v)
+    fh = numpy.clip((h - centers_h[0])/(centers_h[1] - centers_h[0]), 0.0, nh - 1)
+    fv = numpy.clip((v - centers_v[0])/(centers_v[1] - centers_v[0]), 0.0, nv - 1)
+    i = numpy.minimum(fh.astype(int), nh - 2)
+    j = numpy.minimum(fv.astype(int), nv - 2)
+    th, tv = fh - i, fv - j
+    w = numpy.ones(len(h)) if weights is None else weights
+    index = i*nv + j
+    size = nh*nv
+    grid  = numpy.bincount(index,          w*(1.0 - th)*(1.0 - tv), minlength=size)
+    grid += numpy.bincount(index + 1,      w*(1.0 - th)*tv,         minlength=size)
+    grid += numpy.bincount(index + nv,     w*th*(1.0 - tv),         minlength=size)
+    grid += numpy.bincount(index + nv + 1, w*th*tv,                 minlength=size)
+    return grid.reshape((nh, nv))
+
+def gaussian_fft_smoothing(grid, sigma_h, sigma_v):
+    """
+    Convolution of a grid with a Gaussian kernel (sigmas in bins) by FFT, zero padded (no wrap-around).
+    The kernel is truncated at 4 sigma and normalized, so the total is kept apart from what leaves the grid.
+    """
+    kernels = []
+    for sigma, n in [(sigma_h, grid.shape[0]), (sigma_v, grid.shape[1])]:
+        half = min(int(numpy.ceil(4.0*sigma)), n) if sigma > 0.0 else 0
+        kernel = numpy.exp(-0.5*(numpy.arange(-half, half + 1)/sigma)**2) if half > 0 else numpy.ones(1)
+        kernels.append(kernel/numpy.sum(kernel))
+    kernel = numpy.outer(kernels[0], kernels[1])
+    kh, kv = len(kernels[0])//2, len(kernels[1])//2
+    shape = (grid.shape[0] + 2*kh, grid.shape[1] + 2*kv)
+    smooth = numpy.fft.irfft2(numpy.fft.rfft2(grid, shape)*numpy.fft.rfft2(kernel, shape), shape)
+    return numpy.maximum(smooth[kh:kh + grid.shape[0], kv:kv + grid.shape[1]], 0.0)
+
+def kde_bandwidth(n_eff, sigma, profile, centers, rule='scott'):
+    """
+    Bandwidth of a 2D Gaussian product kernel along one axis.\n
+    'scott': sigma n^(-1/6); 'silverman': (n (d+2)/4)^(-1/(d+4)) min(sigma, IQR/1.349), which for d = 2
+    differs from Scott's rule only by the spread estimate, robust to tails. n is the effective number of
+    rays, (sum w)^2/sum w^2; sigma comes from the rays, the interquartile range from the binned profile.
+    """
+    if n_eff <= 0.0:
+        return 0.0
+    if rule == 'silverman':
+        cumulative = numpy.cumsum(profile)/numpy.sum(profile)
+        iqr = numpy.interp(0.75, cumulative, centers) - numpy.interp(0.25, cumulative, centers)
+        if iqr > 0.0:
+            sigma = min(sigma, iqr/1.349)
+    return sigma*n_eff**(-1.0/6.0)
+
+def binned_kde(chunks, edges_h, edges_v, rule='scott', factor=1.0):
+    """
+    Gaussian kernel density estimate of the rays on the bin centres: linear binning followed by an FFT
+    convolution, O(N) in the rays and O(G log G) in the grid points.\n
+    :chunks: function returning an iterable of (h, v, weights) ray chunks (weights None for 1); it is
+             called twice, for the grid and the moments, then for the variances
+    :rule: bandwidth rule, 'scott' or 'silverman' (see kde_bandwidth)
+    :factor: multiplies the bandwidths
+    :return: density in rays (weights) per bin, shape (nbins_h, nbins_v), and the bandwidths (h, v)
+    """
+    if len(edges_h) < 3 or len(edges_v) < 3:
+        raise ValueError('The kernel density estimate needs at least 2 bins per axis')
+    centers_h = 0.5*(edges_h[1:] + edges_h[:-1])
+    centers_v = 0.5*(edges_v[1:] + edges_v[:-1])
+
+    def inside_rays():
+        for h, v, weights in chunks():
+            inside = (h >= edges_h[0]) & (h <= edges_h[-1]) & (v >= edges_v[0]) & (v <= edges_v[-1])
+            yield h[inside], v[inside], numpy.ones(numpy.count_nonzero(inside)) if weights is None else weights[inside]
+
+    grid = numpy.zeros((len(centers_h), len(centers_v)))
+    sum_w, sum_w2, sum_h, sum_v = 0.0, 0.0, 0.0, 0.0
+    for h, v, w in inside_rays():
+        grid += linear_binning(h, v, w, centers_h, centers_v)
+        sum_w, sum_w2 = sum_w + numpy.sum(w), sum_w2 + numpy.sum(w**2)
+        sum_h, sum_v = sum_h + numpy.sum(w*h), sum_v + numpy.sum(w*v)
+
+    bandwidth_h, bandwidth_v = 0.0, 0.0
+    if sum_w > 0.0:
+        mean_h, mean_v = sum_h/sum_w, sum_v/sum_w
+        var_h, var_v = 0.0, 0.0
+        for h, v, w in inside_rays():
+            var_h, var_v = var_h + numpy.sum(w*(h - mean_h)**2), var_v + numpy.sum(w*(v - mean_v)**2)
+        n_eff = sum_w**2/sum_w2
+        bandwidth_h = factor*kde_bandwidth(n_eff, numpy.sqrt(var_h/sum_w), grid.sum(axis=1), centers_h, rule)
+        bandwidth_v = factor*kde_bandwidth(n_eff, numpy.sqrt(var_v/sum_w), grid.sum(axis=0), centers_v, rule)
+    density = gaussian_fft_smoothing(grid, bandwidth_h/(centers_h[1] - centers_h[0]), bandwidth_v/(centers_v[1] - centers_v[0]))
+    return density, (bandwidth_h, bandwidth_v)
+
+
+class BinPlan():
+    """
+    Per-ray bin indices of a 2D histogram of two beam columns, as Shadow.Beam.histo2 bins them
+    (default ranges, numpy.histogram2d edges), so that histograms with other weights are a single
+    pass over the rays. Histograms are kept per weight column.
+
+    The rays are read in chunks of chunk_size (all at once if None) and only the bin index of each
+    ray (4 bytes) is kept. The histograms are accumulated ray by ray in the same order whatever the
+    chunk size, so they are identical to numpy.histogram2d.
+    """
+
+    def __init__(self, beam, col_h, col_v, nbins_h, nbins_v, nolost=0, xrange=None, yrange=None, chunk_size=None):
+        """
+        :beam: Shadow.Beam or RetracedBeam (kept to read weight columns)
+        :col_h, col_v: column numbers (1 = X, ...)
+        :nolost: 0 = all rays, 1 = good rays only, 2 = lost rays only
+        :xrange, yrange: histogram ranges, default as Shadow.Beam.get_good_range
+        :chunk_size: rays read at once, None for all
+        """
+        self.beam = beam
+        self.columns = (col_h, col_v)
+        self.nolost = nolost
+        self.chunk_size = chunk_size
+        self.nrays = beam_nrays(beam)
+        self.shape = (nbins_h, nbins_v)
+
+        # first pass: ray counts and data ranges of the selected rays, used for the cartesian axes
+        self.good_rays = 0
+        h_min, h_max, v_min, v_max = None, None, None, None
+        for start, stop, h, v, flag in self.chunk_columns():
+            self.good_rays += int(numpy.count_nonzero(flag == 1.0))
+            selected = ray_selection(flag, nolost)
+            if numpy.any(selected):
+                h, v = h[selected], v[selected]
+                h_min = numpy.min(h) if h_min is None else min(h_min, numpy.min(h))
+                h_max = numpy.max(h) if h_max is None else max(h_max, numpy.max(h))
+                v_min = numpy.min(v) if v_min is None else min(v_min, numpy.min(v))
+                v_max = numpy.max(v) if v_max is None else max(v_max, numpy.max(v))
+        self.data_range_h = [-1.0, 1.0] if h_min is None else [h_min, h_max]
+        self.data_range_v = [-1.0, 1.0] if v_min is None else [v_min, v_max]
+        self.xrange = good_range(h_min, h_max) if xrange is None else xrange
+        self.yrange = good_range(v_min, v_max) if yrange is None else yrange
+        self.edges_h = self.edges(self.xrange, nbins_h)
+        self.edges_v = self.edges(self.yrange, nbins_v)
+
+        # second pass: bin index of every ray, -1 for rays not selected or outside the histogram
+        self.index = numpy.empty(self.nrays, dtype=numpy.int32 if nbins_h*nbins_v < 2**31 else numpy.int64)
+        for start, stop, h, v, flag in self.chunk_columns():
+            i, j = axis_bin_index(h, self.edges_h), axis_bin_index(v, self.edges_v)
+            self.index[start:stop] = numpy.where(ray_selection(flag, nolost) & (i >= 0) & (j >= 0), i*nbins_v + j, -1)
+        self.histograms = {}
+        self.densities = {}
+
+    def chunk_columns(self, columns=(10,)):
+        """
+        Yields (start, stop, h, v, *columns) chunk by chunk.
+        """
+        for start, stop, chunk in beam_chunks(self.beam, self.chunk_size):
+            yield (start, stop) + tuple(chunk.getshcol(self.columns + tuple(columns)))
+
+    @staticmethod
+    def edges(histogram_range, nbins):
+        first, last = float(histogram_range[0]), float(histogram_range[1])
+        if first == last:
+            first, last = first - 0.5, last + 0.5
+        return numpy.linspace(first, last, nbins + 1)
+
+    def histogram(self, ref=23):
+        """
+        2D histogram weighted by column ref (1 if ref = 0), shape (nbins_h, nbins_v), as numpy.histogram2d.
+        """
+        if ref not in self.histograms:
+            histogram = numpy.zeros(self.shape[0]*self.shape[1])
+            for start, stop, chunk in beam_chunks(self.beam, self.chunk_size):
+                index = self.index[start:stop]
+                binned = index >= 0
+                weights = 1.0 if ref == 0 else chunk.getshonecol(ref)[binned]
+                # unbuffered, in ray order: the same sums as a single numpy.bincount
+                numpy.add.at(histogram, index[binned], weights)
+            self.histograms[ref] = histogram.reshape(self.shape)
+        return self.histograms[ref]
+
+    def density(self, ref=23, rule='scott', factor=1.0):
+        """
+        Kernel density estimate (binned_kde) weighted by column ref, in the units of histogram(ref).\n
+        :return: density, bandwidths (h, v)
+        """
+        key = (ref, rule, factor)
+        if key not in self.densities:
+            def chunks():
+                for start, stop, h, v, flag, weights in self.chunk_columns((10, max(ref, 1))):
+                    selected = ray_selection(flag, self.nolost)
+                    yield h[selected], v[selected], None if ref == 0 else weights[selected]
+            self.densities[key] = binned_kde(chunks, self.edges_h, self.edges_v, rule, factor)
+        return self.densities[key]
+
+    def histo2(self, ref=23, rule=None, factor=1.0):
+        """
+        Histogram dict with the keys of Shadow.Beam.histo2 used by the Beam Analysis widget.\n
+        :rule: None for the histogram, 'scott' or 'silverman' for the kernel density estimate (key 'bandwidth' added)
+        """
+        if rule is not None:
+            density, bandwidth = self.density(ref, rule, factor)
+            histo2 = self.histo2(ref)
+            histo2.update({'histogram': density, 'bandwidth': bandwidth})
+            return histo2
+        return {'histogram': self.histogram(ref),
+                'bin_h_edges': self.edges_h, 'bin_v_edges': self.edges_v,
+                'bin_h_center': 0.5*(self.edges_h[1:] + self.edges_h[:-1]),
+                'bin_v_center': 0.5*(self.edges_v[1:] + self.edges_v[:-1]),
+                'nrays': self.nrays, 'good_rays': self.good_rays}
+
+
+# bytes per ray of Shadow.Beam.rays (18 float64 columns) and of the retraced positions
+RAY_BYTES = 18*8
+POSITION_BYTES = 3*8
+
+def retrace_positions(rays, dist):
+    """
+    Positions (3, nrays) of rays retraced by dist, as Shadow.Beam.retrace.
+    """
+    tof = (-rays[:, 1] + dist)/rays[:, 4]
+    return numpy.array([rays[:, 0] + tof*rays[:, 3], rays[:, 1] + tof*rays[:, 4], rays[:, 2] + tof*rays[:, 5]])
+
+
+class RetracedBeam():
+    """
+    Beam retraced by dist (as Shadow.Beam.retrace) without copying the input rays: chunks are
+    retraced when they are read (beam_chunks), from the retraced positions if they were kept.
+    """
+
+    def __init__(self, rays, dist, positions=None):
+        """
+        :rays: rays of the input beam (not modified)
+        :dist: retrace distance
+        :positions: retraced positions (3, nrays), None to calculate them for each chunk
+        """
+        self.input_rays = rays
+        self.dist = dist
+        self.positions = positions
+
+    def nrays(self):
+        return len(self.input_rays)
+
+    def retraced_positions(self, start, stop):
+        if self.positions is not None:
+            return self.positions[:, start:stop]
+        return retrace_positions(self.input_rays[start:stop], self.dist)
+
+    def chunks(self, chunk_size=None):
+        """
+        Yields (start, stop, chunk) as beam_chunks, chunk being a retraced copy of the rays start:stop.
+        """
+        import Shadow
+
+        nrays = self.nrays()
+        if chunk_size is None:
+            chunk_size = max(nrays, 1)
+        else: # the chunk is a copy of all columns
+            chunk_size = max(1000, chunk_size*CHUNK_BYTES_PER_RAY//(CHUNK_BYTES_PER_RAY + RAY_BYTES))
+        for start in range(0, nrays, chunk_size):
+            stop = min(start + chunk_size, nrays)
+            chunk = Shadow.Beam()
+            chunk.rays = numpy.array(self.input_rays[start:stop], copy=True)
+            chunk.rays[:, 0:3] = self.retraced_positions(start, stop).T
+            yield start, stop, chunk
+
+
+class RetraceCache():
+    """
+    Least recently used cache of beams retraced to other screen positions (Shadow.Beam.retrace),
+    bounded by a memory budget. Only the retraced positions are kept (24 bytes per ray); the other
+    columns are read from the input beam chunk by chunk (RetracedBeam). Distances whose positions
+    do not fit in the budget are retraced again whenever they are read.
+    """
+
+    def __init__(self, memory_budget=500.0, chunk_size=None):
+        """
+        :memory_budget: maximum size of the cached positions, in MB
+        :chunk_size: rays retraced at once, None for all
+        """
+        self.memory_budget = memory_budget
+        self.chunk_size = chunk_size
+        self.entries = OrderedDict()
+        self.beam_key = None
+        self.rays = None
+
+    def nbytes(self):
+        return sum(positions.nbytes for positions in self.entries.values())
+
+    def set_beam(self, beam, beam_key):
+        """
+        Input beam of the following retraces; entries of other beams are dropped.
+
+        :beam: Shadow.Beam
+        :beam_key: identity of the beam (e.g. object id and version)
+        """
+        if beam_key == self.beam_key:
+            return
+        self.entries.clear()
+        self.beam_key = beam_key
+        self.rays = beam.rays
+
+    def retrace(self, dist):
+        """
+        Beam retraced by dist from the beam set by set_beam, as Shadow.Beam.retrace(dist).
+
+        :return: RetracedBeam (read with beam_chunks)
+        """
+        key = float(dist)
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return RetracedBeam(self.rays, key, self.entries[key])
+
+        nrays = len(self.rays)
+        size = POSITION_BYTES*nrays
+        if size > self.memory_budget*1e6:
+            return RetracedBeam(self.rays, key)
+
+        self.resize(self.memory_budget, size)
+        positions = numpy.empty((3, nrays))
+        chunk_size = max(nrays, 1) if self.chunk_size is None else self.chunk_size
+        for start in range(0, nrays, chunk_size):
+            positions[:, start:start + chunk_size] = retrace_positions(self.rays[start:start + chunk_size], key)
+        self.entries[key] = positions
+        return RetracedBeam(self.rays, key, positions)
+
+    def resize(self, memory_budget=None, reserve=0):
+        """
+        Drops the least recently used positions until the cache, plus reserve bytes, fits in the memory budget.
+        """
+        if memory_budget is not None:
+            self.memory_budget = memory_budget
+        while len(self.entries) > 0 and self.nbytes() + reserve > self.memory_budget*1e6:
+            self.entries.popitem(last=False)
+
+
+def profile_fwhm(axis, profile, threshold=0.5):
+    """
+    Full width of a profile at threshold*maximum, between the outermost crossings (linear interpolation).
+    """
+    profile = numpy.asarray(profile, dtype=float)
+    peak = numpy.max(profile) if profile.size else 0.0
+    if peak <= 0.0:
+        return 0.0
+    above = numpy.flatnonzero(profile >= threshold*peak)
+    first, last = above[0], above[-1]
+    level = threshold*peak
+    left, right = axis[first], axis[last]
+    if first > 0:
+        left = numpy.interp(level, [profile[first-1], profile[first]], [axis[first-1], axis[first]])
+    if last < len(profile) - 1:
+        right = numpy.interp(level, [profile[last+1], profile[last]], [axis[last+1], axis[last]])
+    return right - left
+
+
+class BeamComparison():
+    """
+    Named beams binned with the bin edges of the first (reference) beam, so that their histograms can
+    be subtracted or divided bin by bin. Bin plans, histograms and statistics are kept per beam: adding
+    a beam only bins that beam.
+    """
+
+    def __init__(self, chunk_size=None):
+        """
+        :chunk_size: rays read at once by the bin plans, None for all
+        """
+        self.chunk_size = chunk_size
+        self.beams = OrderedDict()
+        self.plans = {}
+        self.statistics_cache = {}
+        self.plan_key = None
+
+    def add(self, name, beam):
+        """
+        Adds a beam, or replaces the beam with the same name (keeping its position).\n
+        :beam: Shadow.Beam
+        """
+        self.beams[name] = beam
+        self.discard(name, name == self.reference())
+
+    def remove(self, name):
+        if name in self.beams:
+            was_reference = name == self.reference()
+            del self.beams[name]
+            self.discard(name, was_reference)
+
+    def clear(self):
+        self.beams.clear()
+        self.discard(None, True)
+
+    def discard(self, name, all_beams=False):
+        # the reference defines the bin edges of all beams
+        if all_beams:
+            self.plans.clear()
+            self.statistics_cache.clear()
+        else:
+            self.plans.pop(name, None)
+            self.statistics_cache = {key: value for key, value in self.statistics_cache.items() if key[0] != name}
+
+    def names(self):
+        return list(self.beams.keys())
+
+    def reference(self):
+        return next(iter(self.beams), None)
+
+    def set_plan(self, col_h, col_v, nbins_h, nbins_v, nolost=0, xrange=None, yrange=None):
+        """
+        Histogram settings shared by all beams; :xrange, yrange: None for the range of the reference beam.
+        """
+        plan_key = (col_h, col_v, nbins_h, nbins_v, nolost,
+                    None if xrange is None else tuple(xrange), None if yrange is None else tuple(yrange))
+        if plan_key != self.plan_key:
+            self.plans.clear()
+            self.statistics_cache.clear()
+            self.plan_key = plan_key
+
+    def plan(self, name):
+        """
+        BinPlan of a beam, with the edges of the reference beam.
+        """
+        if name not in self.plans:
+            col_h, col_v, nbins_h, nbins_v, nolost, xrange, yrange = self.plan_key
+            reference = self.reference()
+            if name != reference:
+                xrange, yrange = self.plan(reference).xrange, self.plan(reference).yrange
+            self.plans[name] = BinPlan(self.beams[name], col_h, col_v, nbins_h, nbins_v, nolost=nolost, xrange=xrange, yrange=yrange,
+                                       chunk_size=self.chunk_size)
+        return self.plans[name]
+
+    def axes(self):
+        """
+        Bin centres (horizontal, vertical) shared by all beams.
+        """
+        plan = self.plan(self.reference())
+        return 0.5*(plan.edges_h[1:] + plan.edges_h[:-1]), 0.5*(plan.edges_v[1:] + plan.edges_v[:-1])
+
+    def histogram(self, name, ref=23):
+        return self.plan(name).histogram(ref)
+
+    def statistics(self, name, ref=23):
+        """
+        Total, ray counts, mean, RMS, peak position and FWHM (of the integrated profiles) of a beam.
+        """
+        if (name, ref) not in self.statistics_cache:
+            plan = self.plan(name)
+            histogram = plan.histogram(ref)
+            h_axis, v_axis = self.axes()
+            h_profile, v_profile = histogram.sum(axis=1), histogram.sum(axis=0)
+            total = numpy.sum(histogram)
+            stats = {'total': total, 'nrays': plan.nrays, 'good_rays': plan.good_rays}
+            for label, axis, profile in [('x', h_axis, h_profile), ('z', v_axis, v_profile)]:
+                if total > 0.0:
+                    mean = numpy.sum(axis*profile)/total
+                    rms = numpy.sqrt(max(numpy.sum(profile*axis**2)/total - mean**2, 0.0))
+                else:
+                    mean, rms = 0.0, 0.0
+                stats[label + '_mean'] = mean
+                stats[label + '_rms'] = rms
+                stats[label + '_fwhm'] = profile_fwhm(axis, profile)
+            i, j = numpy.unravel_index(numpy.argmax(histogram), histogram.shape)
+            stats['x_peak'], stats['z_peak'] = h_axis[i], v_axis[j]
+            self.statistics_cache[(name, ref)] = stats
+        return self.statistics_cache[(name, ref)]
+
+    def compare(self, name, ref=23, mode='difference', normalize=False):
+        """
+        Difference (beam - reference) or ratio (beam / reference, NaN where the reference is empty).\n
+        :normalize: each histogram is divided by its total first, comparing the shapes only
+        """
+        histogram = self.histogram(name, ref)
+        reference = self.histogram(self.reference(), ref)
+        if normalize:
+            histogram = histogram/numpy.sum(histogram) if numpy.sum(histogram) != 0.0 else histogram
+            reference = reference/numpy.sum(reference) if numpy.sum(reference) != 0.0 else reference
+        if mode == 'difference':
+            return histogram - reference
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            return numpy.where(reference != 0.0, histogram/numpy.where(reference != 0.0, reference, 1.0), numpy.nan)
+
+
+class SummedAreaTable():
+    """
+    Summed-area tables (2D cumulative sums) of a 2D histogram and of its first and second moments,
+    so that sums, centroids and RMS sizes over any rectangle of bins are O(1) queries.
+    Coordinates are taken relative to the centre of the axes to limit the rounding of the moments.
+    """
+
+    def __init__(self, xz, x_axis, z_axis):
+        xz = numpy.asarray(xz, dtype=float)
+        self.x_axis = numpy.asarray(x_axis, dtype=float)
+        self.z_axis = numpy.asarray(z_axis, dtype=float)
+        self.x0 = 0.5*(self.x_axis[0] + self.x_axis[-1])
+        self.z0 = 0.5*(self.z_axis[0] + self.z_axis[-1])
+
+        x = (self.x_axis - self.x0)[None, :]
+        z = (self.z_axis - self.z0)[:, None]
+        self.tables = {name: self.table(values) for name, values in [('f', xz), ('fx', xz*x), ('fz', xz*z),
+                                                                      ('fxx', xz*x*x), ('fzz', xz*z*z)]}
+
+    @staticmethod
+    def table(values):
+        """
+        Summed-area table with a leading row and column of zeros: S[i, j] = values[:i, :j].sum().
+        """
+        S = numpy.zeros((values.shape[0] + 1, values.shape[1] + 1))
+        numpy.cumsum(values, axis=0, out=S[1:, 1:])
+        numpy.cumsum(S[1:, 1:], axis=1, out=S[1:, 1:])
+        return S
+
+    @staticmethod
+    def bin_range(axis, lower, upper):
+        """
+        Slice [start, stop) of the bins whose centres are inside [lower, upper] (axis in increasing order).
+        """
+        return numpy.searchsorted(axis, lower, side='left'), numpy.searchsorted(axis, upper, side='right')
+
+    def box(self, name, i0, i1, j0, j1):
+        S = self.tables[name]
+        return S[i1, j1] - S[i0, j1] - S[i1, j0] + S[i0, j0]
+
+    def roi(self, x_min, x_max, z_min, z_max):
+        """
+        Statistics of the bins whose centres are inside the rectangle [x_min, x_max] x [z_min, z_max].\n
+        :return: dict with total (sum of the bins), fraction (of the whole histogram), x_mean, z_mean,
+                 x_rms, z_rms and the number of bins nx, nz
+        """
+        j0, j1 = self.bin_range(self.x_axis, x_min, x_max)
+        i0, i1 = self.bin_range(self.z_axis, z_min, z_max)
+        total = self.box('f', i0, i1, j0, j1)
+        stats = {'total': total, 'fraction': total/self.tables['f'][-1, -1] if self.tables['f'][-1, -1] != 0 else numpy.nan,
+                 'nx': j1 - j0, 'nz': i1 - i0, 'x_mean': numpy.nan, 'z_mean': numpy.nan, 'x_rms': numpy.nan, 'z_rms': numpy.nan}
+        if total != 0:
+            x_mean, z_mean = self.box('fx', i0, i1, j0, j1)/total, self.box('fz', i0, i1, j0, j1)/total
+            stats['x_rms'] = numpy.sqrt(max(self.box('fxx', i0, i1, j0, j1)/total - x_mean**2, 0.0))
+            stats['z_rms'] = numpy.sqrt(max(self.box('fzz', i0, i1, j0, j1)/total - z_mean**2, 0.0))
+            stats['x_mean'], stats['z_mean'] = x_mean + self.x0, z_mean + self.z0
+        return stats
+
+    def band_profiles(self, x_min, x_max, z_min, z_max):
+        """
+        Profiles integrated over bands: x_profile sums the rows with centres in [z_min, z_max],
+        z_profile sums the columns with centres in [x_min, x_max].\n
+        :return: x_profile, z_profile
+        """
+        S = self.tables['f']
+        j0, j1 = self.bin_range(self.x_axis, x_min, x_max)
+        i0, i1 = self.bin_range(self.z_axis, z_min, z_max)
+        x_profile = numpy.diff(S[i1, :] - S[i0, :])
+        z_profile = numpy.diff(S[:, j1] - S[:, j0])
+        return x_profile, z_profile
+
+
+def histogram_text_header(x_axis, z_axis):
+    """
+    Header of the 2D histogram text files written by the Beam Analysis widget.
+    """
+    header  = '#2D histrogram\n'
+    header += '#Z units: ' + '#Rays weighted by intensity' + '\n'
+    header += '#{0:.8e}'.format(x_axis[0]) + '#xmin' + '\n'
+    header += '#{0:.8e}'.format(x_axis[-1]) + '#xmax' + '\n'
+    header += '#{0}'.format(len(x_axis)) + '#nx' + '\n'
+    header += '#{0:.8e}'.format(z_axis[0]) + '#ymin' + '\n'
+    header += '#{0:.8e}'.format(z_axis[-1]) + '#ymax' + '\n'
+    header += '#{0}'.format(len(z_axis)) + '#ny' + '\n'
+    return header
+
+def write_histogram_text(filename, xz, x_axis, z_axis, chunk_rows=256):
+    """
+    Writes a 2D histogram as text, one row per line of tab-terminated '{0:.8e}' values.\n
+    Blocks of chunk_rows rows are formatted with a single operation instead of one write per value.
+    """
+    xz = numpy.asarray(xz, dtype=float)
+    row_format = '%.8e\t'*xz.shape[1] + '\n'
+    with open(filename, 'w') as outfile:
+        outfile.write(histogram_text_header(x_axis, z_axis))
+        for first in range(0, xz.shape[0], chunk_rows):
+            block = xz[first:first + chunk_rows]
+            outfile.write((row_format*len(block)) % tuple(block.ravel().tolist()))
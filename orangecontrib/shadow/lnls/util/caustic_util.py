@@ -0,0 +1,472 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Caustic calculations that do not depend on the GUI.
+
+Functions defined here are used by the Caustic widget and by its worker processes,
+so they must stay at module level (picklable) and free of Qt objects.
+"""
+
+import sys
+import time
+import optparse
+
+import numpy as np
+import h5py
+import Shadow
+from scipy.optimize import curve_fit
+from scipy.interpolate import interp1d
+
+from orangecontrib.shadow.lnls.util import history_util
+
+
+def calc_rms(x, f_x):
+    return np.sqrt(np.sum(f_x*np.square(x))/np.sum(f_x) - (np.sum(f_x*x)/np.sum(f_x))**2)
+
+def get_fwhm(x, y, oversampling=1, zero_padding=False, avg_correction=False, debug=False):
+
+    def add_zeros(array):
+        aux = []
+        aux.append(0)
+        for i in range(len(array)):
+            aux.append(array[i])
+        aux.append(0)
+        return np.array(aux)
+
+    def add_steps(array):
+        aux = []
+        step = (np.max(array)-np.min(array))/(len(array)-1)
+        aux.append(array[0]-step)
+        for i in range(len(array)):
+            aux.append(array[i])
+        aux.append(array[-1]+step)
+        return np.array(aux)
+
+    def interp_distribution(array_x,array_y,oversampling):
+        dist = interp1d(array_x, array_y)
+        x_int = np.linspace(np.min(array_x), np.max(array_x), int(len(x)*oversampling))
+        y_int = dist(x_int)
+        return x_int, y_int
+
+    if(oversampling > 1.0):
+        array_x, array_y = interp_distribution(x, y, oversampling)
+    else:
+        array_x, array_y = x, y
+
+    if(zero_padding):
+        array_x = add_steps(x)
+        array_y = add_zeros(y)
+
+    try:
+        y_peak = np.max(array_y)
+        idx_peak = (np.abs(array_y-y_peak)).argmin()
+        if(idx_peak==0):
+            left_hwhm_idx = 0
+        else:
+            for i in range(0,idx_peak):
+                if np.abs(array_y[i]-y_peak/2)>np.abs(array_y[i-1]-y_peak/2) and (array_y[i-1]-y_peak/2)>0:
+                    break
+            left_hwhm_idx = i
+
+        if(idx_peak==len(array_y)-1):
+            right_hwhm_idx = len(array_y)-1
+        else:
+            for j in range(len(array_y)-2, idx_peak, -1):
+                if np.abs(array_y[j]-y_peak/2)>np.abs(array_y[j+1]-y_peak/2) and (array_y[j+1]-y_peak/2)>0:
+                    break
+            right_hwhm_idx = j
+
+        fwhm = array_x[right_hwhm_idx] - array_x[left_hwhm_idx]
+
+        if(debug):
+            print(y_peak)
+            print(idx_peak)
+            print(left_hwhm_idx, right_hwhm_idx)
+            print(array_x[left_hwhm_idx], array_x[right_hwhm_idx])
+
+        if(avg_correction):
+            avg_y = (array_y[left_hwhm_idx]+array_y[right_hwhm_idx])/2.0
+            popt_left = np.polyfit(np.array([array_x[left_hwhm_idx-1],array_x[left_hwhm_idx],array_x[left_hwhm_idx+1]]),
+                                   np.array([array_y[left_hwhm_idx-1],array_y[left_hwhm_idx],array_y[left_hwhm_idx+1]]),1)
+            popt_right = np.polyfit(np.array([array_x[right_hwhm_idx-1],array_x[right_hwhm_idx],array_x[right_hwhm_idx+1]]),
+                                   np.array([array_y[right_hwhm_idx-1],array_y[right_hwhm_idx],array_y[right_hwhm_idx+1]]),1)
+            x_left = (avg_y-popt_left[1])/popt_left[0]
+            x_right = (avg_y-popt_right[1])/popt_right[0]
+            fwhm = x_right - x_left
+
+            return [fwhm, x_left, x_right, avg_y, avg_y]
+        else:
+            return [fwhm, array_x[left_hwhm_idx], array_x[right_hwhm_idx], array_y[left_hwhm_idx], array_y[right_hwhm_idx]]
+
+    except ValueError:
+        fwhm = 0.0
+        print("Could not calculate fwhm\n")
+        return [fwhm, 0, 0, 0, 0]
+
+def gaussian_beam(z, s0, z0, beta):
+    return s0*np.sqrt(1 + ((z-z0)/beta)**2)
+
+def weighted_avg_and_std(values, weights):
+    """
+    By EOL - stackoverflow - 10/03/2010
+    Return the weighted average and standard deviation.
+    values, weights -- Numpy ndarrays with the same shape.
+    """
+    try:
+        average = np.average(values, weights=weights)
+        variance = np.average((values-average)**2, weights=weights)  # Fast and numerically precise
+        return (average, np.sqrt(variance))
+    except:
+        print('   Mean and RMS values could not be calculated.')
+        return (np.nan, np.nan)
+
+def fit_gaussian_beam(z_points, size):
+    """
+    Fits gaussian_beam to a size curve, with the same initial guess used by the Caustic widget.\n
+    :return: [s0, z0, beta], or [0, 0, 0] if the fit fails
+    """
+    nz = len(z_points)
+    try:
+        p0 = [size[int(nz/2)], z_points[int(nz/2.2)], size[int(nz/2)]/((size[-1] - size[int(nz/2)]) / (z_points[-1] - z_points[int(nz/2)]))]
+        popt, pcov = curve_fit(f=gaussian_beam, xdata=z_points, ydata=size, p0=p0, maxfev=5000)
+        return list(popt)
+    except:
+        return [0.0]*3
+
+def get_waist(z_points, size):
+    """
+    Waist metrics of a size curve.\n
+    :return: [minimum size, z of minimum size, fitted s0, fitted z0, fitted beta]
+    """
+    good = np.isfinite(size)
+    if not np.any(good):
+        return [np.nan]*5
+    idx_min = np.argmin(np.where(good, size, np.inf))
+    return [size[idx_min], z_points[idx_min]] + fit_gaussian_beam(z_points[good], size[good])
+
+def histo2_fwhm(bin_center, histogram):
+    """
+    FWHM of a profile computed as in Shadow's Beam.histo2 (distance between the outermost bins above half maximum).\n
+    :return: (fwhm, (left coordinate, right coordinate)), or (None, None) if it cannot be calculated
+    """
+    tt = np.where(histogram >= np.max(histogram)*0.5)
+    if histogram[tt].size > 1:
+        bin_size = bin_center[1] - bin_center[0]
+        return bin_size*(tt[0][-1] - tt[0][0]), (bin_center[tt[0][0]], bin_center[tt[0][-1]])
+    return None, None
+
+def make_histo2_ticket(histogram, bin_h_center, bin_v_center):
+    """
+    Builds a dict with the keys of Shadow's Beam.histo2 output from an accumulated 2D histogram (nbins_h, nbins_v).
+    """
+    ticket = {'histogram':histogram, 'bin_h_center':bin_h_center, 'bin_v_center':bin_v_center,
+              'nbins_h':len(bin_h_center), 'nbins_v':len(bin_v_center),
+              'histogram_h':histogram.sum(axis=1), 'histogram_v':histogram.sum(axis=0)}
+    ticket['fwhm_h'], ticket['fwhm_coordinates_h'] = histo2_fwhm(bin_h_center, ticket['histogram_h'])
+    ticket['fwhm_v'], ticket['fwhm_coordinates_v'] = histo2_fwhm(bin_v_center, ticket['histogram_v'])
+    return ticket
+
+def progressive_ray_counts(good_rays, first_fraction, npasses):
+    """
+    Cumulative number of rays used after each pass of a progressive caustic. The fractions grow 
+    geometrically from first_fraction to 1, so each pass roughly multiplies the statistics.
+    """
+    first_fraction = min(max(first_fraction, 1.0/good_rays), 1.0)
+    fractions = np.geomspace(first_fraction, 1.0, max(npasses, 1))
+    counts = np.round(fractions*good_rays).astype(int)
+    counts[-1] = good_rays
+    return np.unique(np.maximum(counts, 1))
+
+def histogram_bin_index(values, value_range, nbins):
+    """
+    Bin index of each value with numpy.histogram conventions (last bin closed on the right).\n
+    :return: (index, inside) where inside is False for values out of value_range
+    """
+    edges = np.linspace(value_range[0], value_range[1], nbins + 1)
+    inside = (values >= edges[0]) & (values <= edges[-1])
+    index = np.searchsorted(edges, values, side='right') - 1
+    index[values == edges[-1]] = nbins - 1
+    return index, inside
+
+def bootstrap_z_block(rays, z_values, colh, colv, colref, nbinsh, nbinsv, xrange, yrange, nreplicates, seed, weights_memory=256.0):
+    """
+    Worker for bootstrap uncertainties of a block of z steps. Replicate r weights every ray by a 
+    Poisson(1) count drawn from the seed (seed, r), so one replicate resamples the same rays at all z.
+    The counts (uint8) are drawn once per block and reused at all z, for groups of replicates that fit
+    in weights_memory; bin indices are computed once per z and group.\n
+    :rays: good rays (N, 18)
+    :weights_memory: memory for the Poisson counts of a group of replicates [MB]
+    :return: dict of arrays (nreplicates, len(z_values)) mean_h, mean_v, rms_h, rms_v, fwhm_h, fwhm_v, fwhm_h_shadow, fwhm_v_shadow
+    """
+    beam = Shadow.Beam()
+    beam.rays = rays # the worker receives its own copy
+    nrays = len(rays)
+    group_size = int(min(max(weights_memory*1e6//max(nrays, 1), 1), nreplicates))
+
+    bin_h_center = np.linspace(xrange[0], xrange[1], nbinsh + 1)[:-1] + 0.5*(xrange[1] - xrange[0])/nbinsh
+    bin_v_center = np.linspace(yrange[0], yrange[1], nbinsv + 1)[:-1] + 0.5*(yrange[1] - yrange[0])/nbinsv
+
+    result = {}
+    for key in ['mean_h', 'mean_v', 'rms_h', 'rms_v', 'fwhm_h', 'fwhm_v', 'fwhm_h_shadow', 'fwhm_v_shadow']:
+        result[key] = np.full((nreplicates, len(z_values)), np.nan)
+
+    for first in range(0, nreplicates, group_size):
+        replicates = range(first, min(first + group_size, nreplicates))
+        poisson_weights = np.empty((len(replicates), nrays), dtype=np.uint8)
+        for k, r in enumerate(replicates):
+            poisson_weights[k] = np.random.default_rng([seed, r]).poisson(1.0, nrays)
+
+        for i, z in enumerate(z_values):
+            beam.retrace(z)
+            col_h = beam.getshonecol(colh, nolost=1)
+            col_v = beam.getshonecol(colv, nolost=1)
+            weight = beam.getshonecol(colref, nolost=1) if colref > 0 else np.ones(nrays)
+            index_h, inside_h = histogram_bin_index(col_h, xrange, nbinsh)
+            index_v, inside_v = histogram_bin_index(col_v, yrange, nbinsv)
+            inside = inside_h & inside_v
+            index_h, index_v, weight = index_h[inside], index_v[inside], weight[inside]
+
+            for k, r in enumerate(replicates):
+                w = weight*poisson_weights[k][inside]
+                histogram_h = np.bincount(index_h, weights=w, minlength=nbinsh)
+                histogram_v = np.bincount(index_v, weights=w, minlength=nbinsv)
+                result['mean_h'][r,i], result['rms_h'][r,i] = weighted_avg_and_std(bin_h_center, histogram_h)
+                result['mean_v'][r,i], result['rms_v'][r,i] = weighted_avg_and_std(bin_v_center, histogram_v)
+                result['fwhm_h'][r,i] = get_fwhm(bin_h_center, histogram_h)[0]
+                result['fwhm_v'][r,i] = get_fwhm(bin_v_center, histogram_v)[0]
+                fwhm_h_shadow = histo2_fwhm(bin_h_center, histogram_h)[0]
+                fwhm_v_shadow = histo2_fwhm(bin_v_center, histogram_v)[0]
+                result['fwhm_h_shadow'][r,i] = np.nan if fwhm_h_shadow is None else fwhm_h_shadow
+                result['fwhm_v_shadow'][r,i] = np.nan if fwhm_v_shadow is None else fwhm_v_shadow
+
+    return result
+
+def caustic_summary(beam, zStart, zFin, nz, colh, colv, colref, nbinsh, nbinsv, xrange, yrange):
+    """
+    Runs a caustic keeping only the summary curves (no 2D histograms).\n
+    :return: dict with z_points, good_rays and arrays (nz) mean_h, mean_v, rms_h, rms_v, fwhm_h, fwhm_v
+    """
+    z_points = np.linspace(zStart, zFin, nz)
+    summary = {'z_points':z_points, 'good_rays':beam.nrays(nolost=1)}
+    for key in ['mean_h', 'mean_v', 'rms_h', 'rms_v', 'fwhm_h', 'fwhm_v']:
+        summary[key] = np.zeros(nz)
+
+    for i in range(nz):
+        beam.retrace(z_points[i])
+        histo = beam.histo2(col_h=colh, col_v=colv, nbins_h=nbinsh, nbins_v=nbinsv, nolost=1, ref=colref, xrange=xrange, yrange=yrange)
+        summary['mean_h'][i], summary['rms_h'][i] = weighted_avg_and_std(histo['bin_h_center'], histo['histogram_h'])
+        summary['mean_v'][i], summary['rms_v'][i] = weighted_avg_and_std(histo['bin_v_center'], histo['histogram_v'])
+        summary['fwhm_h'][i] = get_fwhm(histo['bin_h_center'], histo['histogram_h'])[0]
+        summary['fwhm_v'][i] = get_fwhm(histo['bin_v_center'], histo['histogram_v'])[0]
+
+    return summary
+
+def run_sweep_point(descriptors, input_rays, start, sweep_index, parameter, value, caustic_kwargs):
+    """
+    Worker for parameter sweeps: re-traces the beamline with parameter = value and runs a summary caustic.\n
+    :descriptors, input_rays, start: see history_util.trace_history
+    :caustic_kwargs: keyword arguments of caustic_summary (except beam)
+    :return: caustic_summary dict with the extra keys value, waist_fwhm_h, waist_fwhm_v, waist_rms_h, waist_rms_v
+    """
+    beam = history_util.trace_history(descriptors, input_rays=input_rays, start=start,
+                                      sweep_index=sweep_index, parameter=parameter, value=value)
+    summary = caustic_summary(beam, **caustic_kwargs)
+    summary['value'] = value
+    for key in ['fwhm_h', 'fwhm_v', 'rms_h', 'rms_v']:
+        summary['waist_' + key] = get_waist(summary['z_points'], summary[key])
+    return summary
+
+#### SWMR caustic files
+
+# per-step statistics kept in the 'stats' dataset of SWMR files (name, number of values)
+STEP_STATS = [('z', 1), ('xStart', 1), ('xFin', 1), ('nx', 1), ('yStart', 1), ('yFin', 1), ('ny', 1),
+              ('mean_h', 1), ('mean_v', 1), ('rms_h', 1), ('rms_v', 1), ('fwhm_h', 5), ('fwhm_v', 5),
+              ('ellapsed time (s)', 1), ('fwhm_h_shadow', 1), ('center_h_shadow', 1), ('fwhm_v_shadow', 1), ('center_v_shadow', 1)]
+
+def pack_step_stats(attrs):
+    return np.concatenate([np.ravel(np.array(attrs[key], dtype=float)) for key, n in STEP_STATS])
+
+def unpack_step_stats(row):
+    attrs = {}
+    k = 0
+    for key, n in STEP_STATS:
+        attrs[key] = row[k] if n == 1 else np.array(row[k:k+n])
+        k += n
+    return attrs
+
+class CausticSWMRWriter(object):
+    """
+    Keeps a caustic file open in HDF5 single-writer/multiple-reader mode while the caustic runs.
+    
+    Objects and attributes cannot be created in SWMR mode, so all step datasets, the 'stats' dataset 
+    (one row of STEP_STATS per step) and the 'progress' counter (number of steps written) are created 
+    beforehand. The file must have been created with libver='latest'. The per-step attributes are 
+    written by finalize_swmr_caustic after the writer is closed, and the 'stats' and 'progress' 
+    datasets are removed by remove_swmr_datasets once the final summary is written.
+    """
+    
+    def __init__(self, filename, z_points, zOffset, nbinsh, nbinsv, xrange, yrange):
+        
+        self.f = h5py.File(filename, 'a', libver='latest')
+        nz = len(z_points)
+        half_bin_h = 0.5*(xrange[1] - xrange[0])/nbinsh
+        half_bin_v = 0.5*(yrange[1] - yrange[0])/nbinsv
+        
+        self.steps = []
+        for i in range(nz):
+            dset = self.f.create_dataset('step_{0:0{ndigits}d}'.format(i+1, ndigits=len(str(nz))), shape=(nbinsh, nbinsv),
+                                         dtype=float, chunks=True, compression="gzip", fillvalue=0.0)
+            # attributes needed by readers before the file is finalized
+            dset.attrs['z'] = z_points[i] + zOffset
+            dset.attrs['xStart'], dset.attrs['xFin'], dset.attrs['nx'] = xrange[0] + half_bin_h, xrange[1] - half_bin_h, nbinsh
+            dset.attrs['yStart'], dset.attrs['yFin'], dset.attrs['ny'] = yrange[0] + half_bin_v, yrange[1] - half_bin_v, nbinsv
+            self.steps.append(dset)
+            
+        self.stats = self.f.create_dataset('stats', shape=(nz, sum([n for key, n in STEP_STATS])),
+                                           dtype=float, fillvalue=np.nan)
+        self.stats.attrs['columns'] = ', '.join(['{0} ({1})'.format(key, n) for key, n in STEP_STATS])
+        self.progress = self.f.create_dataset('progress', data=np.array([0]))
+        self.f.swmr_mode = True
+    
+    def write_step(self, i, histogram, attrs):
+        self.steps[i][...] = histogram
+        self.steps[i].flush()
+        self.stats[i] = pack_step_stats(attrs)
+        self.stats.flush()
+        self.progress[0] = i + 1
+        self.progress.flush()
+    
+    def close(self):
+        self.f.close()
+
+def finalize_swmr_caustic(filename):
+    """
+    Copies the 'stats' rows of a closed SWMR caustic file to the attributes of the step datasets, 
+    so that it reads like a caustic written step by step.
+    """
+    with h5py.File(filename, 'a') as f:
+        stats = np.array(f['stats'])
+        step_names = sorted([name for name in f.keys() if name.startswith('step_')])
+        for i, name in enumerate(step_names):
+            for key, value in unpack_step_stats(stats[i]).items():
+                f[name].attrs[key] = value
+        f.attrs['progress'] = int(f['progress'][0])
+        f.attrs['end time'] = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
+
+def truncate_caustic(filename, nsteps):
+    """
+    Keeps the first nsteps steps of a caustic file (e.g. a run stopped by the user), with zFin
+    and nz of the steps kept.
+    """
+    with h5py.File(filename, 'a') as f:
+        z_points = np.linspace(f.attrs['zStart'], f.attrs['zFin'], f.attrs['nz'])
+        step_names = sorted([name for name in f.keys() if name.startswith('step_')])
+        for name in step_names[nsteps:]:
+            del f[name]
+        f.attrs['zFin'] = z_points[nsteps - 1]
+        f.attrs['nz'] = nsteps
+
+def remove_swmr_datasets(filename):
+    """
+    Removes the 'stats' and 'progress' working datasets of a finalized SWMR caustic file, whose 
+    contents are in the step attributes and in the 'progress' attribute.
+    """
+    with h5py.File(filename, 'a') as f:
+        for name in ['stats', 'progress']:
+            if name in f:
+                del f[name]
+
+def open_caustic(filename):
+    """
+    Opens a caustic file for reading, as a SWMR reader when possible.
+    """
+    try:
+        return h5py.File(filename, 'r', libver='latest', swmr=True)
+    except (OSError, ValueError):
+        return h5py.File(filename, 'r')
+
+def is_growing_caustic(filename):
+    """
+    True if the caustic file is still being written (SWMR file without the final summary).
+    """
+    with open_caustic(filename) as f:
+        return ('progress' in f) and not ('histoXZ' in f)
+
+def read_growing_caustic(filename):
+    """
+    Reads the steps already written to a SWMR caustic file.\n
+    :return: dict with zStart, zFin, nz, progress, 'begin time', xStart, xFin, yStart, yFin, the arrays (nz) 
+             rms_h_array, rms_v_array, fwhm_h_array, fwhm_v_array, fwhm_shadow_h_array, fwhm_shadow_v_array 
+             (nan for missing steps) and histoXZ (nx, nz), histoYZ (ny, nz) (zeros for missing steps)
+    """
+    with open_caustic(filename) as f:
+        f['progress'].refresh()
+        f['stats'].refresh()
+        progress = int(f['progress'][0])
+        stats = np.array(f['stats'])
+        step_names = sorted([name for name in f.keys() if name.startswith('step_')])
+        
+        caustic = {'zStart':f.attrs['zStart'], 'zFin':f.attrs['zFin'], 'nz':f.attrs['nz'], 'progress':progress,
+                   'begin time':f.attrs['begin time']}
+        for key in ['xStart', 'xFin', 'nx', 'yStart', 'yFin', 'ny']:
+            caustic[key] = f[step_names[0]].attrs[key]
+        
+        histoH = np.zeros((caustic['nx'], caustic['nz']))
+        histoV = np.zeros((caustic['ny'], caustic['nz']))
+        for i in range(progress):
+            f[step_names[i]].refresh()
+            histo2D = np.array(f[step_names[i]])
+            histoH[:,i] = histo2D.sum(axis=1)
+            histoV[:,i] = histo2D.sum(axis=0)
+    
+    steps = [unpack_step_stats(row) for row in stats]
+    caustic['rms_h_array'] = np.array([step['rms_h'] for step in steps])
+    caustic['rms_v_array'] = np.array([step['rms_v'] for step in steps])
+    caustic['fwhm_h_array'] = np.array([step['fwhm_h'][0] for step in steps])
+    caustic['fwhm_v_array'] = np.array([step['fwhm_v'][0] for step in steps])
+    caustic['fwhm_shadow_h_array'] = np.array([step['fwhm_h_shadow'] for step in steps])
+    caustic['fwhm_shadow_v_array'] = np.array([step['fwhm_v_shadow'] for step in steps])
+    caustic['histoXZ'] = histoH
+    caustic['histoYZ'] = histoV
+    return caustic
+
+def follow_caustic(filename, interval=2.0):
+    """
+    Prints the progress and the current minimum FWHM of a caustic file, every interval seconds 
+    until it is finalized (only once if interval is None).
+    """
+    while True:
+        growing = is_growing_caustic(filename)
+        if growing:
+            caustic = read_growing_caustic(filename)
+            progress, nz = caustic['progress'], caustic['nz']
+        else:
+            with open_caustic(filename) as f:
+                caustic = {key: f.attrs[key] for key in ['zStart', 'zFin', 'nz', 'fwhm_h_array', 'fwhm_v_array']}
+            progress = nz = caustic['nz']
+        
+        z_points = np.linspace(caustic['zStart'], caustic['zFin'], nz)
+        text = '{0}: {1}/{2} steps'.format(time.strftime("%H:%M:%S", time.localtime()), progress, nz)
+        if progress > 0:
+            for key, label in [('fwhm_h_array', 'X'), ('fwhm_v_array', 'Y')]:
+                fwhm = np.array(caustic[key][:progress], dtype=float)
+                if np.any(np.isfinite(fwhm)):
+                    idx = np.nanargmin(fwhm)
+                    text += '; min FWHM {0} = {1:.6g} at z = {2:.6g}'.format(label, fwhm[idx], z_points[idx])
+        sys.stdout.write(text + '\n')
+        sys.stdout.flush()
+        
+        if (not growing) or (interval is None):
+            break
+        time.sleep(interval)
+
+
+if __name__ == '__main__':
+
+    p = optparse.OptionParser(usage='python -m orangecontrib.shadow.lnls.util.caustic_util -f FILE [--follow]')
+    p.add_option('-f', '--infile', dest='infile', metavar='FILE', default='', help='caustic file name')
+    p.add_option('--follow', dest='follow', action='store_true', default=False, help='refresh until the caustic is finished')
+    p.add_option('-i', '--interval', dest='interval', type='float', default=2.0, help='refresh interval in seconds')
+    opt, args = p.parse_args()
+    
+    follow_caustic(opt.infile, opt.interval if opt.follow else None)
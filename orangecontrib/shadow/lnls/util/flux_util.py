@@ -0,0 +1,1244 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Source spectrum functions used by the Flux widget, without GUI dependencies.
+"""
+
+import os
+import glob
+import hashlib
+import zipfile
+import multiprocessing
+import tempfile
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy
+from scipy.special import kv, kve
+from scipy.integrate import quad
+try:
+    from scipy.integrate import simpson
+except ImportError: # scipy < 1.6
+    from scipy.integrate import simps as simpson
+from scipy.signal import fftconvolve
+from scipy.interpolate import CubicSpline
+
+
+CACHE_DIRECTORY = os.path.join(os.path.expanduser('~'), '.cache', 'oasys_lnls')
+
+### G1(y) table: log-spaced nodes, cubic spline of log(G1) vs log(y) ###
+G1_Y_MIN = 1e-5
+G1_Y_MAX = 100.0
+G1_NODES = 1500
+
+_g1_spline = None
+
+### K1/3 and K2/3 tables: nodes uniform in log(x), cubic spline of log(K*exp(x)) ###
+KV_X_MIN = 1e-6
+KV_X_MAX = 700.0
+KV_NODES = 4000
+
+_kv_tables = {}
+
+
+def cache_file(name):
+    """
+    Returns the path of a file in the cache folder, creating the folder if needed.
+    """
+    os.makedirs(CACHE_DIRECTORY, exist_ok=True)
+    return os.path.join(CACHE_DIRECTORY, name)
+
+def save_npz(filename, **arrays):
+    """
+    numpy.savez to a temporary file in the same folder, moved to filename when complete, so
+    that readers (other processes) never see a partially written file.
+    """
+    fd, temporary = tempfile.mkstemp(prefix=os.path.basename(filename) + '.', suffix='.tmp', dir=os.path.dirname(filename))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            numpy.savez(f, **arrays)
+        os.replace(temporary, filename)
+    except BaseException:
+        os.remove(temporary)
+        raise
+
+def int_K53(y):
+    """
+    Integral of the modified Bessel function K5/3 from y to infinity, computed with quad.
+    """
+    return quad(lambda x: kv(5.0/3.0, x), y, numpy.inf)[0]
+
+def build_G1_table(y_min=G1_Y_MIN, y_max=G1_Y_MAX, n=G1_NODES):
+    """
+    Tabulates G1(y) = y*int_y^inf K5/3(x)dx on log-spaced nodes.\n
+    The integral is accumulated from the top of the table over the intervals between
+    nodes, so each node only costs one short quad call.\n
+    :return: arrays y, G1(y)
+    """
+    y = numpy.logspace(numpy.log10(y_min), numpy.log10(y_max), n)
+    segments = numpy.array([quad(lambda x: kv(5.0/3.0, x), a, b, epsabs=0, epsrel=1e-13, limit=200)[0]
+                            for a, b in zip(y[:-1], y[1:])])
+    tail = quad(lambda x: kv(5.0/3.0, x), y[-1], numpy.inf, epsabs=0, epsrel=1e-13)[0]
+    integral = numpy.append(numpy.cumsum(segments[::-1])[::-1], 0.0) + tail
+    return y, y*integral
+
+def load_G1_table():
+    """
+    Returns the G1 spline, building it once per process. The table is stored in the
+    cache folder and read back by the following processes.
+    """
+    global _g1_spline
+
+    if _g1_spline is None:
+        filename = 'G1_table_{0:g}_{1:g}_{2}.npz'.format(G1_Y_MIN, G1_Y_MAX, G1_NODES)
+        try:
+            table = numpy.load(cache_file(filename))
+            y, g1 = table['y'], table['g1']
+        except (OSError, KeyError, ValueError, zipfile.BadZipFile): # missing or damaged: rebuilt
+            y, g1 = build_G1_table()
+            try:
+                save_npz(cache_file(filename), y=y, g1=g1)
+            except OSError:
+                pass # read-only home: the table is kept in memory only
+        _g1_spline = CubicSpline(numpy.log(y), numpy.log(g1))
+
+    return _g1_spline
+
+def G1(y):
+    """
+    Synchrotron function G1(y) = y*int_y^inf K5/3(x)dx, evaluated on arrays.\n
+    Values inside [G1_Y_MIN, G1_Y_MAX] are interpolated (relative error < 1e-6). Below the
+    table the integral is split at G1_Y_MIN, since quad alone is inaccurate near the
+    singularity at 0; above it the values are integrated directly.\n
+    :y: photon energy relative to the critical energy - single value or array
+    """
+    y = numpy.asarray(y, dtype=float)
+    g1 = numpy.zeros(y.shape)
+
+    inside = numpy.logical_and(y >= G1_Y_MIN, y <= G1_Y_MAX)
+    g1[inside] = numpy.exp(load_G1_table()(numpy.log(y[inside])))
+
+    below = numpy.logical_and(y > 0, y < G1_Y_MIN)
+    int_K53_min = numpy.exp(load_G1_table()(numpy.log(G1_Y_MIN)))/G1_Y_MIN
+    g1[below] = [y_i*(quad(lambda x: kv(5.0/3.0, x), y_i, G1_Y_MIN)[0] + int_K53_min) for y_i in y[below]]
+
+    above = y > G1_Y_MAX
+    g1[above] = [y_i*int_K53(y_i) for y_i in y[above]]
+
+    return g1
+
+def kv_tabulated(nu, x):
+    """
+    Modified Bessel function K_nu(x) interpolated from a table built once per process
+    (relative error ~1e-12). The table nodes are uniform in log(x), so the interval of
+    each point is found by direct indexing instead of a search. Values outside
+    [KV_X_MIN, KV_X_MAX] are calculated with kv.\n
+    :nu: order
+    :x: array of positive values
+    """
+    if nu not in _kv_tables:
+        u = numpy.linspace(numpy.log(KV_X_MIN), numpy.log(KV_X_MAX), KV_NODES)
+        _kv_tables[nu] = CubicSpline(u, numpy.log(kve(nu, numpy.exp(u)))).c
+    c = _kv_tables[nu]
+
+    x = numpy.asarray(x, dtype=float)
+    u0 = numpy.log(KV_X_MIN)
+    du = (numpy.log(KV_X_MAX) - u0)/(KV_NODES - 1)
+
+    s = (numpy.log(x) - u0)/du
+    idx = numpy.clip(s.astype(numpy.intp), 0, KV_NODES - 2)
+    t = (s - idx)*du
+    result = c[0][idx]*t
+    result += c[1][idx]
+    result *= t
+    result += c[2][idx]
+    result *= t
+    result += c[3][idx]
+    result -= x
+    numpy.exp(result, out=result)
+
+    outside = numpy.logical_or(x < KV_X_MIN, x > KV_X_MAX)
+    if numpy.any(outside):
+        result[outside] = kv(nu, x[outside])
+    return result
+
+def BM_spectrum(E, I, B, ph_energy, hor_acc_mrad=1.0):
+    """
+    Calculates the emitted spectrum of a Bending Magnet (vertically integrated) whithin a horizontal acceptance\n
+    Units: [ph/s/0.1%bw]\n
+    :E: Storage Ring energy [GeV]
+    :I: Storage Ring current [A]
+    :B: Magnetic Field value [T]
+    :ph_energy: Array of Photon Energies [eV]
+    :hor_acc_mrad: Horizontal acceptance [mrad]
+    """
+    e_c = 665*(E**2)*B # eV
+    return (2.457*1e13)*E*I*G1(numpy.asarray(ph_energy)/e_c)*hor_acc_mrad
+
+def Wiggler_spectrum(E, I, B, N_periods, ph_energy, hor_acc_mrad=1.0):
+    """
+    Calculates the emitted spectrum of a Wiggler (vertically integrated) whithin a horizontal acceptance\n
+    Units: [ph/s/0.1%bw]\n
+    :E: Storage Ring energy [GeV]
+    :I: Storage Ring current [A]
+    :B: Magnetic Field value [T]
+    :N_periods: Number of Periods
+    :ph_energy: Array of Photon Energies [eV]
+    :hor_acc_mrad: Horizontal acceptance [mrad]
+    """
+    return BM_spectrum(E, I, B, ph_energy, hor_acc_mrad)*(2*N_periods)
+
+def BM_vertical_acc(E=3.0, B=3.2, ph_energy=1915.2, div_limits=[-1.0e-3, 1.0e-3], e_beam_vert_div=0.0):
+    """
+    Calculates the vertical angular flux probability density function (pdf) for \
+    a Bending Magnet or Wiggler and compares it to divergence limits to calculate \
+    the relative vertcal acceptance. All energies are calculated at once on an (energy x psi) array.\n
+    Return: Dictionary containing vertical angular distribution, fwhm and acceptance factor (energy-dependent)  \n
+    :E: Storage Ring energy [GeV]
+    :B: Magnetic Field value [T]
+    :ph_energy: Photon Energy - single value or array - [eV]
+    :div_limits: Divergence limits array for which acceptance must be calculated [rad]
+    :e_beam_vert_div: electron beam vertical divergence sigma [rad]. Not taken into account if equal to None.
+    """
+    ph_energy = numpy.atleast_1d(numpy.asarray(ph_energy, dtype=float))
+
+    I = 0.1 # [A] -> result independent
+    gamma = E/0.51099890221e-03
+    e_c = 665*(E**2)*B # [eV]
+    energy_relative = ph_energy/e_c
+
+    # calculate graussian approximation to define psi mesh
+    int_K53_0 = G1(energy_relative[0])/energy_relative[0]
+    K23 = kv(2.0/3.0, energy_relative[0]/2)
+    vert_angle_sigma = numpy.sqrt(2*numpy.pi/3)/(gamma*energy_relative[0])*int_K53_0/((K23)**2)
+    if(e_beam_vert_div > 0.0):
+        vert_angle_sigma = numpy.sqrt(vert_angle_sigma**2 + e_beam_vert_div**2)
+
+    psi = numpy.linspace(-vert_angle_sigma*2, vert_angle_sigma*2, 1000) # vertical angle array
+    gamma_psi = 1 + (gamma**2) * (psi**2) # factor dependent on gamma and psi
+    psi_minus = numpy.abs(psi - div_limits[0]).argmin() # first psi limit index
+    psi_plus = numpy.abs(psi - div_limits[1]).argmin() # second psi limit index
+
+    # (energy x psi) distribution
+    e_relative = energy_relative[:, None]
+    G = (e_relative/2.0)*(gamma_psi**(1.5))
+    vert_pdf  = (1.33e13)*(E**2)*I*(e_relative**2)*(gamma_psi**2)
+    vert_pdf *= ( (kv_tabulated(2.0/3.0, G)**2) + (((gamma**2) * (psi**2))/(gamma_psi))*(kv_tabulated(1.0/3.0, G)**2) )
+    vert_pdf /= simpson(y=vert_pdf, x=psi, axis=1)[:, None]
+
+    if(e_beam_vert_div > 0.0): # convolves radiation and e-beam angular distributions
+        e_beam_pdf = (1/(numpy.sqrt(2*numpy.pi*e_beam_vert_div**2)))*numpy.exp(-psi**2/(2*e_beam_vert_div**2))
+        vert_pdf = fftconvolve(vert_pdf, e_beam_pdf[None, :], mode='same', axes=1)
+        vert_pdf /= simpson(y=vert_pdf, x=psi, axis=1)[:, None]
+
+    vert_acceptance = simpson(vert_pdf[:, psi_minus:psi_plus+1], x=psi[psi_minus:psi_plus+1], axis=1)
+
+    # FWHM: half maximum crossings searched on each side of the peak
+    peak = numpy.max(vert_pdf, axis=1)
+    peak_idx = numpy.argmax(vert_pdf, axis=1)
+    distance = numpy.abs(vert_pdf - peak[:, None]/2)
+    left_side = numpy.arange(len(psi))[None, :] < peak_idx[:, None]
+    lwhm = psi[numpy.where(left_side, distance, numpy.inf).argmin(axis=1)]
+    rwhm = psi[numpy.where(left_side, numpy.inf, distance).argmin(axis=1)]
+
+    output = {"Psi": psi,
+              "PDF": vert_pdf,
+              "acceptance": vert_acceptance,
+              "lwhm": lwhm,
+              "rwhm": rwhm,
+              "fwhm": rwhm - lwhm}
+
+    return output
+
+def srw_undulator_spectrum(mag_field=[], electron_beam=[], energy_grid=[], sampling_mesh=[], precision=[], first_harmonic=1):
+    """
+    Calls SRW to calculate spectrum for a planar or elliptical undulator\n
+    :mag_field: list containing: [period [m], length [m], Bx [T], By [T], phase Bx = 0, phase By = 0, Symmetry Bx = +1, Symmetry By = -1]
+    :electron_beam: list containing: [Sx [m], Sy [m], Sx' [rad], Sy'[rad], Energy [GeV], Energy Spread [dE/E], Current [A]]
+    :energy_grid: list containing: [initial energy, final energy, number of energy points]
+    :sampling_mesh: list containing: [observation plane distance from source [m], range -X [m], , range+X [m], range -Y [m], range +Y [m]]
+    :precision: list containing: [h_max: maximum harmonic number to take into account, longitudinal precision factor, azimuthal precision factor (1 is standard, >1 is more accurate]
+    :first_harmonic: initial harmonic number to take into account
+    """ 
+
+    from oasys_srw.srwlib import SRWLMagFldU, SRWLMagFldH, SRWLPartBeam, SRWLStokes, srwl
+
+    #***********Undulator
+    und = SRWLMagFldU([SRWLMagFldH(1, 'v', mag_field[3], mag_field[5], mag_field[7], 1), 
+                       SRWLMagFldH(1, 'h', mag_field[2], mag_field[4], mag_field[6], 1)], 
+                       mag_field[0], int(round(mag_field[1]/mag_field[0])))
+       
+    #***********Electron Beam
+    eBeam = SRWLPartBeam()
+    eBeam.Iavg = electron_beam[6] #average current [A]
+    eBeam.partStatMom1.x = 0. #initial transverse positions [m]
+    eBeam.partStatMom1.y = 0.
+    eBeam.partStatMom1.z = -(mag_field[1]/2 + mag_field[0]*2) #initial longitudinal positions (set in the middle of undulator)
+    eBeam.partStatMom1.xp = 0 #initial relative transverse velocities
+    eBeam.partStatMom1.yp = 0
+    eBeam.partStatMom1.gamma = electron_beam[4]/0.51099890221e-03 #relative energy
+    sigEperE = electron_beam[5] #0.00089 #relative RMS energy spread
+    sigX = electron_beam[0] #33.33e-06 #horizontal RMS size of e-beam [m]
+    sigXp = electron_beam[2] #16.5e-06 #horizontal RMS angular divergence [rad]
+    sigY = electron_beam[1] #2.912e-06 #vertical RMS size of e-beam [m]
+    sigYp = electron_beam[3] #2.7472e-06 #vertical RMS angular divergence [rad]
+    #2nd order stat. moments:
+    eBeam.arStatMom2[0] = sigX*sigX #<(x-<x>)^2> 
+    eBeam.arStatMom2[1] = 0 #<(x-<x>)(x'-<x'>)>
+    eBeam.arStatMom2[2] = sigXp*sigXp #<(x'-<x'>)^2> 
+    eBeam.arStatMom2[3] = sigY*sigY #<(y-<y>)^2>
+    eBeam.arStatMom2[4] = 0 #<(y-<y>)(y'-<y'>)>
+    eBeam.arStatMom2[5] = sigYp*sigYp #<(y'-<y'>)^2>
+    eBeam.arStatMom2[10] = sigEperE*sigEperE #<(E-<E>)^2>/<E>^2
+    
+    #***********Precision Parameters
+    arPrecF = [0]*5 #for spectral flux vs photon energy
+    arPrecF[0] = first_harmonic #initial UR harmonic to take into account
+    arPrecF[1] = precision[0] #final UR harmonic to take into account
+    arPrecF[2] = precision[1] #longitudinal integration precision parameter
+    arPrecF[3] = precision[2] #azimuthal integration precision parameter
+    arPrecF[4] = 1 #calculate flux (1) or flux per unit surface (2)
+        
+    #***********UR Stokes Parameters (mesh) for Spectral Flux
+    stkF = SRWLStokes() #for spectral flux vs photon energy
+    stkF.allocate(energy_grid[2], 1, 1) #numbers of points vs photon energy, horizontal and vertical positions
+    stkF.mesh.zStart = sampling_mesh[0] #longitudinal position [m] at which UR has to be calculated
+    stkF.mesh.eStart = energy_grid[0] #initial photon energy [eV]
+    stkF.mesh.eFin = energy_grid[1] #final photon energy [eV]
+    stkF.mesh.xStart = sampling_mesh[1] #initial horizontal position [m]
+    stkF.mesh.xFin = sampling_mesh[2] #final horizontal position [m]
+    stkF.mesh.yStart = sampling_mesh[3] #initial vertical position [m]
+    stkF.mesh.yFin = sampling_mesh[4] #final vertical position [m]
+           
+    
+    #**********************Calculation (SRWLIB function calls)
+    #print('   Performing Spectral Flux (Stokes parameters) calculation ... ')
+    srwl.CalcStokesUR(stkF, eBeam, und, arPrecF)
+    #print('done')
+    
+    return numpy.array(stkF.arS[0:energy_grid[2]])
+
+def split_energy_grid(energy_grid, n_chunks):
+    """
+    Splits an energy grid into contiguous chunks of the same grid points. Consecutive
+    chunks share their boundary point, which is used to check the stitching.\n
+    :return: list of (first index, last index, [initial energy, final energy, number of points])
+    """
+    e0, e1, n = energy_grid[0], energy_grid[1], int(energy_grid[2])
+    n_chunks = max(1, min(n_chunks, (n - 1)//2))
+    step = (e1 - e0)/(n - 1)
+    bounds = numpy.linspace(0, n - 1, n_chunks + 1).round().astype(int)
+    return [(int(a), int(b), [e0 + a*step, e0 + b*step, int(b - a + 1)]) for a, b in zip(bounds[:-1], bounds[1:])]
+
+def parallel_srw_undulator_spectrum(mag_field, electron_beam, energy_grid, sampling_mesh, precision, n_workers):
+    """
+    Calculates srw_undulator_spectrum with the energy grid split over n_workers processes.\n
+    :return: spectrum, maximum relative difference between chunks at their shared points
+    """
+    chunks = split_energy_grid(energy_grid, n_workers)
+    if len(chunks) == 1:
+        return srw_undulator_spectrum(mag_field, electron_beam, energy_grid, sampling_mesh, precision), 0.0
+
+    spectrum = numpy.zeros(int(energy_grid[2]))
+    mismatch = 0.0
+    with ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        futures = [executor.submit(srw_undulator_spectrum, mag_field, electron_beam, grid, sampling_mesh, precision)
+                   for a, b, grid in chunks]
+        for (a, b, grid), future in zip(chunks, futures):
+            chunk = future.result()
+            if a > 0:
+                reference = max(abs(spectrum[a]), abs(chunk[0]), 1e-300)
+                mismatch = max(mismatch, abs(spectrum[a] - chunk[0])/reference)
+            spectrum[a:b+1] = chunk
+    return spectrum, mismatch
+
+def uniform_bin_index(values, first_edge, last_edge, number_of_bins):
+    """
+    Bin index of values on number_of_bins equal bins, computed as numpy.histogram does
+    (last edge included in the last bin). Values outside the range get -1.
+    """
+    bin_edges = numpy.linspace(first_edge, last_edge, number_of_bins + 1)
+    inside = numpy.logical_and(values >= first_edge, values <= last_edge)
+    value = values[inside]
+
+    idx = ((value - first_edge)/(last_edge - first_edge)*number_of_bins).astype(numpy.intp)
+    idx[idx == number_of_bins] -= 1
+    idx[value < bin_edges[idx]] -= 1
+    idx[(value >= bin_edges[idx + 1]) & (idx != number_of_bins - 1)] += 1
+
+    index = numpy.full(len(values), -1, dtype=numpy.intp)
+    index[inside] = idx
+    return index
+
+def blockwise_bincount(index, weights, number_of_bins, block=65536):
+    """
+    Weighted bincount accumulated over blocks of the same size as numpy.histogram, so
+    that the sums are rounded in the same order.
+    """
+    histogram = numpy.zeros(number_of_bins)
+    for i in range(0, len(index), block):
+        histogram += numpy.bincount(index[i:i + block], weights=weights[i:i + block], minlength=number_of_bins)
+    return histogram
+
+def energy_histograms(energy, intensity, flag, number_of_bins):
+    """
+    Energy histograms of a beam from one extraction of its columns, with a single bin
+    index shared by the histogram of good rays and the histogram of all rays.\n
+    :energy: photon energy of all rays [eV] (column 11)
+    :intensity: intensity of all rays (column 23)
+    :flag: flag of all rays, > 0 for good rays (column 10)
+    :number_of_bins: number of bins between the lowest and highest energies of good rays
+    :return: energy coordinates, intensity histogram of good rays (histoI), histogram of all
+             rays (histoI0), dict with 'intensity', 'nrays', 'good_rays' and 'histoI2' (histogram
+             of squared intensities of good rays, for the variance of the transmission)
+    """
+    good = flag > 0
+    good_energy = energy[good]
+    good_intensity = intensity[good]
+    e_min, e_max = numpy.min(good_energy), numpy.max(good_energy)
+    first_edge, last_edge = (e_min - 0.5, e_max + 0.5) if e_min == e_max else (e_min, e_max)
+
+    index = uniform_bin_index(energy, first_edge, last_edge, number_of_bins)
+    in_range = numpy.logical_and(energy >= e_min, energy <= e_max)
+
+    histoI = blockwise_bincount(index[good], good_intensity, number_of_bins)
+    histoI0 = numpy.bincount(index[in_range], minlength=number_of_bins).astype(float)
+    info = {'intensity': good_intensity.sum(), 'nrays': len(energy), 'good_rays': len(good_energy),
+            'histoI2': numpy.bincount(index[good], weights=good_intensity**2, minlength=number_of_bins)}
+
+    return numpy.linspace(e_min, e_max, number_of_bins), histoI, histoI0, info
+
+def bin_index(values, edges):
+    """
+    Bin index of values on arbitrary increasing edges (last edge included in the last bin).
+    Values outside the edges get -1.
+    """
+    number_of_bins = len(edges) - 1
+    index = numpy.searchsorted(edges, values, side='right') - 1
+    index[values == edges[-1]] = number_of_bins - 1
+    index[numpy.logical_or(index < 0, index >= number_of_bins)] = -1
+    return index
+
+def binned_histograms(energy, intensity, flag, edges):
+    """
+    Energy histograms on arbitrary bin edges.\n
+    :energy, intensity, flag: columns 11, 23 and 10 of all rays
+    :return: histogram of intensities of good rays (histoI), histogram of all rays (histoI0),
+             histogram of squared intensities of good rays (histoI2)
+    """
+    number_of_bins = len(edges) - 1
+    good = flag > 0
+    index = bin_index(energy, edges)
+    inside = index >= 0
+    good_inside = numpy.logical_and(good, inside)
+
+    histoI = numpy.bincount(index[good_inside], weights=intensity[good_inside], minlength=number_of_bins)
+    histoI0 = numpy.bincount(index[inside], minlength=number_of_bins).astype(float)
+    histoI2 = numpy.bincount(index[good_inside], weights=intensity[good_inside]**2, minlength=number_of_bins)
+    return histoI, histoI0, histoI2
+
+def transmission(histoI, histoI0, histoI2):
+    """
+    Transmission of each energy bin and its variance.\n
+    The transmission is the mean intensity of the histoI0 rays of the bin, lost rays
+    counting as 0, so its variance is the variance of that mean. Bins without rays
+    have transmission 0 and infinite variance.
+    """
+    has_rays = histoI0 > 0
+    T1 = numpy.divide(histoI, histoI0, out=numpy.zeros(len(histoI)), where=has_rays)
+    mean_square = numpy.divide(histoI2, histoI0, out=numpy.zeros(len(histoI)), where=has_rays)
+    T1_var = numpy.full(len(histoI), numpy.inf)
+    T1_var[has_rays] = numpy.maximum(mean_square[has_rays] - T1[has_rays]**2, 0.0)/histoI0[has_rays]
+    return T1, T1_var
+
+def bayesian_blocks_edges(counts, edges, p0=0.05):
+    """
+    Bayesian blocks (Scargle et al. 2013, event data) on a fine histogram.\n
+    :counts: number of events in each fine bin
+    :edges: edges of the fine bins
+    :p0: false positive rate of each change point
+    :return: edges of the blocks (a subset of edges)
+    """
+    n = len(counts)
+    ncp_prior = 4 - numpy.log(73.53*p0*(max(numpy.sum(counts), 1)**-0.478))
+    block_length = edges[-1] - edges
+
+    best = numpy.zeros(n)
+    last = numpy.zeros(n, dtype=int)
+    for r in range(n):
+        N_k = numpy.cumsum(counts[:r + 1][::-1])[::-1]
+        T_k = block_length[:r + 1] - block_length[r + 1]
+        fit = N_k*(numpy.log(numpy.where(N_k > 0, N_k, 1)) - numpy.log(T_k))
+        A = fit - ncp_prior
+        A[1:] += best[:r]
+        last[r] = numpy.argmax(A)
+        best[r] = A[last[r]]
+
+    change_points = []
+    index = n
+    while index > 0:
+        change_points.append(index)
+        index = last[index - 1]
+    change_points.append(0)
+    return edges[numpy.array(change_points[::-1])]
+
+def adaptive_energy_edges(good_energy, number_of_bins, method='equal count', p0=0.05):
+    """
+    Energy bin edges adapted to the distribution of the good rays.\n
+    :good_energy: photon energy of good rays [eV]
+    :number_of_bins: number of bins (equal count) or of fine bins / 10 (bayesian blocks)
+    :method: 'equal count' (quantiles) or 'bayesian blocks'
+    :return: edges from the lowest to the highest energy
+    """
+    e_min, e_max = numpy.min(good_energy), numpy.max(good_energy)
+    if e_min == e_max:
+        return numpy.array([e_min - 0.5, e_max + 0.5])
+
+    if method == 'equal count':
+        edges = numpy.quantile(good_energy, numpy.linspace(0, 1, number_of_bins + 1))
+    else:
+        fine_edges = numpy.linspace(e_min, e_max, min(max(10*number_of_bins, 200), 2000) + 1)
+        counts = numpy.bincount(uniform_bin_index(good_energy, e_min, e_max, len(fine_edges) - 1), minlength=len(fine_edges) - 1)
+        edges = bayesian_blocks_edges(counts, fine_edges, p0)
+
+    edges = numpy.unique(edges)
+    edges[0], edges[-1] = e_min, e_max
+    return edges
+
+def merge_to_precision(edges, histoI, histoI0, histoI2, target):
+    """
+    Merges adjacent bins until the relative error of the transmission of every bin is
+    below target (or a single bin is left). The worst bin is merged with its neighbour
+    with fewer rays; the histograms are additive, so the merged bins are exact.\n
+    :return: edges, histoI, histoI0, histoI2 of the merged bins
+    """
+    edges, histoI, histoI0, histoI2 = [numpy.array(a, dtype=float) for a in (edges, histoI, histoI0, histoI2)]
+
+    while len(histoI) > 1:
+        T1, T1_var = transmission(histoI, histoI0, histoI2)
+        relative_error = numpy.divide(numpy.sqrt(T1_var), T1, out=numpy.full(len(T1), numpy.inf), where=T1 > 0)
+        worst = numpy.argmax(relative_error)
+        if relative_error[worst] <= target:
+            break
+
+        if worst == 0:
+            other = 1
+        elif worst == len(histoI) - 1:
+            other = worst - 1
+        else:
+            other = worst - 1 if histoI0[worst - 1] <= histoI0[worst + 1] else worst + 1
+        i = min(worst, other)
+
+        for histogram in (histoI, histoI0, histoI2):
+            histogram[i] += histogram[i + 1]
+        histoI, histoI0, histoI2 = [numpy.delete(a, i + 1) for a in (histoI, histoI0, histoI2)]
+        edges = numpy.delete(edges, i + 1)
+
+    return edges, histoI, histoI0, histoI2
+
+def integration_weights(x):
+    """
+    Trapezoidal weights w such that numpy.dot(w, y) approximates simpson(y, x=x), used to
+    propagate the variances of the spectrum to the integrated flux and power.
+    """
+    x = numpy.asarray(x, dtype=float)
+    if len(x) < 2:
+        return numpy.ones(len(x))
+    weights = numpy.zeros(len(x))
+    weights[1:] += 0.5*numpy.diff(x)
+    weights[:-1] += 0.5*numpy.diff(x)
+    return weights
+
+def ray_flux_weights(energy, intensity, edges, flux_per_bin):
+    """
+    Distributes the flux of each energy bin over the rays of that bin, in proportion to
+    their intensity.\n
+    :energy: photon energy of good rays [eV]
+    :intensity: intensity of good rays
+    :edges: energy bin edges [eV]
+    :flux_per_bin: flux in each energy bin [ph/s]
+    :return: flux carried by each ray [ph/s] (0 for rays outside the energy range)
+    """
+    number_of_bins = len(flux_per_bin)
+    index = bin_index(energy, edges)
+    inside = index >= 0
+
+    histogram = numpy.bincount(index[inside], weights=intensity[inside], minlength=number_of_bins)
+    flux_per_intensity = numpy.divide(flux_per_bin, histogram, out=numpy.zeros(number_of_bins), where=histogram > 0)
+
+    weights = numpy.zeros(len(energy))
+    weights[inside] = intensity[inside]*flux_per_intensity[index[inside]]
+    return weights
+
+def density_map(h, v, weights, h_range, v_range, nbins_h, nbins_v, pixel_area):
+    """
+    Weighted 2D histogram divided by the pixel area.\n
+    :h, v: ray coordinates
+    :weights: quantity carried by each ray (e.g. ph/s or W)
+    :h_range, v_range: [min, max] of the grid
+    :nbins_h, nbins_v: number of pixels
+    :pixel_area: pixel area in the density units (e.g. mm^2)
+    :return: density (nbins_h, nbins_v), pixel centers in h, pixel centers in v
+    """
+    index_h = uniform_bin_index(h, h_range[0], h_range[1], nbins_h)
+    index_v = uniform_bin_index(v, v_range[0], v_range[1], nbins_v)
+    inside = numpy.logical_and(index_h >= 0, index_v >= 0)
+
+    histogram = numpy.bincount(index_h[inside]*nbins_v + index_v[inside], weights=weights[inside],
+                               minlength=nbins_h*nbins_v).reshape(nbins_h, nbins_v)
+    h_edges = numpy.linspace(h_range[0], h_range[1], nbins_h + 1)
+    v_edges = numpy.linspace(v_range[0], v_range[1], nbins_v + 1)
+    return histogram/pixel_area, 0.5*(h_edges[1:] + h_edges[:-1]), 0.5*(v_edges[1:] + v_edges[:-1])
+
+def map_statistics(density, h_centers, v_centers, pixel_area):
+    """
+    Peak value and position and integral of a density map.
+    """
+    i, j = numpy.unravel_index(numpy.argmax(density), density.shape)
+    return {'peak': density[i, j], 'peak_h': h_centers[i], 'peak_v': v_centers[j],
+            'integrated': numpy.sum(density)*pixel_area}
+
+def harmonic_srw_spectra(mag_field, electron_beam, energy_grid, sampling_mesh, precision, harmonics, n_workers=1):
+    """
+    Calculates the undulator spectrum of each harmonic separately (same arguments as
+    srw_undulator_spectrum, precision[0] is ignored), one harmonic per worker process.\n
+    :harmonics: list of harmonic numbers
+    :return: dict {harmonic: spectrum}
+    """
+    def arguments(h):
+        return mag_field, electron_beam, energy_grid, sampling_mesh, [h, precision[1], precision[2]], h
+
+    if n_workers <= 1 or len(harmonics) <= 1:
+        return {h: srw_undulator_spectrum(*arguments(h)) for h in harmonics}
+
+    with ProcessPoolExecutor(max_workers=min(n_workers, len(harmonics)), mp_context=multiprocessing.get_context('spawn')) as executor:
+        futures = {h: executor.submit(srw_undulator_spectrum, *arguments(h)) for h in harmonics}
+        return {h: future.result() for h, future in futures.items()}
+
+def cached_harmonic_spectra(mag_field, electron_beam, energy_grid, sampling_mesh, precision, cache=None, n_workers=1):
+    """
+    Undulator spectrum of each harmonic 1..precision[0], with each harmonic cached separately so
+    that only the harmonics missing from the cache are calculated (harmonic_srw_spectra).\n
+    :cache: SpectrumCache, or None to calculate all harmonics
+    :return: array (precision[0], energy points), harmonics taken from the cache, harmonics calculated
+    """
+    harmonics = list(range(1, int(precision[0]) + 1))
+    # -1 tags the single-harmonic spectra, apart from the full spectra of the same undulator
+    keys = {h: SpectrumCache.make_key(list(mag_field), list(electron_beam), list(sampling_mesh),
+                                      [-1, h, precision[1], precision[2]]) for h in harmonics}
+
+    spectra = {}
+    if cache is not None:
+        for h in harmonics:
+            spectrum = cache.get(keys[h], energy_grid)
+            if spectrum is not None:
+                spectra[h] = spectrum
+
+    cached = [h for h in harmonics if h in spectra]
+    missing = [h for h in harmonics if h not in spectra]
+    if len(missing) > 0:
+        for h, spectrum in harmonic_srw_spectra(mag_field, electron_beam, energy_grid, sampling_mesh, precision,
+                                                missing, n_workers).items():
+            spectra[h] = spectrum
+            if cache is not None:
+                cache.put(keys[h], energy_grid, spectrum)
+
+    return numpy.array([spectra[h] for h in harmonics]), cached, missing
+
+class SpectrumCache():
+    """
+    Cache of source spectra, in memory (least recently used entries) and on disk
+    (npz files in the cache folder, oldest files removed above max_disk_mb). Files are
+    written atomically (save_npz), since the cache is shared by worker processes.\n
+    Spectra are keyed by the physical parameters of the calculation and stored with
+    their energy grid [initial energy, final energy, number of points]. A request is
+    served by a cached spectrum of the same parameters whose grid covers it: directly
+    when the requested energies are cached points, by linear interpolation when the
+    cached grid is at least as fine.
+    """
+    def __init__(self, name='spectrum', max_memory_entries=32, max_disk_mb=500.0, directory=None):
+        self.name = name
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_mb = max_disk_mb
+        self.directory = CACHE_DIRECTORY if directory is None else directory
+        self.memory = OrderedDict()
+
+    @staticmethod
+    def make_key(*parameters):
+        """
+        Hash of the parameters that define a spectrum (the energy grid excluded).
+        """
+        values = [numpy.asarray(parameter, dtype=float).tolist() for parameter in parameters]
+        return hashlib.sha1(repr(values).encode()).hexdigest()[:20]
+
+    @staticmethod
+    def serve(energy_grid, spectrum, requested_grid):
+        """
+        Returns the spectrum on requested_grid from a spectrum calculated on energy_grid,
+        or None if it cannot be obtained without a new calculation.
+        """
+        e0, e1, n = energy_grid[0], energy_grid[1], int(energy_grid[2])
+        r0, r1, m = requested_grid[0], requested_grid[1], int(requested_grid[2])
+        step = (e1 - e0)/(n - 1) if n > 1 else 0.0
+        tol = 1e-9*max(abs(e0), abs(e1), 1.0)
+
+        if (r0 < e0 - tol) or (r1 > e1 + tol):
+            return None
+        if n == 1:
+            return numpy.array(spectrum) if (m == 1 and abs(r0 - e0) <= tol) else None
+
+        energies = numpy.linspace(r0, r1, m)
+        index = (energies - e0)/step
+        if numpy.all(numpy.abs(index - numpy.round(index)) < 1e-6):
+            return numpy.array(spectrum[numpy.clip(numpy.round(index).astype(int), 0, n - 1)])
+
+        requested_step = (r1 - r0)/(m - 1) if m > 1 else numpy.inf
+        if requested_step >= step*(1 - 1e-9):
+            return numpy.interp(energies, numpy.linspace(e0, e1, n), spectrum)
+        return None
+
+    def filename(self, key, energy_grid):
+        grid_key = self.make_key(float(energy_grid[0]), float(energy_grid[1]), int(energy_grid[2]))[:8]
+        return os.path.join(self.directory, '{0}_{1}_{2}.npz'.format(self.name, key, grid_key))
+
+    def get(self, key, energy_grid):
+        """
+        Returns the cached spectrum for key on energy_grid, or None.
+        """
+        for (key_i, grid_i), spectrum_i in reversed(self.memory.items()):
+            if key_i == key:
+                spectrum = self.serve(grid_i, spectrum_i, energy_grid)
+                if spectrum is not None:
+                    self.memory.move_to_end((key_i, grid_i))
+                    return spectrum
+
+        for filename in glob.glob(os.path.join(self.directory, '{0}_{1}_*.npz'.format(self.name, key))):
+            try:
+                with numpy.load(filename) as data:
+                    grid_i, spectrum_i = tuple(data['energy_grid']), data['spectrum']
+            except (OSError, KeyError, ValueError, zipfile.BadZipFile): # damaged files are replaced by put
+                continue
+            spectrum = self.serve(grid_i, spectrum_i, energy_grid)
+            if spectrum is not None:
+                self.remember(key, grid_i, spectrum_i)
+                try:
+                    os.utime(filename) # marks the file as recently used
+                except OSError:
+                    pass
+                return spectrum
+        return None
+
+    def remember(self, key, energy_grid, spectrum):
+        self.memory[(key, tuple(energy_grid))] = spectrum
+        self.memory.move_to_end((key, tuple(energy_grid)))
+        while len(self.memory) > self.max_memory_entries:
+            self.memory.popitem(last=False)
+
+    def put(self, key, energy_grid, spectrum):
+        """
+        Stores a spectrum in memory and on disk.
+        """
+        energy_grid = (float(energy_grid[0]), float(energy_grid[1]), int(energy_grid[2]))
+        spectrum = numpy.array(spectrum)
+        self.remember(key, energy_grid, spectrum)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            save_npz(self.filename(key, energy_grid), energy_grid=numpy.array(energy_grid), spectrum=spectrum)
+            self.evict()
+        except OSError:
+            pass # disk cache not available: memory only
+
+    def evict(self):
+        """
+        Removes the least recently used files until the disk cache fits in max_disk_mb.
+        """
+        files = glob.glob(os.path.join(self.directory, self.name + '_*.npz'))
+        files = sorted(files, key=os.path.getmtime, reverse=True)
+        total = 0
+        for filename in files:
+            total += os.path.getsize(filename)
+            if total > self.max_disk_mb*1e6:
+                os.remove(filename)
+
+    def clear(self):
+        """
+        Empties the memory and disk caches.
+        """
+        self.memory.clear()
+        for filename in glob.glob(os.path.join(self.directory, self.name + '_*.npz')):
+            os.remove(filename)
+
+class StageGraph():
+    """
+    Results of calculation stages cached on their inputs: a stage is recomputed only when its own
+    inputs or one of the stages it depends on changed since it was last evaluated.
+    """
+
+    def __init__(self):
+        self.tokens = {}
+        self.versions = {}
+        self.results = {}
+        self.recomputed = []
+
+    @staticmethod
+    def make_key(inputs):
+        """
+        Hash of the stage inputs (numbers, strings and lists or dicts of them).
+        """
+        return hashlib.sha1(repr(inputs).encode()).hexdigest()[:20]
+
+    def evaluate(self, name, function, inputs=(), depends=()):
+        """
+        Returns the result of function(), called only if the stage is out of date.\n
+        :name: stage name
+        :function: calculation of the stage, without arguments
+        :inputs: values the stage depends on
+        :depends: names of the stages whose results the stage uses
+        """
+        token = (self.make_key(inputs), tuple(self.versions.get(stage, 0) for stage in depends))
+        if name in self.tokens and self.tokens[name] == token:
+            return self.results[name]
+
+        self.tokens.pop(name, None)
+        self.results[name] = function()
+        self.tokens[name] = token
+        self.versions[name] = self.versions.get(name, 0) + 1
+        self.recomputed.append(name)
+        return self.results[name]
+
+    def invalidate(self, name=None):
+        """
+        Forces the recalculation of one stage (and of the stages that depend on it), or of all stages.
+        """
+        if name is None:
+            self.tokens.clear()
+        else:
+            self.tokens.pop(name, None)
+
+
+class EnergyHistogramAccumulator():
+    """
+    Running energy histograms of a sequence of beams, used instead of merging the beams.\n
+    Keeps the intensity-weighted histogram of good rays (histoI), the histogram of all rays
+    (histoI0) and the ray counts, so memory does not grow with the number of beams.
+    The grid is either fixed (energy_range) or defined by the good rays of the first beam,
+    as numpy.histogram would, and extended by bins of the same width to cover the good rays
+    of the following beams. Bins are half-open [a, b), except the bin below the final edge
+    of the initial grid, which includes it as in numpy.histogram.
+    Rays outside the grid (e.g. lost rays of a white beam) are counted per bin of the same
+    width in a sparse table and moved into histoI0 when the grid is extended over them, so
+    histoI0 is the same as if the grid had covered them from the first beam.
+    """
+    def __init__(self, number_of_bins, energy_range=None, max_bins=100000):
+        self.number_of_bins = int(number_of_bins)
+        self.max_bins = max_bins
+        self.fixed = energy_range is not None
+        self.edges = None if energy_range is None else numpy.linspace(energy_range[0], energy_range[1], self.number_of_bins + 1)
+        self.closed_edge = None if energy_range is None else self.edges[-1]
+        self.histoI = numpy.zeros(self.number_of_bins)
+        self.histoI0 = numpy.zeros(self.number_of_bins)
+        self.histoI2 = numpy.zeros(self.number_of_bins)
+        self.n_beams = 0
+        self.nrays = 0
+        self.good_rays = 0
+        self.intensity = 0.0
+        self.good_min = numpy.inf
+        self.good_max = -numpy.inf
+        # all-ray counts outside the grid: bin k is [origin + k*width, origin + (k+1)*width),
+        # origin being edges[offset]
+        self.outside_bins = numpy.zeros(0, dtype=numpy.int64)
+        self.outside_counts = numpy.zeros(0)
+        self.offset = 0
+
+    def bin_index(self, energy):
+        """
+        Returns the bin of each energy and a mask of the energies inside the grid.
+        """
+        n = len(self.edges) - 1
+        index = numpy.searchsorted(self.edges, energy, side='right') - 1
+        index[energy == self.closed_edge] = numpy.searchsorted(self.edges, self.closed_edge) - 1
+        inside = numpy.logical_and(index >= 0, index < n)
+        return index, inside
+
+    def extend(self, e_min, e_max):
+        width = self.edges[1] - self.edges[0]
+        n_left = int(numpy.ceil((self.edges[0] - e_min)/width)) if e_min < self.edges[0] else 0
+        n_right = int(numpy.ceil((e_max - self.edges[-1])/width)) if e_max > self.edges[-1] else 0
+        if n_left + n_right == 0:
+            return
+        if len(self.edges) - 1 + n_left + n_right > self.max_bins:
+            raise Exception("Energy range of the accumulated beams is too wide: set a fixed energy range")
+
+        self.edges = numpy.concatenate((self.edges[0] - width*numpy.arange(n_left, 0, -1),
+                                        self.edges,
+                                        self.edges[-1] + width*numpy.arange(1, n_right + 1)))
+        self.histoI = numpy.pad(self.histoI, (n_left, n_right))
+        self.histoI0 = numpy.pad(self.histoI0, (n_left, n_right))
+        self.histoI2 = numpy.pad(self.histoI2, (n_left, n_right))
+        self.offset += n_left
+
+        # rays of previous beams now inside the grid
+        position = self.outside_bins + self.offset
+        covered = numpy.logical_and(position >= 0, position < len(self.histoI0))
+        if numpy.any(covered):
+            numpy.add.at(self.histoI0, position[covered], self.outside_counts[covered])
+            self.outside_bins = self.outside_bins[~covered]
+            self.outside_counts = self.outside_counts[~covered]
+
+    def add_outside(self, energy):
+        """
+        Counts rays outside the grid in the sparse table.
+        """
+        if len(energy) == 0:
+            return
+        width = self.edges[1] - self.edges[0]
+        bins = numpy.floor((energy - self.edges[self.offset])/width).astype(numpy.int64)
+        bins, counts = numpy.unique(bins, return_counts=True)
+        all_bins = numpy.concatenate((self.outside_bins, bins))
+        all_counts = numpy.concatenate((self.outside_counts, counts))
+        self.outside_bins, inverse = numpy.unique(all_bins, return_inverse=True)
+        self.outside_counts = numpy.bincount(inverse, weights=all_counts)
+
+    def add_rays(self, energy, intensity, flag):
+        """
+        Adds the rays of one beam.\n
+        :energy: photon energy of all rays [eV] (column 11)
+        :intensity: intensity of all rays (column 23)
+        :flag: flag of all rays, > 0 for good rays (column 10)
+        """
+        good = flag > 0
+        if numpy.any(good):
+            self.good_min = min(self.good_min, numpy.min(energy[good]))
+            self.good_max = max(self.good_max, numpy.max(energy[good]))
+
+        if self.edges is None:
+            if not numpy.any(good):
+                raise Exception("No good rays to define the energy grid")
+            e_min, e_max = self.good_min, self.good_max
+            if e_min == e_max:
+                e_min, e_max = e_min - 0.5, e_max + 0.5
+            self.edges = numpy.linspace(e_min, e_max, self.number_of_bins + 1)
+            self.closed_edge = self.edges[-1]
+
+        if not self.fixed and numpy.any(good):
+            # the grid follows the good rays only: lost rays of a white beam could need millions of bins
+            self.extend(numpy.min(energy[good]), numpy.max(energy[good]))
+
+        n = len(self.edges) - 1
+        index, inside = self.bin_index(energy)
+        if not self.fixed:
+            self.add_outside(energy[~inside])
+        self.histoI0 += numpy.bincount(index[inside], minlength=n)
+        self.histoI += numpy.bincount(index[inside & good], weights=intensity[inside & good], minlength=n)
+        self.histoI2 += numpy.bincount(index[inside & good], weights=intensity[inside & good]**2, minlength=n)
+
+        self.n_beams += 1
+        self.nrays += len(energy)
+        self.good_rays += int(numpy.count_nonzero(good))
+        self.intensity += float(numpy.sum(intensity[good]))
+
+    def add_beam(self, beam):
+        """
+        Adds the rays of a Shadow.Beam.
+        """
+        self.add_rays(beam.getshonecol(11, nolost=0), beam.getshonecol(23, nolost=0), beam.getshonecol(10, nolost=0))
+
+    def result(self):
+        """
+        Returns the energy coordinates and the histograms of good rays, all rays and squared
+        intensities of good rays, cropped to the bins between the lowest and highest energies
+        of the good rays.
+        """
+        if self.good_rays == 0:
+            raise Exception("No good rays accumulated")
+        index, _ = self.bin_index(numpy.clip(numpy.array([self.good_min, self.good_max]), self.edges[0], self.edges[-1]))
+        lo, hi = index
+        return (numpy.linspace(self.edges[lo], self.edges[hi + 1], hi - lo + 1),
+                self.histoI[lo:hi + 1].copy(), self.histoI0[lo:hi + 1].copy(), self.histoI2[lo:hi + 1].copy())
+
+
+#########################################################################
+################ HEADLESS FLUX AND POWER CALCULATION ####################
+#########################################################################
+
+def beam_columns(beam):
+    """
+    Returns the columns used by the flux calculation (energy, intensity, flag) of all rays
+    of a Shadow.Beam, or beam itself if it already is such a tuple.
+    """
+    if isinstance(beam, (tuple, list)):
+        return tuple(numpy.asarray(column) for column in beam)
+    return beam.getshonecol(11, nolost=0), beam.getshonecol(23, nolost=0), beam.getshonecol(10, nolost=0)
+
+def source_current(source):
+    return source['electron_beam'][6] if source['type'] == 'undulator' else source['I']
+
+def source_spectrum(source, energies, cache=None):
+    """
+    Source spectrum [ph/s/0.1%bw] at the given energies.\n
+    :source: dict with 'type' and the arguments of the spectrum function:
+             'bending magnet': E, I, B, hor_acc_mrad
+             'wiggler': E, I, B, N_periods, hor_acc_mrad
+             'undulator': mag_field, electron_beam, sampling_mesh, precision (as srw_undulator_spectrum)
+    :energies: photon energies [eV]; for undulators they must be equally spaced
+    :cache: SpectrumCache used for undulator spectra
+    """
+    energies = numpy.asarray(energies, dtype=float)
+    if source['type'] == 'bending magnet':
+        return BM_spectrum(source['E'], source['I'], source['B'], energies, source.get('hor_acc_mrad', 1.0))
+    if source['type'] == 'wiggler':
+        return Wiggler_spectrum(source['E'], source['I'], source['B'], source['N_periods'], energies, source.get('hor_acc_mrad', 1.0))
+    if source['type'] == 'undulator':
+        energy_grid = [energies[0], energies[-1], len(energies)]
+        parameters = [source['mag_field'], source['electron_beam'], source['sampling_mesh'], source['precision']]
+        key = SpectrumCache.make_key(*[list(p) for p in parameters])
+        spectrum = None if cache is None else cache.get(key, energy_grid)
+        if spectrum is None:
+            spectrum = srw_undulator_spectrum(parameters[0], parameters[1], energy_grid, parameters[2], parameters[3])
+            if cache is not None:
+                cache.put(key, energy_grid, spectrum)
+        return spectrum
+    raise ValueError('Unknown source type: ' + str(source['type']))
+
+def flux_from_histograms(En_coord, histoI, histoI0, histoI2, source_spec, vert_acc=None, current=0.1, En_edges=None):
+    """
+    Beamline spectrum and integrated flux and power from the energy histograms and the
+    source spectrum, normalised to 100 mA.\n
+    :En_edges: edges of adapted bins, integrated as a sum over the bins; None for the uniform
+               grid, whose points En_coord span the energy range (Simpson's rule)
+    :return: dict with T1, T1_err, Flux_sample [ph/s/eV], beamline_flux, beamline_flux_err
+             [ph/s/0.1%bw], flux, flux_err [ph/s/100mA], power, power_err [W/100mA]
+    """
+    if vert_acc is None:
+        vert_acc = numpy.ones(len(En_coord))
+
+    T1, T1_var = transmission(histoI, histoI0, histoI2)
+    T1_err = numpy.sqrt(T1_var)
+    Flux_eV = source_spec*(1000.0/En_coord)
+    Flux_sample = Flux_eV*T1*vert_acc
+    Flux_sample_err = Flux_eV*T1_err*vert_acc
+    Power_sample = Flux_sample*En_coord*1.60217662e-19
+
+    # statistical errors of the integrals (bins are independent)
+    if En_edges is None:
+        weights = integration_weights(En_coord)
+        flux, power = simpson(Flux_sample, x=En_coord), simpson(Power_sample, x=En_coord)
+    else: # Simpson's rule on the centres of non-uniform bins would leave out half of the edge bins
+        weights = numpy.diff(En_edges)
+        flux, power = numpy.sum(Flux_sample*weights), numpy.sum(Power_sample*weights)
+    finite = numpy.isfinite(Flux_sample_err)
+
+    return {'T1': T1, 'T1_err': T1_err, 'Flux_sample': Flux_sample,
+            'beamline_flux': source_spec*T1*vert_acc, 'beamline_flux_err': source_spec*T1_err*vert_acc,
+            'flux': flux*(0.1/current),
+            'power': power*(0.1/current),
+            'flux_err': numpy.sqrt(numpy.sum((weights*Flux_sample_err)[finite]**2))*(0.1/current),
+            'power_err': numpy.sqrt(numpy.sum((weights*Flux_sample_err*En_coord*1.60217662e-19)[finite]**2))*(0.1/current)}
+
+def calculate_flux(beam, source, number_of_bins=101, binning='fixed', target_precision=0.0,
+                   vertical_acceptance=None, cache=None, source_table=None):
+    """
+    Flux and power of a beam, without GUI (same calculation as the Flux widget).\n
+    :beam: Shadow.Beam or tuple (energy, intensity, flag) of all rays
+    :source: source dict, see source_spectrum
+    :number_of_bins: number of energy bins
+    :binning: 'fixed', 'equal count' or 'bayesian blocks'
+    :target_precision: relative error of the transmission per bin (0 = no merging)
+    :vertical_acceptance: None or dict with 'div_limits' [rad] and 'e_beam_vert_div' [rad]
+                          (bending magnets and wigglers)
+    :cache: SpectrumCache for undulator spectra
+    :source_table: (energies, spectrum) precomputed source spectrum, interpolated on the bins;
+                   the spectrum is calculated instead if the bins are not inside the table
+    :return: dict with En_coord, En_edges, histoI, histoI0, source_spec, vert_acc, nrays,
+             good_rays, intensity and the results of flux_from_histograms (zero flux and power,
+             empty arrays, if there are no good rays)
+    """
+    energy, intensity, flag = beam_columns(beam)
+    if not numpy.any(flag > 0):
+        empty = numpy.zeros(0)
+        result = {key: empty for key in ['T1', 'T1_err', 'Flux_sample', 'beamline_flux', 'beamline_flux_err',
+                                         'En_coord', 'En_edges', 'histoI', 'histoI0', 'source_spec', 'vert_acc']}
+        result.update({'flux': 0.0, 'flux_err': 0.0, 'power': 0.0, 'power_err': 0.0,
+                       'nrays': len(energy), 'good_rays': 0, 'intensity': 0.0})
+        return result
+    En_coord, histoI, histoI0, info = energy_histograms(energy, intensity, flag, number_of_bins)
+    histoI2 = info['histoI2']
+    En_edges = numpy.linspace(En_coord[0], En_coord[-1], len(En_coord) + 1)
+
+    adapted_bins = False
+    if binning != 'fixed':
+        En_edges = adaptive_energy_edges(energy[flag > 0], number_of_bins, binning)
+        histoI, histoI0, histoI2 = binned_histograms(energy, intensity, flag, En_edges)
+        adapted_bins = True
+    if target_precision > 0:
+        En_edges, histoI, histoI0, histoI2 = merge_to_precision(En_edges, histoI, histoI0, histoI2, target_precision)
+        adapted_bins = True
+    if adapted_bins:
+        En_coord = 0.5*(En_edges[1:] + En_edges[:-1])
+
+    # outside the table numpy.interp would repeat its edge values (e.g. crystal harmonics of a white beam)
+    tolerance = 1e-9*max(abs(En_coord[-1]), 1.0)
+    in_table = source_table is not None and En_coord[0] >= source_table[0][0] - tolerance \
+               and En_coord[-1] <= source_table[0][-1] + tolerance
+    if in_table:
+        source_spec = numpy.interp(En_coord, source_table[0], source_table[1])
+    elif source['type'] == 'undulator' and adapted_bins:
+        srw_energies = numpy.linspace(En_coord[0], En_coord[-1], max(number_of_bins, len(En_coord)))
+        source_spec = numpy.interp(En_coord, srw_energies, source_spectrum(source, srw_energies, cache))
+    else:
+        source_spec = source_spectrum(source, En_coord, cache)
+
+    vert_acc = None
+    if vertical_acceptance is not None and source['type'] != 'undulator':
+        vert_acc = BM_vertical_acc(source['E'], source['B'], En_coord, vertical_acceptance['div_limits'],
+                                   vertical_acceptance.get('e_beam_vert_div', 0.0))['acceptance']
+
+    result = flux_from_histograms(En_coord, histoI, histoI0, histoI2, source_spec, vert_acc, source_current(source),
+                                  En_edges if adapted_bins else None)
+    result.update({'En_coord': En_coord, 'En_edges': En_edges, 'histoI': histoI, 'histoI0': histoI0,
+                   'source_spec': source_spec, 'vert_acc': numpy.ones(len(En_coord)) if vert_acc is None else vert_acc,
+                   'nrays': info['nrays'], 'good_rays': info['good_rays'], 'intensity': info['intensity']})
+    return result
+
+def batch_flux(beams, source, n_workers=1, cache=None, **options):
+    """
+    Flux and power of many beams (e.g. beamline variants) with the same source, in parallel.\n
+    Undulator spectra are calculated once, in this process, on a grid covering the good-ray
+    energies of all beams with the finest bin step among them (through the shared cache,
+    so repeated batches do not call SRW again), and interpolated on the bins of each beam.
+    Bending magnet and wiggler spectra are calculated by the workers.\n
+    :beams: list of Shadow.Beam or (energy, intensity, flag) tuples
+    :source: source dict, see source_spectrum
+    :n_workers: number of worker processes
+    :cache: SpectrumCache shared by the batches (a default one is used if None)
+    :options: keyword arguments of calculate_flux
+    :return: list of calculate_flux results, in the order of beams
+    """
+    if cache is None:
+        cache = SpectrumCache(name='srw_spectrum')
+    columns = [beam_columns(beam) for beam in beams]
+
+    source_table = None
+    # beams without good rays get a zero result from calculate_flux
+    ranges = [(numpy.min(e[f > 0]), numpy.max(e[f > 0])) for e, i, f in columns if numpy.any(f > 0)]
+    if source['type'] == 'undulator' and len(ranges) > 0:
+        number_of_bins = options.get('number_of_bins', 101)
+        e_min, e_max = min(r[0] for r in ranges), max(r[1] for r in ranges)
+        step = min((r[1] - r[0])/max(number_of_bins - 1, 1) for r in ranges if r[1] > r[0]) if any(r[1] > r[0] for r in ranges) else 1.0
+        n_points = int(min(numpy.ceil((e_max - e_min)/step) + 1, 20000)) if e_max > e_min else 2
+        energies = numpy.linspace(e_min, e_max if e_max > e_min else e_min + 1.0, n_points)
+        source_table = (energies, source_spectrum(source, energies, cache))
+
+    if n_workers <= 1 or len(columns) <= 1:
+        return [calculate_flux(c, source, source_table=source_table, **options) for c in columns]
+
+    with ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        futures = [executor.submit(calculate_flux, c, source, source_table=source_table, **options) for c in columns]
+        return [future.result() for future in futures]
+
+
+#########################################################################
+######################## MONOCHROMATOR ENERGY SCAN ######################
+#########################################################################
+
+def energy_scan_settings(energy, source_index=None, bandwidth=0.0, crystal_indices=()):
+    """
+    SHADOW variables changed at one point of an energy scan.\n
+    :energy: photon energy [eV]
+    :source_index: history index of the source whose energy follows the scan, or None. The source
+                   emits a box PH1-PH2 of width bandwidth around energy (a single line if bandwidth = 0)
+    :bandwidth: width of the source energy window [eV]
+    :crystal_indices: history indices of crystals autotuned to energy (PHOT_CENT in eV)
+    :return: settings list of history_util.trace_history
+    """
+    settings = []
+    if source_index is not None:
+        settings += [(source_index, 'F_PHOT', 0), (source_index, 'F_COLOR', 3 if bandwidth > 0 else 1),
+                     (source_index, 'PH1', energy - bandwidth/2.0), (source_index, 'PH2', energy + bandwidth/2.0)]
+    for index in crystal_indices:
+        settings += [(index, 'F_CENTRAL', 1), (index, 'F_PHOT_CENT', 0), (index, 'PHOT_CENT', energy)]
+    return settings
+
+def energy_scan_point(descriptors, input_rays, start, settings, source, source_table, flux_kwargs):
+    """
+    Worker for energy scans: re-traces the beamline with the scan settings and calculates flux and power.\n
+    :descriptors, input_rays, start, settings: see history_util.trace_history
+    :source, source_table, flux_kwargs: see calculate_flux
+    :return: dict with flux, flux_err, power, power_err and the ray statistics nrays, good_rays,
+             intensity, mean_energy, rms_energy (good rays weighted by intensity) and nbins
+    """
+    from orangecontrib.shadow.lnls.util import history_util
+
+    beam = history_util.trace_history(descriptors, input_rays=input_rays, start=start, settings=settings)
+    result = calculate_flux(beam, source, source_table=source_table, **flux_kwargs)
+
+    total = numpy.sum(result['histoI'])
+    mean_energy = numpy.sum(result['En_coord']*result['histoI'])/total if total > 0 else numpy.nan
+    rms_energy = numpy.sqrt(numpy.sum((result['En_coord'] - mean_energy)**2*result['histoI'])/total) if total > 0 else numpy.nan
+
+    stats = {key: result[key] for key in ['flux', 'flux_err', 'power', 'power_err', 'nrays', 'good_rays', 'intensity']}
+    stats.update({'mean_energy': mean_energy, 'rms_energy': rms_energy, 'nbins': len(result['En_coord'])})
+    return stats
+
+def energy_scan(input_beam, energies, source, source_index=None, bandwidth=0.0, crystal_indices=(), n_workers=1,
+                cache=None, spectrum_points=2001, progress=None, **options):
+    """
+    Flux and power vs. monochromator energy: the beamline that produced input_beam is re-traced in worker
+    processes (in this process if n_workers <= 1) for each energy, with the source energy window and/or the crystals following the scan.
+    The source spectrum is calculated once (through cache) on a grid covering the scan and interpolated
+    on the bins of each point; points with bins outside the grid (e.g. crystal harmonics) calculate their own
+    spectrum and points without good rays give zero flux.\n
+    :input_beam: ShadowBeam with OE history
+    :energies: scan energies [eV]
+    :source: source dict, see source_spectrum
+    :source_index, bandwidth, crystal_indices: see energy_scan_settings
+    :n_workers: number of worker processes, the points are traced serially in this process if n_workers <= 1
+    :cache: SpectrumCache for undulator spectra
+    :spectrum_points: number of points of the source spectrum grid
+    :progress: function called as progress(k, n_done) when point k is finished
+    :options: keyword arguments of calculate_flux
+    :return: dict of arrays: energy and the keys returned by energy_scan_point
+    """
+    from orangecontrib.shadow.lnls.util import history_util
+
+    energies = numpy.asarray(energies, dtype=float)
+    driven = ([] if source_index is None else [source_index]) + list(crystal_indices)
+    if len(driven) == 0:
+        raise ValueError('The energy scan must drive the source or at least one crystal')
+
+    step = numpy.min(numpy.diff(numpy.sort(energies))) if len(energies) > 1 else 0.0
+    margin = max(bandwidth/2.0, step, 1e-3*numpy.max(energies))
+    table_energies = numpy.linspace(max(numpy.min(energies) - margin, 1.0), numpy.max(energies) + margin, spectrum_points)
+    source_table = (table_energies, source_spectrum(source, table_energies, cache))
+
+    elements = history_util.flatten_oe_history(input_beam)
+    results = [None]*len(energies)
+
+    with tempfile.TemporaryDirectory() as start_files_dir:
+        descriptors = history_util.write_history_files(elements, start_files_dir)
+        start = min(history_util.first_element_of(descriptors, index) for index in driven)
+        input_rays = elements[start]['input_rays']
+        if descriptors[start]['kind'] != 'source' and input_rays is None: # trace from the source
+            start = 0
+
+        def arguments(energy):
+            return (descriptors, input_rays, start, energy_scan_settings(energy, source_index, bandwidth, crystal_indices),
+                    source, source_table, options)
+
+        if n_workers <= 1 or len(energies) <= 1:
+            for k, energy in enumerate(energies):
+                results[k] = energy_scan_point(*arguments(energy))
+                if progress is not None:
+                    progress(k, k + 1)
+        else:
+            with ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+                futures = {executor.submit(energy_scan_point, *arguments(energy)): k for k, energy in enumerate(energies)}
+                for n_done, future in enumerate(as_completed(futures)):
+                    k = futures[future]
+                    results[k] = future.result()
+                    if progress is not None:
+                        progress(k, n_done + 1)
+
+    scan = {key: numpy.array([result[key] for result in results]) for key in results[0]}
+    scan['energy'] = energies
+    return scan
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Re-tracing of a ShadowOui beamline from the OE history carried by a ShadowBeam.
+
+The history is written to SHADOW start files (start.00, start.01, ...) so that it
+can be rebuilt in worker processes, where the ShadowOui objects are not available.
+Only SHADOW sources, optical elements and ideal lenses are reproduced: widgets that
+modify the beam outside of SHADOW (e.g. HYBRID) are not part of the re-traced beamline.
+"""
+
+import os
+import re
+
+import numpy as np
+import Shadow
+
+
+def flatten_oe_history(input_beam):
+    """
+    Lists the SHADOW objects of the beamline that produced input_beam.\n
+    :input_beam: ShadowBeam with OE history
+    :return: list of dicts with keys 'history_index', 'name', 'kind' ('source', 'oe' or 'ideal_lens'),
+             'object' (Shadow.Source, Shadow.OE or Shadow.IdealLensOE) and 'input_rays' (rays entering
+             the history element, or None if they are not available). Compound elements are expanded
+             into one entry per SHADOW OE, all with the same history_index.
+    """
+    elements = []
+    for idx, history_element in enumerate(input_beam.getOEHistory()):
+        name = history_element._widget_class_name
+        input_beam_i = getattr(history_element, '_input_beam', None)
+        input_rays = None if input_beam_i is None else input_beam_i._beam.rays
+
+        if not history_element._shadow_source_start is None:
+            elements.append({'history_index':idx, 'name':name, 'kind':'source',
+                             'object':history_element._shadow_source_start.src, 'input_rays':None})
+
+        elif not history_element._shadow_oe_start is None:
+            oe = history_element._shadow_oe_start._oe
+            oe_list = oe.list if hasattr(oe, 'list') else [oe] # compound elements
+            for oe_i in oe_list:
+                kind = 'ideal_lens' if isinstance(oe_i, Shadow.IdealLensOE) else 'oe'
+                elements.append({'history_index':idx, 'name':name, 'kind':kind,
+                                 'object':oe_i, 'input_rays':input_rays})
+    return elements
+
+def write_history_files(elements, directory):
+    """
+    Writes the start files of a flattened history into directory.\n
+    :elements: list returned by flatten_oe_history
+    :directory: destination folder (must exist)
+    :return: list of picklable descriptors, one per element, used by trace_history
+    """
+    descriptors = []
+    for k, element in enumerate(elements):
+        descriptor = {'history_index':element['history_index'], 'name':element['name'], 'kind':element['kind']}
+
+        if element['kind'] == 'ideal_lens':
+            lens = element['object']
+            descriptor['lens'] = {'T_SOURCE':lens.T_SOURCE, 'T_IMAGE':lens.T_IMAGE,
+                                  'focal_x':lens.focal_x, 'focal_z':lens.focal_z}
+        else:
+            descriptor['file'] = os.path.join(directory, 'start.{0:02d}'.format(k))
+            element['object'].write(descriptor['file'])
+
+        descriptors.append(descriptor)
+    return descriptors
+
+def first_element_of(descriptors, history_index):
+    """
+    Returns the position in descriptors of the first SHADOW object of a history element.
+    """
+    for k, descriptor in enumerate(descriptors):
+        if descriptor['history_index'] == history_index:
+            return k
+    raise ValueError('Element {0} is not a SHADOW source or optical element'.format(history_index))
+
+def set_parameter(shadow_object, parameter, value):
+    """
+    Sets a SHADOW variable, e.g. 'RMIRR', or an item of an array variable, e.g. 'RX_SLIT[0]'.
+    """
+    match = re.match(r'^\s*(\w+)\s*(?:\[\s*(\d+)\s*\])?\s*$', parameter)
+    if match is None:
+        raise ValueError('Invalid parameter name: ' + parameter)
+
+    name, item = match.group(1), match.group(2)
+    if not hasattr(shadow_object, name):
+        raise ValueError('SHADOW object has no variable ' + name)
+
+    if item is None:
+        old_value = getattr(shadow_object, name)
+        setattr(shadow_object, name, type(old_value)(value) if isinstance(old_value, (int, float)) else value)
+    else:
+        array = getattr(shadow_object, name)
+        array[int(item)] = value
+        setattr(shadow_object, name, array)
+
+def trace_history(descriptors, input_rays=None, start=0, sweep_index=None, parameter=None, value=None, settings=None):
+    """
+    Re-traces the beamline described by descriptors.\n
+    :descriptors: list returned by write_history_files
+    :input_rays: rays entering descriptors[start]; ignored if it is a source
+    :start: position in descriptors where tracing starts
+    :sweep_index: history index of the element whose parameter is changed (all its SHADOW objects)
+    :parameter: SHADOW variable name, e.g. 'RMIRR' or 'RX_SLIT[0]'
+    :value: value assigned to parameter
+    :settings: list of (history index, parameter, value) changed together, e.g. energy scans
+    :return: Shadow.Beam at the end of the beamline
+    """
+    beam = Shadow.Beam()
+    if descriptors[start]['kind'] != 'source':
+        beam.rays = np.array(input_rays, copy=True)
+
+    for k in range(start, len(descriptors)):
+        descriptor = descriptors[k]
+
+        if descriptor['kind'] == 'source':
+            shadow_object = Shadow.Source()
+            shadow_object.load(descriptor['file'])
+        elif descriptor['kind'] == 'oe':
+            shadow_object = Shadow.OE()
+            shadow_object.load(descriptor['file'])
+            shadow_object.FWRITE = 3 # no files, workers run concurrently in the same folder
+        else:
+            shadow_object = Shadow.IdealLensOE()
+            for key, lens_value in descriptor['lens'].items():
+                setattr(shadow_object, key, lens_value)
+
+        if (sweep_index is not None) and (descriptor['history_index'] == sweep_index):
+            set_parameter(shadow_object, parameter, value)
+        for history_index, setting_parameter, setting_value in (settings or []):
+            if descriptor['history_index'] == history_index:
+                set_parameter(shadow_object, setting_parameter, setting_value)
+
+        if descriptor['kind'] == 'source':
+            beam.genSource(shadow_object)
+        elif descriptor['kind'] == 'oe':
+            beam.traceOE(shadow_object, k)
+        else:
+            beam.traceIdealLensOE(shadow_object, k)
+
+    return beam
@@ -1,10 +1,10 @@
-import copy
 import sys
 import time
 
 import numpy
+import h5py
 from PyQt5 import QtGui, QtWidgets
-from orangewidget import gui
+from orangewidget import gui, widget
 from orangewidget.settings import Setting
 from oasys.widgets import gui as oasysgui
 from oasys.widgets import congruence
@@ -15,6 +15,7 @@ from oasys.util.oasys_util import EmittingStream, TTYGrabber
 from orangecontrib.shadow.util.shadow_objects import ShadowBeam
 from orangecontrib.shadow.util.shadow_util import ShadowCongruence, ShadowPlot
 from orangecontrib.shadow.widgets.gui.ow_automatic_element import AutomaticElement
+from orangecontrib.shadow.lnls.util import beam_util
 
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg
 from matplotlib.figure import Figure
@@ -39,7 +40,8 @@ class PlotXY(AutomaticElement):
     category = "Display Data Tools"
     keywords = ["data", "file", "load", "read"]
 
-    inputs = [("Input Beam", ShadowBeam, "setBeam")]
+    inputs = [("Input Beam", ShadowBeam, "setBeam"),
+              ("Comparison Beams", ShadowBeam, "setComparisonBeam", widget.Multiple)]
 
     IMAGE_WIDTH = 640
     IMAGE_HEIGHT = 640
@@ -51,6 +53,8 @@ class PlotXY(AutomaticElement):
     image_plane=Setting(0)
     image_plane_new_position=Setting(10.0)
     image_plane_rel_abs_position=Setting(0)
+    retrace_cache_size=Setting(500.0)
+    memory_limit=Setting(1000.0)
 
     x_column_index=Setting(0)
     y_column_index=Setting(2)
@@ -93,6 +97,7 @@ class PlotXY(AutomaticElement):
     plottitle=Setting('Title')
     output_filename = Setting('default.png')
     output_datfilename = Setting('default_histo2D.dat')
+    export_format = Setting(0)
     integral = Setting('0.0')
     
     fwhm_int_ext = Setting(0)
@@ -101,15 +106,45 @@ class PlotXY(AutomaticElement):
     
     plot_zeroPadding = Setting(0)
     gaussian_filter = Setting(0)
+    density_estimator = Setting(0)
+    kde_factor = Setting(1.0)
     
     inten=Setting(0)
     nrays=Setting(0)
     grays=Setting(0)
     lrays=Setting(0)
     
+    roi_x_min=Setting(-1.0)
+    roi_x_max=Setting(1.0)
+    roi_y_min=Setting(-1.0)
+    roi_y_max=Setting(1.0)
+    
+    comparison_name=Setting('Beam 1')
+    comparison_beam=Setting(2)
+    comparison_map=Setting(0)
+    comparison_normalize=Setting(0)
+    
+    beam2D=None
+    input_beam_version=0
+    beam_info_version=-1
+    bin_plan=None
+    bin_plan_key=None
+    bin_plan_version=0
+    retrace_cache=None
+    histogram_key=None
+    histogram_version=0
+    sat=None
+    sat_key=None
+    comparison=None
+    comparison_links=None
+    comparison_count=0
+    
     def __init__(self):
         super().__init__()
 
+        self.comparison = beam_util.BeamComparison()
+        self.comparison_links = {}
+
         gui.button(self.controlArea, self, "Refresh", callback=self.plot_results, height=45)
         gui.separator(self.controlArea, 10)
 
@@ -119,6 +154,8 @@ class PlotXY(AutomaticElement):
         # graph tab
         tab_set = oasysgui.createTabPage(self.tabs_setting, "Plot Settings")
         tab_gen = oasysgui.createTabPage(self.tabs_setting, "Calculations Settings")
+        tab_roi = oasysgui.createTabPage(self.tabs_setting, "ROI")
+        tab_cmp = oasysgui.createTabPage(self.tabs_setting, "Compare")
 
         screen_box = oasysgui.widgetBox(tab_set, "Screen Position Settings", addSpace=True, orientation="vertical", height=120)
 
@@ -297,11 +334,14 @@ class PlotXY(AutomaticElement):
 #        oasysgui.lineEdit(units_box, self, "integral", "Integral (e.g. Total Flux/Power)",
 #                          labelWidth=250, valueType=str, orientation="horizontal")
         
-        export_box = oasysgui.widgetBox(tab_set, "Export 2D Histogram", addSpace=True, orientation="vertical", height=90)
+        export_box = oasysgui.widgetBox(tab_set, "Export 2D Histogram", addSpace=True, orientation="vertical", height=120)
 
         oasysgui.lineEdit(export_box, self, "output_datfilename", "File name to save", controlWidth=180,
                           labelWidth=250, valueType=str, orientation="horizontal")
         
+        gui.comboBox(export_box, self, "export_format", label="File format", labelWidth=250,
+                     items=["Text", "HDF5", "NumPy (.npy)", "NumPy archive (.npz)"], sendSelectedValue=False, orientation="horizontal")
+
         gui.button(export_box, self, "Export Data", callback=self.export_histo, height=25)
 
 
@@ -310,7 +350,7 @@ class PlotXY(AutomaticElement):
 #        gui.checkBox(incremental_box, self, "keep_result", "Keep Result")
 #        gui.button(incremental_box, self, "Clear", callback=self.clearResults)
 
-        histograms_box = oasysgui.widgetBox(tab_gen, "Histograms settings", addSpace=True, orientation="vertical", height=115)
+        histograms_box = oasysgui.widgetBox(tab_gen, "Histograms settings", addSpace=True, orientation="vertical", height=175)
 
         oasysgui.lineEdit(histograms_box, self, "number_of_binsX", "Number of Bins X", labelWidth=250, valueType=int, orientation="horizontal")
         oasysgui.lineEdit(histograms_box, self, "number_of_binsY", "Number of Bins Y", labelWidth=250, valueType=int, orientation="horizontal")
@@ -318,19 +358,24 @@ class PlotXY(AutomaticElement):
         gui.comboBox(histograms_box, self, "is_conversion_active", label="Is U.M. conversion active", labelWidth=250,
                      items=["No", "Yes"], sendSelectedValue=False, orientation="horizontal")
 
+        gui.comboBox(histograms_box, self, "density_estimator", label="Density", labelWidth=150,
+                     items=["Histogram", "KDE - Scott's rule", "KDE - Silverman's rule"], sendSelectedValue=False, orientation="horizontal")
+
+        oasysgui.lineEdit(histograms_box, self, "kde_factor", "KDE bandwidth factor", labelWidth=250, valueType=float, orientation="horizontal")
+
         plot_control_box = oasysgui.widgetBox(tab_gen, "Plot Controls", addSpace=True, orientation="vertical", height=440)
         
 #        gui.checkBox(plot_control_box, self, "invertXY", "Invert X, Y")
         
         gui.comboBox(plot_control_box, self, "cut", label="Slices", labelWidth=250, callback=self.set_SlicePosition,
-                     items=["1D histograms", "Cut at 0", "Cut at peak", "Cut at mean value", "Cut at position"], 
+                     items=["1D histograms", "Cut at 0", "Cut at peak", "Cut at mean value", "Cut at position", "Integrated over ROI bands"], 
                      sendSelectedValue=False, orientation="horizontal")
         
         self.slice_box = oasysgui.widgetBox(plot_control_box, "", addSpace=False, orientation="vertical", height=50)
 #        self.slice_box_empty = oasysgui.widgetBox(plot_control_box, "", addSpace=False, orientation="vertical", height=100)
 
-        oasysgui.lineEdit(self.slice_box, self, "x_cut_pos", "X position to cut", labelWidth=220, valueType=float, orientation="horizontal")
-        oasysgui.lineEdit(self.slice_box, self, "y_cut_pos", "Y position to cut", labelWidth=220, valueType=float, orientation="horizontal")
+        oasysgui.lineEdit(self.slice_box, self, "x_cut_pos", "X position to cut", labelWidth=220, valueType=float, orientation="horizontal", callback=self.update_analysis)
+        oasysgui.lineEdit(self.slice_box, self, "y_cut_pos", "Y position to cut", labelWidth=220, valueType=float, orientation="horizontal", callback=self.update_analysis)
 
         self.set_SlicePosition()
         
@@ -344,15 +389,15 @@ class PlotXY(AutomaticElement):
                      items=["Linear", "Logarithmic"], sendSelectedValue=False, orientation="horizontal")
 
         gui.comboBox(plot_control_box, self, "textA", label="Text 1", labelWidth=250,
-                     items=["None", "Title", "Mean Values", "Peak Values", "Data Range", "Slice FWHM", "Slice RMS", "Slice Maximum", "FIT Mean", "FIT Peak", "FIT FWHM", "FIT RMS", "FIT Maximum"], 
+                     items=["None", "Title", "Mean Values", "Peak Values", "Data Range", "Slice FWHM", "Slice RMS", "Slice Maximum", "FIT Mean", "FIT Peak", "FIT FWHM", "FIT RMS", "FIT Maximum", "ROI Statistics"], 
                      sendSelectedValue=False, orientation="horizontal")
 
         gui.comboBox(plot_control_box, self, "textB", label="Text 2", labelWidth=250,
-                     items=["None", "Title", "Mean Values", "Peak Values", "Data Range", "Slice FWHM", "Slice RMS", "Slice Maximum", "FIT Mean", "FIT Peak", "FIT FWHM", "FIT RMS", "FIT Maximum"], 
+                     items=["None", "Title", "Mean Values", "Peak Values", "Data Range", "Slice FWHM", "Slice RMS", "Slice Maximum", "FIT Mean", "FIT Peak", "FIT FWHM", "FIT RMS", "FIT Maximum", "ROI Statistics"], 
                      sendSelectedValue=False, orientation="horizontal")
 
         gui.comboBox(plot_control_box, self, "textC", label="Text 3", labelWidth=250,
-                     items=["None", "Title", "Mean Values", "Peak Values", "Data Range", "Slice FWHM", "Slice RMS", "Slice Maximum", "FIT Mean", "FIT Peak", "FIT FWHM", "FIT RMS", "FIT Maximum"], 
+                     items=["None", "Title", "Mean Values", "Peak Values", "Data Range", "Slice FWHM", "Slice RMS", "Slice Maximum", "FIT Mean", "FIT Peak", "FIT FWHM", "FIT RMS", "FIT Maximum", "ROI Statistics"], 
                      sendSelectedValue=False, orientation="horizontal")
         
         oasysgui.lineEdit(plot_control_box, self, "plottitle", "Title / Description (< 40 char)", controlWidth=180,
@@ -369,7 +414,7 @@ class PlotXY(AutomaticElement):
         
         gui.button(plot_control_box, self, "Export Figure", callback=self.save_fig, height=25)
         
-        adv_box = oasysgui.widgetBox(tab_gen, "Advanced Controls", addSpace=True, orientation="vertical", height=160)
+        adv_box = oasysgui.widgetBox(tab_gen, "Advanced Controls", addSpace=True, orientation="vertical", height=220)
         
         gui.comboBox(adv_box, self, "fwhm_int_ext", label="FWHM innermost / outermost", labelWidth=250,
                      items=["Innermost", "Outermost"], sendSelectedValue=False, orientation="horizontal")
@@ -386,9 +431,38 @@ class PlotXY(AutomaticElement):
         oasysgui.lineEdit(adv_box, self, "gaussian_filter", "Smooth factor - gaussian filter (>0)",
                           labelWidth=250, valueType=float, orientation="horizontal")   
 
+        oasysgui.lineEdit(adv_box, self, "retrace_cache_size", "Retraced beams cache size [MB]",
+                          labelWidth=250, valueType=float, orientation="horizontal")
+
+        oasysgui.lineEdit(adv_box, self, "memory_limit", "Memory for reading rays [MB]",
+                          labelWidth=250, valueType=float, orientation="horizontal")
+
+        roi_box = oasysgui.widgetBox(tab_roi, "Region of Interest / Aperture", addSpace=True, orientation="vertical", height=200)
+        
+        oasysgui.lineEdit(roi_box, self, "roi_x_min", "X min", labelWidth=220, valueType=float, orientation="horizontal", callback=self.update_analysis)
+        oasysgui.lineEdit(roi_box, self, "roi_x_max", "X max", labelWidth=220, valueType=float, orientation="horizontal", callback=self.update_analysis)
+        oasysgui.lineEdit(roi_box, self, "roi_y_min", "Y min", labelWidth=220, valueType=float, orientation="horizontal", callback=self.update_analysis)
+        oasysgui.lineEdit(roi_box, self, "roi_y_max", "Y max", labelWidth=220, valueType=float, orientation="horizontal", callback=self.update_analysis)
+        gui.button(roi_box, self, "Print ROI Statistics", callback=self.print_roi_statistics, height=25)
+
+        compare_box = oasysgui.widgetBox(tab_cmp, "Beams (binned as the first beam)", addSpace=True, orientation="vertical", height=130)
+
+        oasysgui.lineEdit(compare_box, self, "comparison_name", "Name", labelWidth=150, valueType=str, orientation="horizontal")
+        gui.button(compare_box, self, "Keep Current Beam", callback=self.keep_current_beam, height=25)
+        gui.button(compare_box, self, "Clear Kept Beams", callback=self.clear_kept_beams, height=25)
+
+        compare_plot_box = oasysgui.widgetBox(tab_cmp, "Comparison", addSpace=True, orientation="vertical", height=160)
+
+        oasysgui.lineEdit(compare_plot_box, self, "comparison_beam", "Beam compared to the first (#)", labelWidth=250, valueType=int, orientation="horizontal")
+        gui.comboBox(compare_plot_box, self, "comparison_map", label="Map", labelWidth=250,
+                     items=["Difference", "Ratio"], sendSelectedValue=False, orientation="horizontal")
+        gui.checkBox(compare_plot_box, self, "comparison_normalize", "Normalize each beam to its total")
+        gui.button(compare_plot_box, self, "Compare Beams", callback=self.compare_beams, height=25)
+
         self.main_tabs = oasysgui.tabWidget(self.mainArea)
         plot_tab = oasysgui.createTabPage(self.main_tabs, "Plots")
         out_tab = oasysgui.createTabPage(self.main_tabs, "Output")
+        self.compare_tab = oasysgui.createTabPage(self.main_tabs, "Comparison")
         
         output_box = oasysgui.widgetBox(plot_tab, "", addSpace=True, orientation="horizontal",
                                         height=650, width=2.0*self.CONTROL_AREA_WIDTH)  
@@ -467,29 +541,57 @@ class PlotXY(AutomaticElement):
         self.axY  = self.figure.add_axes(rect_Y, sharey=self.ax2D)
         self.axT  = self.figure.add_axes(rect_T)
         
+        self.compare_figure = Figure()
+        self.compare_figure.patch.set_facecolor('white')
+        compare_canvas = FigureCanvasQTAgg(self.compare_figure)
+        compare_box = gui.widgetBox(self.compare_tab, "Comparison", addSpace=True, orientation="vertical")
+        compare_box.layout().addWidget(compare_canvas)
+        
 
     def save_fig(self):
         self.figure.savefig(self.output_filename, dpi=200)
 
     def export_histo(self):
-        
-        header  = '#2D histrogram\n'
-        header += '#Z units: ' + '#Rays weighted by intensity' + '\n'
-        header += '#{0:.8e}'.format(self.x_axis[0]) + '#xmin' + '\n'
-        header += '#{0:.8e}'.format(self.x_axis[-1]) + '#xmax' + '\n'
-        header += '#{0}'.format(len(self.x_axis)) + '#nx' + '\n'
-        header += '#{0:.8e}'.format(self.z_axis[0]) + '#ymin' + '\n'
-        header += '#{0:.8e}'.format(self.z_axis[-1]) + '#ymax' + '\n'
-        header += '#{0}'.format(len(self.z_axis)) + '#ny' + '\n' 
-        
-        with open(self.output_datfilename, 'w') as outfile:
-            
-            outfile.write(header)
-            for line in self.xz:
-                for column in line:
-                    outfile.write('{0:.8e}\t'.format(column))
-                outfile.write('\n')
-                      
+        try:
+            if getattr(self, 'xz', None) is None:
+                raise Exception("No histogram: run the widget first")
+
+            congruence.checkDir(self.output_datfilename)
+            if self.export_format == 0:
+                beam_util.write_histogram_text(self.output_datfilename, self.xz, self.x_axis, self.z_axis)
+            elif self.export_format == 1:
+                with h5py.File(self.output_datfilename, 'w') as f:
+                    f.create_dataset('x', data=self.x_axis)
+                    f.create_dataset('z', data=self.z_axis)
+                    dset = f.create_dataset('histogram', data=self.xz, compression="gzip")
+                    for key, value in self.histogram_metadata().items():
+                        dset.attrs[key] = value
+                    for key, value in self.beam_statistics.items():
+                        dset.attrs[key] = value
+            elif self.export_format == 2:
+                # histogram with the axes in the first row (X) and column (Z), as read by the widget
+                XZ = numpy.zeros((len(self.z_axis)+1, len(self.x_axis)+1))
+                XZ[0,1:] = self.x_axis
+                XZ[1:,0] = self.z_axis
+                XZ[1:,1:] = self.xz
+                numpy.save(self.output_datfilename, XZ)
+            else:
+                numpy.savez(self.output_datfilename, x=self.x_axis, z=self.z_axis, histogram=self.xz,
+                            **self.histogram_metadata(), **self.beam_statistics)
+        except Exception as exception:
+            QtWidgets.QMessageBox.critical(self, "Error",
+                                       str(exception),
+                                       QtWidgets.QMessageBox.Ok)
+
+    def histogram_metadata(self):
+        titles = self.get_titles()
+        return {'x_label': titles[2], 'z_label': titles[3],
+                'units': self.workspace_units_label,
+                'weight': self.weight_column.itemText(self.weight_column_index),
+                'rays': ["All rays", "Good Only", "Lost Only"][self.rays],
+                'integral': float(self.integral),
+                'nrays': self.bin_plan.nrays,
+                'good_rays': self.bin_plan.good_rays}
 
     def clearResults(self):
         if ConfirmDialog.confirmed(parent=self):
@@ -518,55 +620,111 @@ class PlotXY(AutomaticElement):
     def set_SlicePosition(self):
         self.slice_box.setVisible(self.cut == 4)
 #        self.slice_box_empty.setVisible(self.y_range != 4)
+        self.update_analysis()
+        
+    def update_analysis(self):
+        """
+        Re-analyzes the stored 2D histogram (cuts, ROI), without reading the beam again.
+        """
+        if self.beam2D is None: 
+            return
+        try:
+            self.analyze_beam(self.beam2D, invertXY = 0, overSampling = self.fwhm_oversampling,
+                               cut=self.cut, textA=self.textA, textB=self.textB, textC=self.textC, fitType=self.fitType,
+                               xlabel=self.get_titles()[2],ylabel=self.get_titles()[3], scale=self.scale)
+        except Exception as exception:
+            QtWidgets.QMessageBox.critical(self, "Error",
+                                       str(exception),
+                                       QtWidgets.QMessageBox.Ok)
+    
+    def get_roi_statistics(self):
+        congruence.checkLessThan(self.roi_x_min, self.roi_x_max, "ROI X min", "ROI X max")
+        congruence.checkLessThan(self.roi_y_min, self.roi_y_max, "ROI Y min", "ROI Y max")
+        stats = self.sat.roi(self.roi_x_min, self.roi_x_max, self.roi_y_min, self.roi_y_max)
+        # bin sums to integral of the displayed distribution
+        x_step = self.sat.x_axis[1] - self.sat.x_axis[0] if len(self.sat.x_axis) > 1 else 1.0
+        z_step = self.sat.z_axis[1] - self.sat.z_axis[0] if len(self.sat.z_axis) > 1 else 1.0
+        stats['integral'] = stats['total']*x_step*z_step
+        return stats
+        
+    def print_roi_statistics(self):
+        try:
+            sys.stdout = EmittingStream(textWritten=self.writeStdOut)
+            if self.sat is None:
+                raise Exception("No histogram: run the widget first")
+            
+            stats = self.get_roi_statistics()
+            print('\nROI X = [{0}, {1}], Y = [{2}, {3}] ({4} x {5} bins):'.format(self.roi_x_min, self.roi_x_max, self.roi_y_min, self.roi_y_max, stats['nx'], stats['nz']))
+            print('   Integral = {0:.6e} ({1:.4%} of the histogram)'.format(stats['integral'], stats['fraction']))
+            print('   X mean = {0:.6g}, Y mean = {1:.6g}'.format(stats['x_mean'], stats['z_mean']))
+            print('   X RMS = {0:.6g}, Y RMS = {1:.6g}'.format(stats['x_rms'], stats['z_rms']))
+        except Exception as exception:
+            QtWidgets.QMessageBox.critical(self, "Error",
+                                       str(exception),
+                                       QtWidgets.QMessageBox.Ok)
 
     def replace_fig(self, beam, var_x, var_y,  title, xtitle, ytitle, xrange, yrange, nbins, nolost, xum, yum):
 
 #        os.write(1, b'### Got here A ### \n')      
-        beam  = self.read_shadow_beam(beam=beam)                                                               
+        histogram_key = (self.bin_plan_version, self.weight_column_index, self.plot_zeroPadding, self.gaussian_filter, self.density_estimator, self.kde_factor)
+        if self.beam2D is None or histogram_key != self.histogram_key:
+            self.beam2D = self.read_shadow_beam(bin_plan=self.bin_plan)
+            self.histogram_key = histogram_key
+            self.histogram_version += 1
 #        os.write(1, b'### Got here B ### \n')
         
-        self.analyze_beam(beam, invertXY = 0, overSampling = self.fwhm_oversampling,
+        self.analyze_beam(self.beam2D, invertXY = 0, overSampling = self.fwhm_oversampling,
                            cut=self.cut, textA=self.textA, textB=self.textB, textC=self.textC, fitType=self.fitType,
                            xlabel=self.get_titles()[2],ylabel=self.get_titles()[3], scale=self.scale)
         
 #        os.write(1, b'### Got here C ### \n')
     def plot_xy(self, var_x, var_y, title, xtitle, ytitle, xum, yum):
-        beam_to_plot = self.input_beam._beam
         
-        #Collect beam info       
-        info_beam = beam_to_plot.histo1(1, nolost=1)
-        self.inten = ("{:.2f}".format(info_beam['intensity']))
-        self.nrays = str(int(info_beam['nrays']))
-        self.grays = str(int(info_beam['good_rays']))
-        self.lrays = str(int(info_beam['nrays']-info_beam['good_rays'])) 
-
-        if self.image_plane == 1:
-            new_shadow_beam = self.input_beam.duplicate(history=False)
-            dist = 0.0
-
-            if self.image_plane_rel_abs_position == 1:  # relative
-                dist = self.image_plane_new_position
-            else:  # absolute
-                if self.input_beam.historySize() == 0:
-                    historyItem = None
-                else:
-                    historyItem = self.input_beam.getOEHistory(oe_number=self.input_beam._oe_number)
-
-                if historyItem is None: image_plane = 0.0
-                elif self.input_beam._oe_number == 0: image_plane = 0.0
-                else: image_plane = historyItem._shadow_oe_end._oe.T_IMAGE
-
-                dist = self.image_plane_new_position - image_plane
-
-            self.retrace_beam(new_shadow_beam, dist)
-
-            beam_to_plot = new_shadow_beam._beam
+        #Collect beam info (once per input beam)
+        if self.beam_info_version != self.input_beam_version:
+            info_beam = beam_util.ray_statistics(self.input_beam._beam, self.chunk_size())
+            self.inten = ("{:.2f}".format(info_beam['intensity']))
+            self.nrays = str(int(info_beam['nrays']))
+            self.grays = str(int(info_beam['good_rays']))
+            self.lrays = str(int(info_beam['nrays']-info_beam['good_rays'])) 
+            self.beam_info_version = self.input_beam_version
+        
+        # The rays are binned again only if the beam, the screen position, the columns, the rays or the bins change:
+        # other weights are one bincount and display options do not touch the rays
+        bin_plan_key = (self.input_beam_version, self.image_plane, self.image_plane_new_position, self.image_plane_rel_abs_position,
+                        var_x, var_y, self.rays, self.number_of_binsX, self.number_of_binsY)
+        if self.bin_plan is None or bin_plan_key != self.bin_plan_key:
+            beam_to_plot = self.input_beam._beam
+            
+            if self.image_plane == 1:
+                dist = 0.0
+    
+                if self.image_plane_rel_abs_position == 1:  # relative
+                    dist = self.image_plane_new_position
+                else:  # absolute
+                    if self.input_beam.historySize() == 0:
+                        historyItem = None
+                    else:
+                        historyItem = self.input_beam.getOEHistory(oe_number=self.input_beam._oe_number)
+    
+                    if historyItem is None: image_plane = 0.0
+                    elif self.input_beam._oe_number == 0: image_plane = 0.0
+                    else: image_plane = historyItem._shadow_oe_end._oe.T_IMAGE
+    
+                    dist = self.image_plane_new_position - image_plane
+    
+                beam_to_plot = self.retrace_beam(self.input_beam, dist)
+            
+            self.bin_plan = beam_util.BinPlan(beam_to_plot, var_x, var_y, self.number_of_binsX, self.number_of_binsY, nolost=self.rays,
+                                              chunk_size=self.chunk_size())
+            self.bin_plan_key = bin_plan_key
+            self.bin_plan_version += 1
 
         self.unitFactorX=1.0
         self.unitFactorY=1.0
-        xrange, yrange = self.get_ranges(beam_to_plot, var_x, var_y)
+        xrange, yrange = self.get_ranges(self.bin_plan, var_x, var_y)
 
-        self.replace_fig(beam_to_plot, var_x, var_y, title, xtitle, ytitle, xrange=xrange, yrange=yrange, nbins=100, nolost=self.rays, xum=xum, yum=yum)
+        self.replace_fig(self.bin_plan.beam, var_x, var_y, title, xtitle, ytitle, xrange=xrange, yrange=yrange, nbins=100, nolost=self.rays, xum=xum, yum=yum)
 
     def plot_results(self):
         try:
@@ -607,7 +765,7 @@ class PlotXY(AutomaticElement):
 
             return False
 
-    def get_ranges(self, beam_to_plot, var_x, var_y):
+    def get_ranges(self, bin_plan, var_x, var_y):
         xrange = None
         yrange = None
         factor1 = ShadowPlot.get_factor(var_x, self.workspace_units_to_cm)
@@ -618,37 +776,9 @@ class PlotXY(AutomaticElement):
 
         if self.x_range == 0 and self.y_range == 0:
             if self.cartesian_axis == 1:
-                x_max = 0
-                y_max = 0
-                x_min = 0
-                y_min = 0
-
-                x, y, good_only = beam_to_plot.getshcol((var_x, var_y, 10))
-
-                x_to_plot = copy.deepcopy(x)
-                y_to_plot = copy.deepcopy(y)
-
-                go = numpy.where(good_only == 1)
-                lo = numpy.where(good_only != 1)
-
-                if self.rays == 0:
-                    x_max = numpy.array(x_to_plot[0:], float).max()
-                    y_max = numpy.array(y_to_plot[0:], float).max()
-                    x_min = numpy.array(x_to_plot[0:], float).min()
-                    y_min = numpy.array(y_to_plot[0:], float).min()
-                elif self.rays == 1:
-                    x_max = numpy.array(x_to_plot[go], float).max()
-                    y_max = numpy.array(y_to_plot[go], float).max()
-                    x_min = numpy.array(x_to_plot[go], float).min()
-                    y_min = numpy.array(y_to_plot[go], float).min()
-                elif self.rays == 2:
-                    x_max = numpy.array(x_to_plot[lo], float).max()
-                    y_max = numpy.array(y_to_plot[lo], float).max()
-                    x_min = numpy.array(x_to_plot[lo], float).min()
-                    y_min = numpy.array(y_to_plot[lo], float).min()
-
-                xrange = [x_min, x_max]
-                yrange = [y_min, y_max]
+                # data range of the selected rays (all, good or lost), kept by the bin plan
+                xrange = list(bin_plan.data_range_h)
+                yrange = list(bin_plan.data_range_v)
         else:
             if self.x_range == 1:
                 congruence.checkLessThan(self.x_range_min, self.x_range_max, "X range min", "X range max")
@@ -755,6 +885,7 @@ class PlotXY(AutomaticElement):
         if ShadowCongruence.checkEmptyBeam(beam):
             if ShadowCongruence.checkGoodBeam(beam):
                 self.input_beam = beam
+                self.input_beam_version += 1
 
                 if self.is_automatic_run:
                     self.plot_results()
@@ -764,6 +895,110 @@ class PlotXY(AutomaticElement):
                                            QtWidgets.QMessageBox.Ok)
 
 
+    def setComparisonBeam(self, beam, id):
+        if beam is None:
+            if id in self.comparison_links:
+                self.comparison.remove(self.comparison_links.pop(id))
+        elif ShadowCongruence.checkEmptyBeam(beam) and ShadowCongruence.checkGoodBeam(beam):
+            if not id in self.comparison_links:
+                self.comparison_count += 1
+                self.comparison_links[id] = "Input {0}".format(self.comparison_count)
+            self.comparison.add(self.comparison_links[id], beam._beam)
+
+    def keep_current_beam(self):
+        try:
+            if not ShadowCongruence.checkEmptyBeam(self.input_beam):
+                raise Exception("No input beam")
+            if self.comparison_name in self.comparison_links.values():
+                raise Exception("Name used by a connected beam: " + self.comparison_name)
+            # the beam on the current screen (retraced, if so)
+            beam = self.input_beam._beam if self.bin_plan is None or self.bin_plan_key[0] != self.input_beam_version else self.bin_plan.beam
+            self.comparison.add(self.comparison_name, beam)
+            
+            sys.stdout = EmittingStream(textWritten=self.writeStdOut)
+            print('\nBeams to compare: ' + ', '.join(self.comparison.names()))
+        except Exception as exception:
+            QtWidgets.QMessageBox.critical(self, "Error",
+                                       str(exception),
+                                       QtWidgets.QMessageBox.Ok)
+
+    def clear_kept_beams(self):
+        for name in self.comparison.names():
+            if not name in self.comparison_links.values():
+                self.comparison.remove(name)
+
+    def compare_beams(self):
+        """
+        Difference or ratio map of a beam and the first one, with the integrated profiles of all beams.
+        """
+        try:
+            sys.stdout = EmittingStream(textWritten=self.writeStdOut)
+            
+            names = self.comparison.names()
+            if len(names) < 2:
+                raise Exception("At least two beams are needed: keep the current beam or connect Comparison Beams")
+            self.comparison_beam = congruence.checkStrictlyPositiveNumber(self.comparison_beam, "Beam compared to the first (#)")
+            if self.comparison_beam > len(names):
+                raise Exception("There are only {0} beams".format(len(names)))
+            
+            var_x, var_y = self.x_column_index+1, self.y_column_index+1
+            factor_x = ShadowPlot.get_factor(var_x, self.workspace_units_to_cm)
+            factor_y = ShadowPlot.get_factor(var_y, self.workspace_units_to_cm)
+            xrange = [self.x_range_min / factor_x, self.x_range_max / factor_x] if self.x_range == 1 else None
+            yrange = [self.y_range_min / factor_y, self.y_range_max / factor_y] if self.y_range == 1 else None
+            self.comparison.chunk_size = self.chunk_size()
+            self.comparison.set_plan(var_x, var_y, self.number_of_binsX, self.number_of_binsY, nolost=self.rays, xrange=xrange, yrange=yrange)
+            
+            h_axis, v_axis = self.comparison.axes()
+            h_axis, v_axis = h_axis*factor_x, v_axis*factor_y
+            name = names[self.comparison_beam-1]
+            result = self.comparison.compare(name, ref=self.weight_column_index, mode=['difference', 'ratio'][self.comparison_map],
+                                             normalize=self.comparison_normalize==1)
+            titles = self.get_titles()
+            
+            self.compare_figure.clear()
+            ax_map, ax_x, ax_z, ax_t = [self.compare_figure.add_subplot(2, 2, k) for k in range(1, 5)]
+            
+            if self.comparison_map == 0:
+                vmax = numpy.nanmax(numpy.abs(result)) if numpy.any(numpy.isfinite(result)) else 1.0
+                mesh = ax_map.pcolormesh(h_axis, v_axis, result.T, cmap='RdBu_r', vmin=-vmax, vmax=vmax)
+                ax_map.set_title('{0} - {1}'.format(name, names[0]), fontsize=10)
+            else:
+                mesh = ax_map.pcolormesh(h_axis, v_axis, numpy.ma.masked_invalid(result.T))
+                ax_map.set_title('{0} / {1}'.format(name, names[0]), fontsize=10)
+            self.compare_figure.colorbar(mesh, ax=ax_map)
+            ax_map.set_xlabel(titles[2])
+            ax_map.set_ylabel(titles[3])
+            
+            print('\nBeam comparison ({0} x {1} bins of the first beam):'.format(self.number_of_binsX, self.number_of_binsY))
+            print('   {0:>16} {1:>12} {2:>10} {3:>10} {4:>10} {5:>10} {6:>10} {7:>10}'.format('Beam', 'Total', 'X mean', 'Y mean', 'X RMS', 'Y RMS', 'X FWHM', 'Y FWHM'))
+            text = ''
+            for name_k in names:
+                histogram = self.comparison.histogram(name_k, ref=self.weight_column_index)
+                total = numpy.sum(histogram) if self.comparison_normalize == 1 and numpy.sum(histogram) != 0.0 else 1.0
+                ax_x.plot(h_axis, histogram.sum(axis=1)/total, label=name_k)
+                ax_z.plot(v_axis, histogram.sum(axis=0)/total, label=name_k)
+                
+                stats = self.comparison.statistics(name_k, ref=self.weight_column_index)
+                print('   {0:>16} {1:>12.4e} {2:>10.4g} {3:>10.4g} {4:>10.4g} {5:>10.4g} {6:>10.4g} {7:>10.4g}'.format(name_k, stats['total'],
+                      stats['x_mean']*factor_x, stats['z_mean']*factor_y, stats['x_rms']*factor_x, stats['z_rms']*factor_y,
+                      stats['x_fwhm']*factor_x, stats['z_fwhm']*factor_y))
+                text += '{0}\n   RMS = {1:.3f} x {2:.3f}\n   FWHM = {3:.3f} x {4:.3f}\n'.format(name_k, stats['x_rms']*factor_x, stats['z_rms']*factor_y,
+                                                                                           stats['x_fwhm']*factor_x, stats['z_fwhm']*factor_y)
+            ax_x.set_xlabel(titles[2])
+            ax_z.set_xlabel(titles[3])
+            ax_x.legend(fontsize=8)
+            ax_t.axis('off')
+            ax_t.text(0.0, 1.0, text, family='serif', verticalalignment='top', fontsize=9, transform=ax_t.transAxes)
+            
+            self.compare_figure.tight_layout()
+            self.compare_figure.canvas.draw()
+            self.main_tabs.setCurrentIndex(self.main_tabs.indexOf(self.compare_tab))
+        except Exception as exception:
+            QtWidgets.QMessageBox.critical(self, "Error",
+                                       str(exception),
+                                       QtWidgets.QMessageBox.Ok)
+
     def writeStdOut(self, text):
         cursor = self.shadow_output.textCursor()
         cursor.movePosition(QtGui.QTextCursor.End)
@@ -771,8 +1006,20 @@ class PlotXY(AutomaticElement):
         self.shadow_output.setTextCursor(cursor)
         self.shadow_output.ensureCursorVisible()
 
-    def retrace_beam(self, new_shadow_beam, dist):
-            new_shadow_beam._beam.retrace(dist)
+    def retrace_beam(self, shadow_beam, dist):
+        # retraced positions are cached per distance, the other columns are read chunk by chunk from the input beam
+        self.retrace_cache_size = congruence.checkPositiveNumber(self.retrace_cache_size, "Retraced beams cache size")
+        if self.retrace_cache is None:
+            self.retrace_cache = beam_util.RetraceCache(self.retrace_cache_size)
+        self.retrace_cache.resize(self.retrace_cache_size)
+        self.retrace_cache.chunk_size = self.chunk_size()
+        self.retrace_cache.set_beam(shadow_beam._beam, (id(shadow_beam), self.input_beam_version))
+        return self.retrace_cache.retrace(dist)
+
+    def chunk_size(self):
+        # rays are read in chunks that fit in the memory ceiling
+        self.memory_limit = congruence.checkStrictlyPositiveNumber(self.memory_limit, "Memory for reading rays")
+        return beam_util.chunk_rays(self.memory_limit)
 
     def getConversionActive(self):
         return self.is_conversion_active==1
@@ -985,25 +1232,18 @@ class PlotXY(AutomaticElement):
             return [fwhm, 0, 0, 0, 0]
     
     def find_peak(self, xz):
-        zmax = [0, 0]; xmax = [0, 0]
-    
-        for i in range(len(xz[:,0])):
-            for j in range(len(xz[0,:])):
-                
-                if(xz[i,j] > zmax[1]):
-                    zmax[0] = j
-                    zmax[1] = xz[i,j]
-                                    
-                if(xz[i,j] > xmax[1]):
-                    xmax[0] = i
-                    xmax[1] = xz[i,j]
-                    
-        return xmax, zmax
+        return beam_util.find_peak(xz)
 
 
-    def read_shadow_beam(self, beam):   
+    def read_shadow_beam(self, bin_plan):   
 
-        histo2D = beam.histo2(col_h=self.x_column_index+1, col_v=self.y_column_index+1, nbins_h=self.number_of_binsX, nbins_v=self.number_of_binsY, nolost=self.rays, ref=self.weight_column_index)
+        if self.density_estimator == 0:
+            histo2D = bin_plan.histo2(ref=self.weight_column_index)
+        else:
+            # kernel density estimate on the bin centres: plots, cuts, FWHM and RMS use the smoothed density
+            self.kde_factor = congruence.checkStrictlyPositiveNumber(self.kde_factor, "KDE bandwidth factor")
+            histo2D = bin_plan.histo2(ref=self.weight_column_index, rule=['scott', 'silverman'][self.density_estimator-1], factor=self.kde_factor)
+            print('KDE bandwidths: X = {0:.4g}, Y = {1:.4g}'.format(histo2D['bandwidth'][0]*self.unitFactorX, histo2D['bandwidth'][1]*self.unitFactorY))
         
         x_axis = histo2D['bin_h_center']
         z_axis = histo2D['bin_v_center']
@@ -1069,44 +1309,24 @@ class PlotXY(AutomaticElement):
             xz = xz * float(self.integral) # distribution in physical units [unit = unit[integral] / (unit[x_azis] * unit[z_axis])] 
         #os.write(1, b'### Got here 2 ### \n')
 
-        x_cut_coord = 0.0
-        z_cut_coord = 0.0
-       
+        # SUMMED-AREA TABLE FOR ROI AND BAND QUERIES
+        sat_key = (self.histogram_version, self.integral, self.unitFactorX, self.unitFactorY, invertXY)
+        if self.sat is None or sat_key != self.sat_key:
+            self.sat = beam_util.SummedAreaTable(xz, x_axis, z_axis)
+            self.sat_key = sat_key
+        
         # FIND MEAN VALUE
-        z_int = numpy.array([numpy.sum(xz[i,1:]) for i in range(len(z_axis))])
-        x_int = numpy.array([numpy.sum(xz[1:,j]) for j in range(len(x_axis))])
+        z_int, x_int = beam_util.integrated_profiles(xz)
         z_mean = numpy.average(z_axis, weights=z_int)
         x_mean = numpy.average(x_axis, weights=x_int)
 #        os.write(1, b'### Got here 3 ### \n')
         # FIND PEAK VALUES
         xmax, zmax = self.find_peak(xz)
         
-        if(cut==0): # PLOT INTEGRATED DISTRIBUTION
-            z_cut = numpy.array([numpy.sum(xz[i,1:]) for i in range(len(z_axis))])*(x_axis[int(len(x_axis)/2 + 1)]-x_axis[int(len(x_axis)/2)])
-            x_cut = numpy.array([numpy.sum(xz[1:,j]) for j in range(len(x_axis))])*(z_axis[int(len(z_axis)/2 + 1)]-z_axis[int(len(z_axis)/2)])
-            
-        elif(cut==1): # PLOT CUT AT ZERO
-            z_cut = xz[:, numpy.abs(x_axis).argmin()]
-            x_cut = xz[numpy.abs(z_axis).argmin(), :]
-        
-        elif(cut==2): # PLOT CUT AT PEAK
-            x_cut_coord = x_axis[zmax[0]]
-            z_cut_coord = z_axis[xmax[0]]
-            z_cut = xz[:, zmax[0]]
-            x_cut = xz[xmax[0], :]
-
-        elif(cut==3): # PLOT CUT AT MEAN VALUE OF INTEGRATED DISTRIBUTION
-            x_cut_coord = x_axis[numpy.abs(x_axis-x_mean).argmin()]
-            z_cut_coord = z_axis[numpy.abs(z_axis-z_mean).argmin()]
-            z_cut = xz[:, numpy.abs(x_axis-x_mean).argmin()]
-            x_cut = xz[numpy.abs(z_axis-z_mean).argmin(), :]
-            
-        elif(cut==4): # PLOT CUT AT CUSTOM VALUES
-            x_cut_coord = x_axis[numpy.abs(x_axis-self.x_cut_pos).argmin()]
-            z_cut_coord = z_axis[numpy.abs(z_axis-self.y_cut_pos).argmin()]
-            z_cut = xz[:, numpy.abs(x_axis-self.x_cut_pos).argmin()]
-            x_cut = xz[numpy.abs(z_axis-self.y_cut_pos).argmin(), :]
-            pass
+        # PLOT INTEGRATED DISTRIBUTION OR CUT AT ZERO, PEAK, MEAN VALUE OR CUSTOM VALUES
+        x_cut, z_cut, x_cut_coord, z_cut_coord = beam_util.extract_cuts(xz, x_axis, z_axis, cut, x_pos=self.x_cut_pos, z_pos=self.y_cut_pos,
+                                                                        profiles=(z_int, x_int), peak=(xmax, zmax), mean=(x_mean, z_mean),
+                                                                        sat=self.sat, band=(self.roi_x_min, self.roi_x_max, self.roi_y_min, self.roi_y_max))
         
 #        os.write(1, b'### Got here 4 ### \n')
         z_cut_rms = self.calc_rms(z_axis, z_cut)
@@ -1217,8 +1437,8 @@ class PlotXY(AutomaticElement):
             # If there is a negative or zero number, it will be replaced by half minimum value higher than 0.
             if(numpy.min(xz) <= 0.0):
                 xz_min_except_0 = numpy.min(xz[xz>0])
-                xz[xz<=0.0] = xz_min_except_0/2.0
-                self.ax2D.pcolormesh(x_axis, z_axis, xz, norm=LogNorm(vmin=xz.min(), vmax=xz.max()))
+                xz_log = numpy.where(xz<=0.0, xz_min_except_0/2.0, xz) # only for display, the exported histogram is kept
+                self.ax2D.pcolormesh(x_axis, z_axis, xz_log, norm=LogNorm(vmin=xz_log.min(), vmax=xz_log.max()))
     
             else:
                 self.ax2D.pcolormesh(x_axis, z_axis, xz, norm=LogNorm(vmin=xz.min(), vmax=xz.max()))
@@ -1231,6 +1451,10 @@ class PlotXY(AutomaticElement):
         self.axX.axvline(x=x_cut_coord, color='k', linestyle='--', alpha=0.1)
         self.axY.axhline(y=z_cut_coord, color='k', linestyle='--', alpha=0.1)
         
+        if(cut==5 or 13 in [textA, textB, textC]): # ROI
+            self.ax2D.plot([self.roi_x_min, self.roi_x_max, self.roi_x_max, self.roi_x_min, self.roi_x_min],
+                           [self.roi_y_min, self.roi_y_min, self.roi_y_max, self.roi_y_max, self.roi_y_min], 'w--', linewidth=1)
+        
         ###### TESTING ####
 #        def interp_distribution(array_x,array_y,oversampling):
 #            dist = interp1d(array_x, array_y)
@@ -1318,6 +1542,16 @@ class PlotXY(AutomaticElement):
         
         text8 = ''; text9 = ''; text10 = ''; text11 = ''; text12 = ''; # IF FIT IS DISABLED
         
+        # ROI STATISTICS
+        text13 = ''
+        if(13 in [textA, textB, textC]):
+            roi_stats = self.get_roi_statistics()
+            text13  = 'ROI = {0:.3e} ({1:.1%})\n'.format(roi_stats['integral'], roi_stats['fraction'])
+            text13 += hor_label+' MEAN = {0:.3f}\n'.format(roi_stats['x_mean'])
+            text13 += vert_label+' MEAN = {0:.3f}\n'.format(roi_stats['z_mean'])
+            text13 += hor_label+' RMS = {0:.3f}\n'.format(roi_stats['x_rms'])
+            text13 += vert_label+' RMS = {0:.3f}\n'.format(roi_stats['z_rms'])
+        
         if(fitType != 0):
             
             # MEAN COORDINATES
@@ -1354,7 +1588,8 @@ class PlotXY(AutomaticElement):
                 9 : [text9, 'C1'],
                 10 : [text10, 'C1'],
                 11 : [text11, 'C1'],
-                12 : [text12, 'C1']
+                12 : [text12, 'C1'],
+                13 : [text13, 'C2']
             }.get(x, ['', ''])       
         
         [text_box1, color1] = text(textA)
@@ -1364,6 +1599,17 @@ class PlotXY(AutomaticElement):
         self.xz = xz
         self.x_axis = x_axis
         self.z_axis = z_axis    
+        
+        # statistics exported with the histogram
+        self.beam_statistics = {'x_mean': x_mean, 'z_mean': z_mean,
+                                'x_peak': x_axis[zmax[0]], 'z_peak': z_axis[xmax[0]],
+                                'cut': cut,
+                                'x_fwhm': x_cut_fwhm[0], 'z_fwhm': z_cut_fwhm[0],
+                                'x_rms': x_cut_rms, 'z_rms': z_cut_rms,
+                                'x_max': numpy.max(x_cut), 'z_max': numpy.max(z_cut)}
+        if(fitType != 0):
+            self.beam_statistics.update({'x_fit_fwhm': x_cut_fit_fwhm[0], 'z_fit_fwhm': z_cut_fit_fwhm[0],
+                                         'x_fit_rms': x_cut_fit_rms, 'z_fit_rms': z_cut_fit_rms})
     
         self.axT.text(self.LTborder + 0.02, self.RBborder + self.width_main + self.space + self.X_or_Y - 0.05, text_box1, color=color1, family='serif', weight='medium', horizontalalignment='left', verticalalignment='top', fontsize=10, transform= self.axT.transAxes)
         self.axT.text(self.LTborder + 0.02, self.RBborder + self.width_main + self.space + self.X_or_Y - 0.35, text_box2, color=color2, family='serif', weight='medium', horizontalalignment='left', verticalalignment='top', fontsize=10, transform= self.axT.transAxes)
@@ -4,6 +4,10 @@ import os
 
 import sys
 import time
+import platform
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
 #import numpy
 import h5py
 from matplotlib import pyplot as plt
@@ -23,12 +27,15 @@ from silx.gui.plot.Colormap import Colormap
 from PyQt5 import QtWidgets
 from PyQt5.QtGui import QTextCursor
 from PyQt5.QtGui import QPalette, QColor, QFont
+from PyQt5.QtCore import QTimer
 
 import orangecanvas.resources as resources
 from orangecontrib.shadow.lnls.widgets.gui.ow_lnls_shadow_widget_c import LNLSShadowWidgetC
 from orangecontrib.shadow.util.shadow_objects import ShadowBeam
+import Shadow
 import Shadow.ShadowTools as st
 from orangecontrib.shadow.util.shadow_util import ShadowCongruence
+from orangecontrib.shadow.lnls.util import caustic_util, history_util
 
 
     
@@ -87,6 +94,25 @@ class CausticWidget(LNLSShadowWidgetC):
     plot2D_z_range_maxYZ = Setting(0.0)    
     scale = Setting(0)
     quick_preview = Setting(1)
+    progressive = Setting(0)
+    progressive_first_fraction = Setting(0.02)
+    progressive_passes = Setting(6)
+    progressive_seed = Setting(0)
+    bootstrap_replicates = Setting(0)
+    bootstrap_confidence = Setting(95.0)
+    bootstrap_workers = Setting(4)
+    swmr_writing = Setting(0)
+    follow_interval = Setting(2.0)
+    follow_file = 0
+    caustic_running = False
+    
+    sweep_element = Setting(1)
+    sweep_parameter = Setting('RMIRR')
+    sweep_start = Setting(1000.0)
+    sweep_stop = Setting(2000.0)
+    sweep_npoints = Setting(11)
+    sweep_workers = Setting(4)
+    sweep_filename = Setting('caustic_sweep.h5')
     
     def __init__(self):
         super().__init__()
@@ -104,10 +130,11 @@ class CausticWidget(LNLSShadowWidgetC):
         ### Tabs inside control area ###
         tab1 = oasysgui.createTabPage(self.tabs_setting, "Run Options", height=840)
         tab2 = oasysgui.createTabPage(self.tabs_setting, "Plot Options" )
+        tab_sweep = oasysgui.createTabPage(self.tabs_setting, "Sweep")
 
 
         ### Run Options Tab
-        gui.button(tab1, self, "Run Caustic", callback=self.run_caustic, height=35,width=100)
+        self.run_button = gui.button(tab1, self, "Run Caustic", callback=self.run_caustic, height=35,width=100)
         general_box = oasysgui.widgetBox(tab1, "Variables Settings", addSpace=True, orientation="vertical", height=380)
 
         gui.checkBox(general_box, self, "auto_xy_ranges", "Internal Calculated X,Y Ranges", callback=self.calc_rangesXY)
@@ -255,6 +282,20 @@ class CausticWidget(LNLSShadowWidgetC):
         oasysgui.lineEdit(self.zrange_box, self, "nz", "Z Number of Points", callback=self.nz_to_step, labelWidth=260, valueType=int, orientation="horizontal")
         oasysgui.lineEdit(self.zrange_box, self, "z_offset", "Z Offset", labelWidth=260, valueType=float, orientation="horizontal")
         oasysgui.lineEdit(self.zrange_box, self, "save_filename", "HDF5 File Name", labelWidth=120, valueType=str, orientation="horizontal")
+        self.swmr_checkbox = gui.checkBox(caustic_box, self, "swmr_writing", "SWMR writing (file readable during the run)")
+        
+        progressive_box = oasysgui.widgetBox(tab1, "Progressive Preview", addSpace=True, orientation="vertical", height=160)
+        gui.checkBox(progressive_box, self, "progressive", "Refine with increasing ray subsets", callback=self.set_progressive)
+        oasysgui.lineEdit(progressive_box, self, "progressive_first_fraction", "Fraction of rays in first pass", labelWidth=260, valueType=float, orientation="horizontal")
+        oasysgui.lineEdit(progressive_box, self, "progressive_passes", "Number of passes", labelWidth=260, valueType=int, orientation="horizontal")
+        oasysgui.lineEdit(progressive_box, self, "progressive_seed", "Random seed (0 = new seed)", labelWidth=260, valueType=int, orientation="horizontal")
+        gui.button(progressive_box, self, "Stop", callback=self.stop_caustic)
+        
+        self.bootstrap_box = oasysgui.widgetBox(tab1, "Bootstrap Uncertainty", addSpace=True, orientation="vertical", height=110)
+        oasysgui.lineEdit(self.bootstrap_box, self, "bootstrap_replicates", "Replicates (0 = disabled)", labelWidth=260, valueType=int, orientation="horizontal")
+        oasysgui.lineEdit(self.bootstrap_box, self, "bootstrap_confidence", "Confidence Level [%]", labelWidth=260, valueType=float, orientation="horizontal")
+        oasysgui.lineEdit(self.bootstrap_box, self, "bootstrap_workers", "Worker Processes", labelWidth=260, valueType=int, orientation="horizontal")
+        self.set_progressive()
         
         ### 2D Plot Options Tab
 #        button_box1 = oasysgui.widgetBox(tab2, "", addSpace=True, orientation="vertical", height=68, width=150)
@@ -262,9 +303,12 @@ class CausticWidget(LNLSShadowWidgetC):
 #        gui.button(button_box1, self, "Load and Refresh", callback=self.load_and_refresh, height=28, width=140)
 #        gui.button(button_box2, self, "Save 2D Plots", callback=self.save_2D_plots, height=28, width=140)
 
-        self.options2D_box = oasysgui.widgetBox(tab2, "Read File", addSpace=True, orientation="vertical", height=160)
+        self.options2D_box = oasysgui.widgetBox(tab2, "Read File", addSpace=True, orientation="vertical", height=190)
 
         gui.checkBox(self.options2D_box, self, "quick_preview", "Plot Quick Preview")
+        follow_box = oasysgui.widgetBox(self.options2D_box, "", addSpace=False, orientation="horizontal")
+        gui.checkBox(follow_box, self, "follow_file", "Follow growing file every", callback=self.set_follow)
+        oasysgui.lineEdit(follow_box, self, "follow_interval", "[s]", labelWidth=20, controlWidth=50, valueType=float, orientation="horizontal")
 
         button_file_box = oasysgui.widgetBox(self.options2D_box, "", addSpace=False, orientation="horizontal")
         self.le_load_filename = oasysgui.lineEdit(button_file_box, self, "load_filename", "HDF5 File Name (.h5)", 
@@ -358,6 +402,19 @@ class CausticWidget(LNLSShadowWidgetC):
         oasysgui.lineEdit(zrange_box3, self, "plot2D_z_range_maxYZ", "Z Max (YZ fit)", labelWidth=100, controlWidth=60, valueType=float, orientation="horizontal")
         
         
+        ### Sweep Tab
+        gui.button(tab_sweep, self, "Run Sweep", callback=self.run_sweep, height=35,width=100)
+        sweep_box = oasysgui.widgetBox(tab_sweep, "Sweep Settings", addSpace=True, orientation="vertical", height=260)
+        
+        oasysgui.lineEdit(sweep_box, self, "sweep_element", "Element Number (0 = source)", labelWidth=260, valueType=int, orientation="horizontal")
+        oasysgui.lineEdit(sweep_box, self, "sweep_parameter", "SHADOW Variable (e.g. RMIRR, RX_SLIT[0])", labelWidth=260, valueType=str, orientation="horizontal")
+        oasysgui.lineEdit(sweep_box, self, "sweep_start", "Start Value", labelWidth=260, valueType=float, orientation="horizontal")
+        oasysgui.lineEdit(sweep_box, self, "sweep_stop", "Stop Value", labelWidth=260, valueType=float, orientation="horizontal")
+        oasysgui.lineEdit(sweep_box, self, "sweep_npoints", "Number of Values", labelWidth=260, valueType=int, orientation="horizontal")
+        oasysgui.lineEdit(sweep_box, self, "sweep_workers", "Worker Processes", labelWidth=260, valueType=int, orientation="horizontal")
+        oasysgui.lineEdit(sweep_box, self, "sweep_filename", "HDF5 File Name", labelWidth=120, valueType=str, orientation="horizontal")
+        gui.button(sweep_box, self, "List Beamline Elements", callback=self.list_beamline_elements)
+        
         ############### MAIN AREA #####################
         
         self.tabs_plots = oasysgui.tabWidget(self.mainArea)
@@ -367,6 +424,7 @@ class CausticWidget(LNLSShadowWidgetC):
         ### Tabs Inside the main area ###
         tab3 = oasysgui.createTabPage(self.tabs_plots, "2D Visualization")
         tab4 = oasysgui.createTabPage(self.tabs_plots, "2D Analysis" )
+        tab_sweep_plots = oasysgui.createTabPage(self.tabs_plots, "Sweep")
 #        tab5 = oasysgui.createTabPage(self.tabs_plots, "3D Visualization")
       
       
@@ -458,6 +516,45 @@ class CausticWidget(LNLSShadowWidgetC):
         self.ax22 = self.figure22.add_axes([0.15, 0.15, 0.8, 0.75])        
         
         
+        ###### Sweep
+        
+        sweep_box1 = oasysgui.widgetBox(tab_sweep_plots, "", addSpace=True, orientation="horizontal",
+                                        height=355, width=3*self.CONTROL_AREA_WIDTH)
+        
+        self.image_box_sweepH = gui.widgetBox(sweep_box1, "X FWHM vs Parameter", addSpace=True, orientation="vertical")
+        self.image_box_sweepH.setFixedHeight(1.0*self.IMAGE_HEIGHT)
+        self.image_box_sweepH.setFixedWidth(1.0*self.IMAGE_WIDTH)
+        self.figure_sweepH = Figure()
+        self.figure_sweepH.patch.set_facecolor('white')
+        self.plot_canvas_sweepH = FigureCanvasQTAgg(self.figure_sweepH)
+        self.image_box_sweepH.layout().addWidget(self.plot_canvas_sweepH)
+        self.ax_sweepH = self.figure_sweepH.add_axes([0.15, 0.15, 0.8, 0.75])
+        
+        self.image_box_sweepV = gui.widgetBox(sweep_box1, "Y FWHM vs Parameter", addSpace=True, orientation="vertical")
+        self.image_box_sweepV.setFixedHeight(1.0*self.IMAGE_HEIGHT)
+        self.image_box_sweepV.setFixedWidth(1.0*self.IMAGE_WIDTH)
+        self.figure_sweepV = Figure()
+        self.figure_sweepV.patch.set_facecolor('white')
+        self.plot_canvas_sweepV = FigureCanvasQTAgg(self.figure_sweepV)
+        self.image_box_sweepV.layout().addWidget(self.plot_canvas_sweepV)
+        self.ax_sweepV = self.figure_sweepV.add_axes([0.15, 0.15, 0.8, 0.75])
+        
+        sweep_box2 = oasysgui.widgetBox(tab_sweep_plots, "", addSpace=True, orientation="horizontal",
+                                        height=355, width=3*self.CONTROL_AREA_WIDTH)
+        
+        self.image_box_waist = gui.widgetBox(sweep_box2, "Waist vs Parameter", addSpace=True, orientation="vertical")
+        self.image_box_waist.setFixedHeight(1.0*self.IMAGE_HEIGHT)
+        self.image_box_waist.setFixedWidth(2.0*self.IMAGE_WIDTH)
+        self.figure_waist = Figure()
+        self.figure_waist.patch.set_facecolor('white')
+        self.plot_canvas_waist = FigureCanvasQTAgg(self.figure_waist)
+        self.image_box_waist.layout().addWidget(self.plot_canvas_waist)
+        self.ax_waist_size = self.figure_waist.add_axes([0.08, 0.15, 0.38, 0.75])
+        self.ax_waist_z = self.figure_waist.add_axes([0.58, 0.15, 0.38, 0.75])
+        
+        self.follow_timer = QTimer(self)
+        self.follow_timer.timeout.connect(self.follow_refresh)
+        
         ### Creates 'Run' function for widget ###
         self.runaction = widget.OWAction("Load and Refresh", self)
         self.runaction.triggered.connect(self.load_and_refresh)
@@ -597,7 +694,7 @@ class CausticWidget(LNLSShadowWidgetC):
 
                 self.input_beam = beam
 
-                if self.is_automatic_run:
+                if self.is_automatic_run and not self.caustic_running: # the running caustic keeps its own beam
 #                    self.run()
                     pass
             else:
@@ -607,14 +704,25 @@ class CausticWidget(LNLSShadowWidgetC):
     
     ### Call plot functions ###
     def run_caustic(self):
+        # events are processed during the run (plots, follow mode, Stop): the run must not be started again
+        if self.caustic_running:
+            return False
+        self.caustic_running = True
+        self.run_button.setEnabled(False)
+        try:
+            return self.compute_caustic(self.input_beam)
+        finally:
+            self.caustic_running = False
+            self.run_button.setEnabled(True)
 
+    def compute_caustic(self, input_beam):
 
         try:
             plotted = False
 
             sys.stdout = EmittingStream(textWritten=self.writeStdOut)
 
-            if ShadowCongruence.checkEmptyBeam(self.input_beam):
+            if ShadowCongruence.checkEmptyBeam(input_beam):
                 self.x_nbins = congruence.checkStrictlyPositiveNumber(self.x_nbins, "Number of Bins X")
                 self.y_nbins = congruence.checkStrictlyPositiveNumber(self.y_nbins, "Number of Bins Y")
                 self.nz = congruence.checkStrictlyPositiveNumber(self.nz, "Number of Z Points")
@@ -628,13 +736,46 @@ class CausticWidget(LNLSShadowWidgetC):
                 self.print_date_i()
                 sys.stdout.write("Running Caustic... ")
                 sys.stdout.flush()
-                self.run_shadow_caustic(filename=self.save_filename, beam=self.input_beam._beam.duplicate(), 
-                                        zStart=self.z_range_min, zFin=self.z_range_max, nz=self.nz, zOffset=self.z_offset,
-                                        colh=self.x_column_index+1, colv=self.y_column_index+1, colref=self.weight_column_index,
-                                        nbinsh=self.x_nbins, nbinsv=self.y_nbins, 
-                                        xrange=[self.x_range_min, self.x_range_max],
-                                        yrange=[self.y_range_min, self.y_range_max])
-                sys.stdout.write('...finished!')
+                if self.progressive:
+                    congruence.checkStrictlyPositiveNumber(self.progressive_first_fraction, "Fraction of rays in first pass")
+                    congruence.checkLessOrEqualThan(self.progressive_first_fraction, 1.0, "Fraction of rays in first pass", "1")
+                    self.progressive_passes = congruence.checkStrictlyPositiveNumber(self.progressive_passes, "Number of passes")
+                    self.progressive_seed = congruence.checkPositiveNumber(self.progressive_seed, "Random seed")
+                    self.run_shadow_caustic_progressive(filename=self.save_filename, beam=input_beam._beam, 
+                                                        zStart=self.z_range_min, zFin=self.z_range_max, nz=self.nz, zOffset=self.z_offset,
+                                                        colh=self.x_column_index+1, colv=self.y_column_index+1, colref=self.weight_column_index,
+                                                        nbinsh=self.x_nbins, nbinsv=self.y_nbins, 
+                                                        xrange=[self.x_range_min, self.x_range_max],
+                                                        yrange=[self.y_range_min, self.y_range_max],
+                                                        first_fraction=self.progressive_first_fraction, npasses=self.progressive_passes,
+                                                        seed=self.progressive_seed)
+                    sys.stdout.write('...finished!')
+                    if self.profile is not None:
+                        self.print_profile(self.profile)
+                else:
+                    self.run_shadow_caustic(filename=self.save_filename, beam=input_beam._beam.duplicate(), 
+                                            zStart=self.z_range_min, zFin=self.z_range_max, nz=self.nz, zOffset=self.z_offset,
+                                            colh=self.x_column_index+1, colv=self.y_column_index+1, colref=self.weight_column_index,
+                                            nbinsh=self.x_nbins, nbinsv=self.y_nbins, 
+                                            xrange=[self.x_range_min, self.x_range_max],
+                                            yrange=[self.y_range_min, self.y_range_max],
+                                            swmr=self.swmr_writing)
+                    sys.stdout.write('...finished!')
+                    self.print_profile(self.profile)
+                    if self.bootstrap_replicates > 0:
+                        congruence.checkStrictlyPositiveNumber(self.bootstrap_confidence, "Confidence Level")
+                        congruence.checkLessThan(self.bootstrap_confidence, 100.0, "Confidence Level", "100 %")
+                        self.bootstrap_workers = congruence.checkStrictlyPositiveNumber(self.bootstrap_workers, "Worker Processes")
+                        sys.stdout.write("\nRunning Bootstrap ({0} replicates)... ".format(self.bootstrap_replicates))
+                        self.run_bootstrap(filename=self.save_filename, beam=input_beam._beam, 
+                                           zStart=self.z_range_min, zFin=self.z_range_max, nz=self.nz,
+                                           colh=self.x_column_index+1, colv=self.y_column_index+1, colref=self.weight_column_index,
+                                           nbinsh=self.x_nbins, nbinsv=self.y_nbins, 
+                                           xrange=[self.x_range_min, self.x_range_max],
+                                           yrange=[self.y_range_min, self.y_range_max],
+                                           nreplicates=self.bootstrap_replicates, confidence=self.bootstrap_confidence,
+                                           workers=self.bootstrap_workers)
+                        sys.stdout.write('...finished!')
                 self.print_date_f()
                 plotted = True
 
@@ -648,6 +789,90 @@ class CausticWidget(LNLSShadowWidgetC):
                                        QtWidgets.QMessageBox.Ok)
             return False
 
+    def set_progressive(self):
+        # the progressive caustic is written once at the end, without SWMR or bootstrap
+        self.swmr_checkbox.setEnabled(self.progressive == 0)
+        self.bootstrap_box.setEnabled(self.progressive == 0)
+
+    def set_follow(self):
+        if self.follow_file:
+            sys.stdout = EmittingStream(textWritten=self.writeStdOut)
+            self.follow_timer.start(int(1000*max(self.follow_interval, 0.1)))
+        else:
+            self.follow_timer.stop()
+    
+    def follow_refresh(self):
+        try:
+            growing = caustic_util.is_growing_caustic(self.load_filename)
+            self.plot_quick_preview(self.load_filename,
+                                    scale=self.scale,
+                                    xrange=[self.plot2D_x_range_min, self.plot2D_x_range_max],
+                                    yrange=[self.plot2D_y_range_min, self.plot2D_y_range_max],
+                                    zrange=[self.plot2D_z_range_min, self.plot2D_z_range_max],
+                                    zrangeXZ=[self.plot2D_z_range_minXZ, self.plot2D_z_range_maxXZ],
+                                    zrangeYZ=[self.plot2D_z_range_minYZ, self.plot2D_z_range_maxYZ],
+                                    xunits=self.x_units, yunits=self.y_units, zunits=self.z_units, verbose=False)
+            if not growing:
+                sys.stdout.write('\nCaustic finished, follow mode stopped.\n')
+                self.follow_file = 0
+                self.follow_timer.stop()
+        except Exception as exception:
+            sys.stdout.write('\nFollow mode stopped: ' + str(exception) + '\n')
+            self.follow_file = 0
+            self.follow_timer.stop()
+    
+    def stop_caustic(self):
+        self.stop_requested = True
+    
+    def list_beamline_elements(self):
+        sys.stdout = EmittingStream(textWritten=self.writeStdOut)
+        
+        if self.input_beam is None:
+            sys.stdout.write('\nNo input beam.\n')
+            return
+        
+        sys.stdout.write('\nBeamline elements (number: widget):\n')
+        for element in history_util.flatten_oe_history(self.input_beam):
+            sys.stdout.write('   {0}: {1} ({2})\n'.format(element['history_index'], element['name'], element['kind']))
+    
+    def run_sweep(self):
+        
+        try:
+            sys.stdout = EmittingStream(textWritten=self.writeStdOut)
+            
+            if ShadowCongruence.checkEmptyBeam(self.input_beam):
+                self.x_nbins = congruence.checkStrictlyPositiveNumber(self.x_nbins, "Number of Bins X")
+                self.y_nbins = congruence.checkStrictlyPositiveNumber(self.y_nbins, "Number of Bins Y")
+                self.nz = congruence.checkStrictlyPositiveNumber(self.nz, "Number of Z Points")
+                self.sweep_npoints = congruence.checkStrictlyPositiveNumber(self.sweep_npoints, "Number of Values")
+                self.sweep_workers = congruence.checkStrictlyPositiveNumber(self.sweep_workers, "Worker Processes")
+                self.sweep_element = congruence.checkPositiveNumber(self.sweep_element, "Element Number")
+                congruence.checkLessThan(self.x_range_min, self.x_range_max, "X range min", "X range max")
+                congruence.checkLessThan(self.y_range_min, self.y_range_max, "Y range min", "Y range max")
+                congruence.checkLessThan(self.z_range_min, self.z_range_max, "Z range min", "Z range max")
+                
+                self.print_date_i()
+                sys.stdout.write("Running Sweep of {0} over element {1}...\n".format(self.sweep_parameter, self.sweep_element))
+                sys.stdout.flush()
+                self.run_shadow_sweep(filename=self.sweep_filename, input_beam=self.input_beam, 
+                                      sweep_element=self.sweep_element, parameter=self.sweep_parameter,
+                                      values=np.linspace(self.sweep_start, self.sweep_stop, self.sweep_npoints),
+                                      workers=self.sweep_workers,
+                                      zStart=self.z_range_min, zFin=self.z_range_max, nz=self.nz,
+                                      colh=self.x_column_index+1, colv=self.y_column_index+1, colref=self.weight_column_index,
+                                      nbinsh=self.x_nbins, nbinsv=self.y_nbins, 
+                                      xrange=[self.x_range_min, self.x_range_max],
+                                      yrange=[self.y_range_min, self.y_range_max])
+                sys.stdout.write('...finished!')
+                self.plot_sweep(self.sweep_filename, xunits=self.x_units, yunits=self.y_units, zunits=self.z_units)
+                self.tabs_plots.setCurrentIndex(2)
+                self.print_date_f()
+        
+        except Exception as exception:
+            QtWidgets.QMessageBox.critical(self, "Error",
+                                       str(exception),
+                                       QtWidgets.QMessageBox.Ok)
+
     def save_2D_plots(self):
 #        sys.stdout = EmittingStream(textWritten=self.writeStdOut)
         filename, ext = os.path.splitext(self.load_filename)
@@ -679,11 +904,12 @@ class CausticWidget(LNLSShadowWidgetC):
             import platform
             
             mayavi_path = os.path.split(__file__)[0] 
+            follow_str = ' --follow' if caustic_util.is_growing_caustic(self.load_filename) else ''
             
             if platform.system() == 'Linux':
-                command_str = "gnome-terminal -e 'bash -c \" python {0} -f {1} ; exec bash\"'".format(os.path.join(mayavi_path, 'volume_slicer_mayavi.py'), os.path.join(os.getcwd(), self.load_filename))
+                command_str = "gnome-terminal -e 'bash -c \" python {0} -f {1}{2} ; exec bash\"'".format(os.path.join(mayavi_path, 'volume_slicer_mayavi.py'), os.path.join(os.getcwd(), self.load_filename), follow_str)
             if platform.system() == 'Windows':
-                command_str = "cmd /c python {0} -f {1} ".format(os.path.join(mayavi_path, 'volume_slicer_mayavi.py'), os.path.join(os.getcwd(), self.load_filename))
+                command_str = "cmd /c python {0} -f {1}{2} ".format(os.path.join(mayavi_path, 'volume_slicer_mayavi.py'), os.path.join(os.getcwd(), self.load_filename), follow_str)
             os.system(command_str)         
             
         except ImportError:
@@ -699,95 +925,10 @@ class CausticWidget(LNLSShadowWidgetC):
 
 
     def calc_rms(self, x, f_x):
-            return np.sqrt(np.sum(f_x*np.square(x))/np.sum(f_x) - (np.sum(f_x*x)/np.sum(f_x))**2)
+        return caustic_util.calc_rms(x, f_x)
     
     def get_fwhm(self, x, y, oversampling=1, zero_padding=False, avg_correction=False, debug=False):
-       
-       
-        def add_zeros(array):
-            aux = []
-            aux.append(0)
-            for i in range(len(array)):
-                aux.append(array[i])
-            aux.append(0)
-            return np.array(aux)
-        
-        def add_steps(array):
-            aux = []
-            step = (np.max(array)-np.min(array))/(len(array)-1)
-            aux.append(array[0]-step)
-            for i in range(len(array)):
-                aux.append(array[i])
-            aux.append(array[-1]+step)
-            return np.array(aux)
-        
-        def interp_distribution(array_x,array_y,oversampling):
-            dist = interp1d(array_x, array_y)
-            x_int = np.linspace(np.min(array_x), np.max(array_x), int(len(x)*oversampling))
-            y_int = dist(x_int)
-            return x_int, y_int 
-        
-        if(oversampling > 1.0):
-            array_x, array_y = interp_distribution(x, y, oversampling)
-        else:
-            array_x, array_y = x, y
-            
-        if(zero_padding):
-            array_x = add_steps(x)
-            array_y = add_zeros(y)
-            
-        try:    
-            y_peak = np.max(array_y)
-            idx_peak = (np.abs(array_y-y_peak)).argmin()
-            #x_peak = array_x[idx_peak]
-            if(idx_peak==0):
-                left_hwhm_idx = 0
-            else:
-                #left_hwhm_idx = (np.abs(array_y[:idx_peak]-y_peak/2)).argmin()
-    #            for i in range(idx_peak,0,-1):
-                for i in range(0,idx_peak):
-    #                if np.abs(array_y[i]-y_peak/2)<np.abs(array_y[i-1]-y_peak/2) and (array_y[i-1]-y_peak/2)<0:
-                    if np.abs(array_y[i]-y_peak/2)>np.abs(array_y[i-1]-y_peak/2) and (array_y[i-1]-y_peak/2)>0:
-                        break                
-                left_hwhm_idx = i     
-                
-            if(idx_peak==len(array_y)-1):
-                right_hwhm_idx = len(array_y)-1
-            else:
-                #right_hwhm_idx = (np.abs(array_y[idx_peak:]-y_peak/2)).argmin() + idx_peak
-    #            for j in range(idx_peak,len(array_y)):
-                for j in range(len(array_y)-2, idx_peak, -1):
-    #                if np.abs(array_y[j]-y_peak/2)<np.abs(array_y[j+1]-y_peak/2) and (array_y[j+1]-y_peak/2)<0:
-                    if np.abs(array_y[j]-y_peak/2)>np.abs(array_y[j+1]-y_peak/2) and (array_y[j+1]-y_peak/2)>0:
-                        break              
-                right_hwhm_idx = j
-                
-            fwhm = array_x[right_hwhm_idx] - array_x[left_hwhm_idx]               
-                
-            if(avg_correction):
-                avg_y = (array_y[left_hwhm_idx]+array_y[right_hwhm_idx])/2.0
-                popt_left = np.polyfit(np.array([array_x[left_hwhm_idx-1],array_x[left_hwhm_idx],array_x[left_hwhm_idx+1]]),
-                                       np.array([array_y[left_hwhm_idx-1],array_y[left_hwhm_idx],array_y[left_hwhm_idx+1]]),1)                                   
-                popt_right = np.polyfit(np.array([array_x[right_hwhm_idx-1],array_x[right_hwhm_idx],array_x[right_hwhm_idx+1]]),
-                                       np.array([array_y[right_hwhm_idx-1],array_y[right_hwhm_idx],array_y[right_hwhm_idx+1]]),1)
-                x_left = (avg_y-popt_left[1])/popt_left[0]
-                x_right = (avg_y-popt_right[1])/popt_right[0]
-                fwhm = x_right - x_left
-                
-                return [fwhm, x_left, x_right, avg_y, avg_y]
-            else:
-                return [fwhm, array_x[left_hwhm_idx], array_x[right_hwhm_idx], array_y[left_hwhm_idx], array_y[right_hwhm_idx]]
-                
-            if(debug):
-                print(y_peak)
-                print(idx_peak)
-                print(left_hwhm_idx, right_hwhm_idx)
-                print(array_x[left_hwhm_idx], array_x[right_hwhm_idx])            
-            
-        except ValueError:
-            fwhm = 0.0        
-            print("Could not calculate fwhm\n")   
-            return [fwhm, 0, 0, 0, 0]
+        return caustic_util.get_fwhm(x, y, oversampling=oversampling, zero_padding=zero_padding, avg_correction=avg_correction, debug=debug)
     
     def find_peak(self, xz):
         zmax = [0, 0]; xmax = [0, 0]
@@ -806,21 +947,10 @@ class CausticWidget(LNLSShadowWidgetC):
         return zmax, xmax
     
     def gaussian_beam(self, z, s0, z0, beta):
-        return s0*np.sqrt(1 + ((z-z0)/beta)**2)
+        return caustic_util.gaussian_beam(z, s0, z0, beta)
     
     def weighted_avg_and_std(self, values, weights):
-        """
-        By EOL - stackoverflow - 10/03/2010
-        Return the weighted average and standard deviation.
-        values, weights -- Numpy ndarrays with the same shape.
-        """
-        try:
-            average = np.average(values, weights=weights)
-            variance = np.average((values-average)**2, weights=weights)  # Fast and numerically precise
-            return (average, np.sqrt(variance))
-        except:
-            print('   Mean and RMS values could not be calculated.')
-            return (np.nan, np.nan)
+        return caustic_util.weighted_avg_and_std(values, weights)
 
     def get_good_ranges(self, beam, zStart, zFin, colh, colv):
         
@@ -904,8 +1034,8 @@ class CausticWidget(LNLSShadowWidgetC):
 
     #def append_dataset_hdf5(self, filename, data, z, zOffset, nz, tag, t0, ndigits):
 
-    def initialize_hdf5(self, h5_filename, zStart, zFin, nz, zOffset, colh, colv, colref, nbinsh, nbinsv, good_rays, offsets=None):
-        with h5py.File(h5_filename, 'w') as f:
+    def initialize_hdf5(self, h5_filename, zStart, zFin, nz, zOffset, colh, colv, colref, nbinsh, nbinsv, good_rays, offsets=None, swmr=False):
+        with h5py.File(h5_filename, 'w', libver='latest' if swmr else None) as f:
             f.attrs['begin time'] = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
             f.attrs['zStart'] = zStart
             f.attrs['zFin'] = zFin
@@ -922,54 +1052,128 @@ class CausticWidget(LNLSShadowWidgetC):
                 f.attrs['offsets'] = offsets
             
     
+    def get_step_attributes(self, data, z, zOffset, t0):
+        
+        attrs = {}
+        attrs['z'] = z + zOffset
+        attrs['xStart'] = data['bin_h_center'].min()
+        attrs['xFin'] = data['bin_h_center'].max()
+        attrs['nx'] = data['nbins_h']
+        attrs['yStart'] = data['bin_v_center'].min()
+        attrs['yFin'] = data['bin_v_center'].max()
+        attrs['ny'] = data['nbins_v']
+        attrs['mean_h'], attrs['rms_h'] = self.weighted_avg_and_std(data['bin_h_center'], data['histogram_h']) 
+        attrs['mean_v'], attrs['rms_v'] = self.weighted_avg_and_std(data['bin_v_center'], data['histogram_v'])
+        attrs['fwhm_h'] = self.get_fwhm(data['bin_h_center'], data['histogram_h'])
+        attrs['fwhm_v'] = self.get_fwhm(data['bin_v_center'], data['histogram_v'])
+        attrs['ellapsed time (s)'] = round(time.time() - t0, 3)
+        
+        try:
+            attrs['fwhm_h_shadow'] = float(data['fwhm_h'])
+            attrs['center_h_shadow'] = (data['fwhm_coordinates_h'][0] + data['fwhm_coordinates_h'][1]) / 2.0
+        except:
+            print('CAUSTIC WARNING: FWHM X could not be calculated by Shadow')
+            attrs['fwhm_h_shadow'] = np.nan
+            attrs['center_h_shadow'] = np.nan
+        try:
+            attrs['fwhm_v_shadow'] = float(data['fwhm_v'])
+            attrs['center_v_shadow'] = (data['fwhm_coordinates_v'][0] + data['fwhm_coordinates_v'][1]) / 2.0
+        except:
+            print('CAUSTIC WARNING: FWHM Y could not be calculated by Shadow')
+            attrs['fwhm_v_shadow'] = np.nan
+            attrs['center_v_shadow'] = np.nan
+        
+        return attrs
+    
     def append_dataset_hdf5(self, filename, data, z, zOffset, nz, tag, t0, ndigits):
         
-        mean_h, rms_h = self.weighted_avg_and_std(data['bin_h_center'], data['histogram_h']) 
-        mean_v, rms_v = self.weighted_avg_and_std(data['bin_v_center'], data['histogram_v'])
-        fwhm_h = self.get_fwhm(data['bin_h_center'], data['histogram_h'])
-        fwhm_v = self.get_fwhm(data['bin_v_center'], data['histogram_v'])
+        t_stats = time.perf_counter()
+        attrs = self.get_step_attributes(data, z, zOffset, t0)
+        t_write = time.perf_counter()
+        t_stats = t_write - t_stats
         
         with h5py.File(filename, 'a') as f:
             dset = f.create_dataset('step_{0:0{ndigits}d}'.format(tag, ndigits=ndigits),
                                     data=np.array(data['histogram'], dtype=np.float), compression="gzip")
-            dset.attrs['z'] = z + zOffset
-            dset.attrs['xStart'] = data['bin_h_center'].min()
-            dset.attrs['xFin'] = data['bin_h_center'].max()
-            dset.attrs['nx'] = data['nbins_h']
-            dset.attrs['yStart'] = data['bin_v_center'].min()
-            dset.attrs['yFin'] = data['bin_v_center'].max()
-            dset.attrs['ny'] = data['nbins_v']
-            dset.attrs['mean_h'] = mean_h
-            dset.attrs['mean_v'] = mean_v
-            dset.attrs['rms_h'] = rms_h
-            dset.attrs['rms_v'] = rms_v
-            dset.attrs['fwhm_h'] = fwhm_h
-            dset.attrs['fwhm_v'] = fwhm_v
-            dset.attrs['ellapsed time (s)'] = round(time.time() - t0, 3)
-            
-            try:
-                dset.attrs['fwhm_h_shadow'] = data['fwhm_h']
-                dset.attrs['center_h_shadow'] = (data['fwhm_coordinates_h'][0] + data['fwhm_coordinates_h'][1]) / 2.0
-            except:
-                print('CAUSTIC WARNING: FWHM X could not be calculated by Shadow')
-                dset.attrs['fwhm_h_shadow'] = np.nan
-                dset.attrs['center_h_shadow'] = np.nan
-            try:
-                dset.attrs['fwhm_v_shadow'] = data['fwhm_v']
-                dset.attrs['center_v_shadow'] = (data['fwhm_coordinates_v'][0] + data['fwhm_coordinates_v'][1]) / 2.0
-            except:
-                print('CAUSTIC WARNING: FWHM Y could not be calculated by Shadow')
-                dset.attrs['fwhm_v_shadow'] = np.nan
-                dset.attrs['center_v_shadow'] = np.nan
+            for key in list(attrs.keys()):
+                dset.attrs[key] = attrs[key]
                 
             if (tag == nz - 1):
                 f.attrs['end time'] = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
+        
+        return t_stats, time.perf_counter() - t_write
+
+    def get_step_names(self, f):
+        """
+        Returns the names of the caustic step datasets, skipping summary datasets and groups.
+        """
+        return sorted([name for name in f.keys() if name.startswith('step_')])
+
+    def get_peak_rss(self):
+        """
+        Returns the peak resident set size of this process [MB], or nan if it cannot be measured.
+        """
+        try:
+            import resource
+            peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            return peak_rss/1024.0**2 if sys.platform == 'darwin' else peak_rss/1024.0 # bytes on macOS, kB on Linux
+        except ImportError: # Windows
+            pass
+        try:
+            import psutil
+            return psutil.Process().memory_info().peak_wset/1024.0**2
+        except (ImportError, AttributeError):
+            return np.nan
+
+    def write_profile_hdf5(self, filename, stage_times, good_rays, t_summary):
+        """
+        Writes the per-stage timing of a caustic run into the 'profile' group of the caustic file.\n
+        :stage_times: array (nz, 4) with retrace, histogram, statistics and write wall times [s] for each step
+        :good_rays: number of good rays traced at each step
+        :t_summary: wall time [s] spent writing the summary (histoXZ, histoYZ and attributes)
+        """
+        
+        stage_names = ['retrace', 'histogram', 'statistics', 'write']
+        stage_totals = stage_times.sum(axis=0)
+        t_compute = stage_totals[0] + stage_totals[1]
+        
+        profile = {stage_names[k] + ' time (s)': stage_totals[k] for k in range(len(stage_names))}
+        profile['summary time (s)'] = t_summary
+        profile['total time (s)'] = np.sum(stage_totals) + t_summary
+        profile['peak RSS (MB)'] = self.get_peak_rss()
+        profile['rays per second'] = good_rays*len(stage_times)/t_compute if t_compute > 0 else np.nan
+        profile['good_rays'] = good_rays
+        
+        with h5py.File(filename, 'a') as f:
+            if 'profile' in f:
+                del f['profile']
+            group = f.create_group('profile')
+            for k, stage in enumerate(stage_names):
+                group.create_dataset(stage, data=stage_times[:,k])
+            for key in list(profile.keys()):
+                group.attrs[key] = profile[key]
+            group.attrs['host'] = platform.node()
+        
+        return profile
+    
+    def print_profile(self, profile):
+        
+        sp = '   '
+        total = profile['total time (s)']
+        text  = '\nTiming summary:\n'
+        for stage in ['retrace', 'histogram', 'statistics', 'write', 'summary']:
+            t = profile[stage + ' time (s)']
+            text += sp + '{0:<11s}: {1:9.3f} s ({2:5.1f} %)\n'.format(stage, t, 100*t/total if total > 0 else 0.0)
+        text += sp + '{0:<11s}: {1:9.3f} s\n'.format('total', total)
+        text += sp + '{0:<11s}: {1:9.1f} MB\n'.format('peak RSS', profile['peak RSS (MB)'])
+        text += sp + '{0:<11s}: {1:9.3e} (retrace + histogram)\n'.format('rays/s', profile['rays per second'])
+        sys.stdout.write(text)
 
     def read_caustic(self, filename, write_attributes=False, plot=False, plot2D=False, print_minimum=False):
         
         with h5py.File(filename, 'r+') as f:
         
-            dset_names = list(f.keys())
+            dset_names = self.get_step_names(f)
             
             center_shadow = np.zeros((len(dset_names), 2), dtype=float)
             center = np.zeros((len(dset_names), 2), dtype=float)
@@ -1074,6 +1278,11 @@ class CausticWidget(LNLSShadowWidgetC):
                    #'histoHZ': histoH,
                    #'histoVZ': histoV}
         
+        bootstrap = self.read_bootstrap(filename)
+        if bootstrap is not None:
+            for key in ['fwhm_h', 'fwhm_v', 'rms_h', 'rms_v', 'mean_h', 'mean_v', 'fwhm_h_shadow', 'fwhm_v_shadow']:
+                outdict[key + '_band'] = bootstrap[key + '_band']
+        
         if(write_attributes):
             with h5py.File(filename, 'a') as f:
                 for key in list(outdict.keys()):
@@ -1163,22 +1372,371 @@ class CausticWidget(LNLSShadowWidgetC):
         
         return outdict
                 
-    def run_shadow_caustic(self, filename, beam, zStart, zFin, nz, zOffset, colh, colv, colref, nbinsh, nbinsv, xrange, yrange):
+    def run_shadow_caustic(self, filename, beam, zStart, zFin, nz, zOffset, colh, colv, colref, nbinsh, nbinsv, xrange, yrange, swmr=False):
+        """
+        Caustic written step by step. With swmr, the file is readable during the run, the plots
+        (follow mode) are refreshed after every step and the Stop button ends the run: the file
+        then holds the steps completed.
+        """
     
         t0 = time.time()
+        self.stop_requested = False
         good_rays = beam.nrays(nolost=1)
-        self.initialize_hdf5(filename, zStart, zFin, nz, zOffset, colh, colv, colref, nbinsh, nbinsv, good_rays)
+        self.initialize_hdf5(filename, zStart, zFin, nz, zOffset, colh, colv, colref, nbinsh, nbinsv, good_rays, swmr=swmr)
         z_points = np.linspace(zStart, zFin, nz)
-        for i in range(nz):        
-            beam.retrace(z_points[i]);
-            histo = beam.histo2(col_h=colh, col_v=colv, nbins_h=nbinsh, nbins_v=nbinsv, nolost=1, ref=colref, xrange=xrange, yrange=yrange);
-            self.append_dataset_hdf5(filename, data=histo, z=z_points[i], zOffset=zOffset, nz=nz, tag=i+1, t0=t0, ndigits=len(str(nz)))
+        if swmr:
+            writer = caustic_util.CausticSWMRWriter(filename, z_points, zOffset, nbinsh, nbinsv, xrange, yrange)
+        stage_times = np.zeros((nz, 4)) # retrace, histogram, statistics, write
+        n_done = nz
+        try:
+            for i in range(nz):        
+                t = time.perf_counter()
+                beam.retrace(z_points[i]);
+                stage_times[i,0] = time.perf_counter() - t
+                t = time.perf_counter()
+                histo = beam.histo2(col_h=colh, col_v=colv, nbins_h=nbinsh, nbins_v=nbinsv, nolost=1, ref=colref, xrange=xrange, yrange=yrange);
+                stage_times[i,1] = time.perf_counter() - t
+                if swmr:
+                    t = time.perf_counter()
+                    attrs = self.get_step_attributes(histo, z_points[i], zOffset, t0)
+                    stage_times[i,2] = time.perf_counter() - t
+                    t = time.perf_counter()
+                    writer.write_step(i, histo['histogram'], attrs)
+                    stage_times[i,3] = time.perf_counter() - t
+                    QtWidgets.QApplication.processEvents() # lets the follow mode refresh the plots
+                    if self.stop_requested:
+                        n_done = i + 1
+                        sys.stdout.write('\nStopped by user after step {0} of {1}.'.format(n_done, nz))
+                        break
+                else:
+                    stage_times[i,2:] = self.append_dataset_hdf5(filename, data=histo, z=z_points[i], zOffset=zOffset, nz=nz, tag=i+1, t0=t0, ndigits=len(str(nz)))
+        finally:
+            if swmr:
+                writer.close()
+        t = time.perf_counter()
+        if swmr:
+            caustic_util.finalize_swmr_caustic(filename)
+            if n_done < nz:
+                caustic_util.truncate_caustic(filename, n_done)
+        self.read_caustic(filename, write_attributes=True)
+        if swmr:
+            caustic_util.remove_swmr_datasets(filename)
+        self.profile = self.write_profile_hdf5(filename, stage_times[:n_done], good_rays, time.perf_counter() - t)
+    
+    def run_shadow_caustic_progressive(self, filename, beam, zStart, zFin, nz, zOffset, colh, colv, colref, nbinsh, nbinsv, 
+                                       xrange, yrange, first_fraction=0.02, npasses=6, seed=0):
+        """
+        Caustic computed in passes over growing random subsets of the good rays. Each pass traces only 
+        the rays not used before and adds them to the same histograms, so the last pass reproduces the 
+        full caustic. Plots are refreshed after every pass and the run can be stopped with the Stop 
+        button; the file is written with the rays used in the completed passes, with the seed of the
+        ray order and the profile of the run.\n
+        :first_fraction: fraction of the good rays used in the first pass
+        :npasses: number of passes (the fractions grow geometrically up to 1)
+        :seed: seed of the ray order, 0 for a new seed
+        """
+        
+        t0 = time.time()
+        self.stop_requested = False
+        self.profile = None
+        if seed == 0:
+            seed = int(np.random.SeedSequence().entropy % 2**32)
+        
+        good_index = np.where(beam.rays[:,9] > 0)[0]
+        good_rays = len(good_index)
+        ray_order = good_index[np.random.default_rng(seed).permutation(good_rays)]
+        ray_counts = caustic_util.progressive_ray_counts(good_rays, first_fraction, npasses)
+        z_points = np.linspace(zStart, zFin, nz)
+        
+        histograms = np.zeros((nz, nbinsh, nbinsv))
+        stage_times = np.zeros((nz, 4)) # retrace, histogram, statistics, write
+        n_used = 0
+        for n_pass, n_total in enumerate(ray_counts):
+            
+            beam_pass = Shadow.Beam()
+            beam_pass.rays = beam.rays[ray_order[n_used:n_total]].copy()
+            
+            # each step is added in place; a pass stopped at step i is taken out of the steps before i
+            for i in range(nz):
+                t = time.perf_counter()
+                beam_pass.retrace(z_points[i])
+                stage_times[i,0] += time.perf_counter() - t
+                t = time.perf_counter()
+                histo = beam_pass.histo2(col_h=colh, col_v=colv, nbins_h=nbinsh, nbins_v=nbinsv, nolost=1, ref=colref, xrange=xrange, yrange=yrange)
+                histograms[i] += histo['histogram']
+                stage_times[i,1] += time.perf_counter() - t
+                QtWidgets.QApplication.processEvents()
+                if self.stop_requested:
+                    for j in range(i + 1):
+                        beam_pass.retrace(z_points[j])
+                        histograms[j] -= beam_pass.histo2(col_h=colh, col_v=colv, nbins_h=nbinsh, nbins_v=nbinsv, nolost=1, ref=colref,
+                                                          xrange=xrange, yrange=yrange)['histogram']
+                    break
+            
+            if self.stop_requested:
+                sys.stdout.write('\nStopped by user during pass {0}.'.format(n_pass+1))
+                break
+            
+            bin_h_center, bin_v_center = histo['bin_h_center'], histo['bin_v_center']
+            n_used = n_total
+            sys.stdout.write('\n   pass {0}/{1}: {2} of {3} rays ({4:.1f} %)'.format(n_pass+1, len(ray_counts), n_used, good_rays, 100.0*n_used/good_rays))
+            self.plot_progressive(z_points, histograms, bin_h_center, bin_v_center, n_used, good_rays,
+                                  xunits=self.x_units, yunits=self.y_units, zunits=self.z_units)
+            QtWidgets.QApplication.processEvents()
+        
+        if n_used == 0:
+            sys.stdout.write('\nNo pass completed, file not written.')
+            return
+        
+        self.initialize_hdf5(filename, zStart, zFin, nz, zOffset, colh, colv, colref, nbinsh, nbinsv, n_used)
+        for i in range(nz):
+            histo = caustic_util.make_histo2_ticket(histograms[i], bin_h_center, bin_v_center)
+            stage_times[i,2:] = self.append_dataset_hdf5(filename, data=histo, z=z_points[i], zOffset=zOffset, nz=nz, tag=i+1, t0=t0, ndigits=len(str(nz)))
+        t = time.perf_counter()
         self.read_caustic(filename, write_attributes=True)
+        
+        with h5py.File(filename, 'a') as f:
+            f.attrs['progressive fraction'] = n_used/good_rays
+            f.attrs['progressive total rays'] = good_rays
+            f.attrs['progressive seed'] = seed
+        self.profile = self.write_profile_hdf5(filename, stage_times, n_used, time.perf_counter() - t)
+    
+    def run_bootstrap(self, filename, beam, zStart, zFin, nz, colh, colv, colref, nbinsh, nbinsv, xrange, yrange,
+                      nreplicates=100, confidence=95.0, workers=4):
+        """
+        Bootstrap uncertainties of the caustic curves, resampling the ray weights with Poisson(1) counts.
+        Blocks of z steps run in worker processes. Results go to the 'bootstrap' group of the caustic file:
+        replicate curves (nreplicates, nz), their confidence bands (2, nz) and the fitted waist of every 
+        replicate (nreplicates, 5) with its band (2, 5).\n
+        :nreplicates: number of bootstrap replicates
+        :confidence: confidence level of the bands [%]
+        :workers: number of worker processes
+        """
+        
+        rays = beam.rays[beam.rays[:,9] > 0]
+        z_points = np.linspace(zStart, zFin, nz)
+        z_blocks = [block for block in np.array_split(np.arange(nz), workers) if len(block) > 0]
+        seed = int(np.random.SeedSequence().entropy % 2**32)
+        
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+            futures = [executor.submit(caustic_util.bootstrap_z_block, rays, z_points[block], colh, colv, colref,
+                                       nbinsh, nbinsv, xrange, yrange, nreplicates, seed) for block in z_blocks]
+            results = [future.result() for future in futures]
+        
+        percentiles = [(100.0 - confidence)/2.0, (100.0 + confidence)/2.0]
+        with h5py.File(filename, 'a') as f:
+            if 'bootstrap' in f:
+                del f['bootstrap']
+            group = f.create_group('bootstrap')
+            group.attrs['replicates'] = nreplicates
+            group.attrs['confidence'] = confidence
+            group.attrs['seed'] = seed
+            
+            for key in list(results[0].keys()):
+                curves = np.concatenate([result[key] for result in results], axis=1)
+                group.create_dataset(key, data=curves)
+                group.create_dataset(key + '_band', data=np.nanpercentile(curves, percentiles, axis=0))
+                
+                if key.startswith('fwhm') or key.startswith('rms'):
+                    waists = np.array([caustic_util.get_waist(z_points, curve) for curve in curves])
+                    waists[:,4] = np.abs(waists[:,4]) # beta enters squared
+                    dset = group.create_dataset('waist_' + key, data=waists)
+                    dset.attrs['columns'] = 'minimum size, z of minimum size, fitted s0, fitted z0, fitted beta'
+                    group.create_dataset('waist_' + key + '_band', data=np.nanpercentile(waists, percentiles, axis=0))
+        
+            for key, label in [('waist_fwhm_h', 'X FWHM'), ('waist_fwhm_v', 'Y FWHM')]:
+                band = np.array(group[key + '_band'])
+                sys.stdout.write('\n   {0} waist ({1:.0f} %): size [{2:.6g}, {3:.6g}], z [{4:.6g}, {5:.6g}]'.format(
+                                 label, confidence, band[0,2], band[1,2], band[0,3], band[1,3]))
+    
+    def read_bootstrap(self, filename):
+        """
+        Returns the 'bootstrap' group of a caustic file as a dict of arrays, or None if the file has no bootstrap.
+        """
+        with h5py.File(filename, 'r') as f:
+            if not 'bootstrap' in f:
+                return None
+            bootstrap = {key: np.array(f['bootstrap'][key]) for key in f['bootstrap'].keys()}
+            bootstrap['confidence'] = f['bootstrap'].attrs['confidence']
+        return bootstrap
+    
+    def plot_bootstrap_band(self, ax, z_points, bootstrap, key, factor, zf, color='C0'):
+        if bootstrap is None:
+            return
+        band = bootstrap[key + '_band']*factor
+        ax.fill_between(z_points*zf, band[0], band[1], color=color, alpha=0.2, linewidth=0,
+                        label='{0:.0f} % band'.format(bootstrap['confidence']))
+        if 'waist_' + key + '_band' in bootstrap:
+            waist = np.nanmedian(bootstrap['waist_' + key], axis=0)
+            waist_band = bootstrap['waist_' + key + '_band']
+            ax.errorbar(waist[3]*zf, waist[2]*factor, 
+                        xerr=[[(waist[3]-waist_band[0,3])*zf], [(waist_band[1,3]-waist[3])*zf]],
+                        yerr=[[(waist[2]-waist_band[0,2])*factor], [(waist_band[1,2]-waist[2])*factor]],
+                        fmt='s', color=color, markersize=4, capsize=3, alpha=0.8, label='fitted waist')
     
+    def plot_progressive(self, z_points, histograms, bin_h_center, bin_v_center, n_used, good_rays, xunits=0, yunits=0, zunits=0):
+        
+        labels_xy = ['mm', '\u00B5m', 'nm']
+        factors_xy = [1.0, 1e3, 1e6]
+        labels_z = ['m', 'mm', '\u00B5m', 'nm']
+        factors_z = [1e-3, 1.0, 1e3, 1e6]
+        xf, yf, zf = factors_xy[xunits], factors_xy[yunits], factors_z[zunits]
+        
+        histoHZ = histograms.sum(axis=2).T
+        histoVZ = histograms.sum(axis=1).T
+        fwhm = np.zeros((len(z_points), 2))
+        rms = np.zeros((len(z_points), 2))
+        for i in range(len(z_points)):
+            fwhm[i,0] = caustic_util.get_fwhm(bin_h_center, histoHZ[:,i])[0]
+            fwhm[i,1] = caustic_util.get_fwhm(bin_v_center, histoVZ[:,i])[0]
+            rms[i,0] = caustic_util.weighted_avg_and_std(bin_h_center, histoHZ[:,i])[1]
+            rms[i,1] = caustic_util.weighted_avg_and_std(bin_v_center, histoVZ[:,i])[1]
+        
+        title = '{0:.1f} % of {1} rays'.format(100.0*n_used/good_rays, good_rays)
+        
+        for ax, histo, bins, label, units, factor in [(self.axXZ, histoHZ, bin_h_center, 'X', labels_xy[xunits], xf), 
+                                                      (self.axYZ, histoVZ, bin_v_center, 'Y', labels_xy[yunits], yf)]:
+            ax.clear()
+            ax.imshow(histo, extent=[z_points[0]*zf, z_points[-1]*zf, bins[0]*factor, bins[-1]*factor], aspect='auto', origin='lower')
+            ax.set_xlabel('Z ' + '[' + labels_z[zunits] + ']')
+            ax.set_ylabel(label + ' [' + units + ']')
+            ax.set_title(title)
+            ax.minorticks_on()
+            ax.tick_params(which='both', axis='both', direction='out', right=True, top=True)
+        
+        for ax, curve, label, units in [(self.ax11, fwhm[:,0]*xf, 'X FWHM', labels_xy[xunits]), (self.ax12, fwhm[:,1]*yf, 'Y FWHM', labels_xy[yunits]),
+                                        (self.ax21, rms[:,0]*xf, 'X RMS', labels_xy[xunits]), (self.ax22, rms[:,1]*yf, 'Y RMS', labels_xy[yunits])]:
+            ax.clear()
+            ax.plot(z_points*zf, curve, '-o', alpha=0.6)
+            ax.set_xlabel('Z ' + '[' + labels_z[zunits] + ']')
+            ax.set_ylabel(label + ' [' + units + ']')
+            ax.set_title(title)
+            ax.minorticks_on()
+            ax.tick_params(which='both', axis='both', direction='in', right=True, top=True)
+            ax.grid(which='both', alpha=0.1)
+        
+        self.figureXZ.canvas.draw()
+        self.figureYZ.canvas.draw()
+        self.figure11.canvas.draw()
+        self.figure12.canvas.draw()
+        self.figure21.canvas.draw()
+        self.figure22.canvas.draw()
+    
+    def run_shadow_sweep(self, filename, input_beam, sweep_element, parameter, values, workers,
+                         zStart, zFin, nz, colh, colv, colref, nbinsh, nbinsv, xrange, yrange):
+        """
+        Re-traces the beamline for each value of a SHADOW variable of one element and runs a summary 
+        caustic for each of them in worker processes. Only summary curves and waist metrics are saved.\n
+        :sweep_element: element number in the beamline history (0 = source)
+        :parameter: SHADOW variable name of the element, e.g. 'RMIRR' or 'RX_SLIT[0]'
+        :values: array of values of the parameter
+        :workers: number of worker processes
+        """
+        
+        caustic_kwargs = {'zStart':zStart, 'zFin':zFin, 'nz':nz, 'colh':colh, 'colv':colv, 'colref':colref,
+                          'nbinsh':nbinsh, 'nbinsv':nbinsv, 'xrange':xrange, 'yrange':yrange}
+        
+        begin_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
+        elements = history_util.flatten_oe_history(input_beam)
+        results = [None]*len(values)
+        
+        with tempfile.TemporaryDirectory() as start_files_dir:
+            descriptors = history_util.write_history_files(elements, start_files_dir)
+            start = history_util.first_element_of(descriptors, sweep_element)
+            element_name = descriptors[start]['name']
+            input_rays = elements[start]['input_rays']
+            if descriptors[start]['kind'] != 'source' and input_rays is None: # trace from the source
+                start = 0
+                
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+                futures = {executor.submit(caustic_util.run_sweep_point, descriptors, input_rays, start, 
+                                           sweep_element, parameter, value, caustic_kwargs): k for k, value in enumerate(values)}
+                for n_done, future in enumerate(as_completed(futures)):
+                    k = futures[future]
+                    results[k] = future.result()
+                    sys.stdout.write('   {0} = {1:.6g} done ({2}/{3})\n'.format(parameter, values[k], n_done+1, len(values)))
+                    QtWidgets.QApplication.processEvents()
+        
+        with h5py.File(filename, 'w') as f:
+            f.attrs['parameter'] = parameter
+            f.attrs['element'] = sweep_element
+            f.attrs['element name'] = element_name
+            f.attrs['zStart'] = zStart
+            f.attrs['zFin'] = zFin
+            f.attrs['nz'] = nz
+            f.attrs['col_h'] = colh
+            f.attrs['col_v'] = colv
+            f.attrs['col_ref'] = colref
+            f.attrs['nbins_h'] = nbinsh
+            f.attrs['nbins_v'] = nbinsv
+            f.attrs['begin time'] = begin_time
+            f.attrs['end time'] = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
+            
+            f.create_dataset('parameter_values', data=values)
+            f.create_dataset('z_points', data=results[0]['z_points'])
+            f.create_dataset('good_rays', data=np.array([result['good_rays'] for result in results]))
+            for key in ['mean_h', 'mean_v', 'rms_h', 'rms_v', 'fwhm_h', 'fwhm_v']:
+                f.create_dataset(key, data=np.array([result[key] for result in results]))
+            for key in ['waist_fwhm_h', 'waist_fwhm_v', 'waist_rms_h', 'waist_rms_v']:
+                dset = f.create_dataset(key, data=np.array([result[key] for result in results]))
+                dset.attrs['columns'] = 'minimum size, z of minimum size, fitted s0, fitted z0, fitted beta'
+    
+    def plot_sweep(self, filename, xunits=0, yunits=0, zunits=0):
+        
+        labels_xy = ['mm', '\u00B5m', 'nm']
+        factors_xy = [1.0, 1e3, 1e6]
+        labels_z = ['m', 'mm', '\u00B5m', 'nm']
+        factors_z = [1e-3, 1.0, 1e3, 1e6]
+        xf, yf, zf = factors_xy[xunits], factors_xy[yunits], factors_z[zunits]
+        
+        with h5py.File(filename, 'r') as f:
+            parameter = f.attrs['parameter']
+            values = np.array(f['parameter_values'])
+            z_points = np.array(f['z_points'])
+            fwhm_h = np.array(f['fwhm_h'])
+            fwhm_v = np.array(f['fwhm_v'])
+            waist_h = np.array(f['waist_fwhm_h'])
+            waist_v = np.array(f['waist_fwhm_v'])
+        
+        for ax, fwhm, waist, label, units, factor in [(self.ax_sweepH, fwhm_h, waist_h, 'X', labels_xy[xunits], xf), 
+                                                      (self.ax_sweepV, fwhm_v, waist_v, 'Y', labels_xy[yunits], yf)]:
+            ax.clear()
+            if len(values) > 1:
+                ax.pcolormesh(values, z_points*zf, fwhm.T*factor, shading='nearest')
+                ax.plot(values, waist[:,1]*zf, 'w-o', markersize=3, alpha=0.8, label='minimum')
+                ax.legend(loc='best', fontsize=8)
+            ax.set_xlabel(parameter)
+            ax.set_ylabel('Z ' + '[' + labels_z[zunits] + ']')
+            ax.set_title(label + ' FWHM ' + '[' + units + ']')
+            ax.minorticks_on()
+            ax.tick_params(which='both', axis='both', direction='out', right=True, top=True)
+
+        self.ax_waist_size.clear()
+        self.ax_waist_size.plot(values, waist_h[:,0]*xf, '-o', label='X [' + labels_xy[xunits] + ']', alpha=0.6)
+        self.ax_waist_size.plot(values, waist_v[:,0]*yf, '-o', label='Y [' + labels_xy[yunits] + ']', alpha=0.6)
+        self.ax_waist_size.set_xlabel(parameter)
+        self.ax_waist_size.set_ylabel('Minimum FWHM')
+        
+        self.ax_waist_z.clear()
+        self.ax_waist_z.plot(values, waist_h[:,1]*zf, '-o', label='X', alpha=0.6)
+        self.ax_waist_z.plot(values, waist_v[:,1]*zf, '-o', label='Y', alpha=0.6)
+        self.ax_waist_z.set_xlabel(parameter)
+        self.ax_waist_z.set_ylabel('Waist Z ' + '[' + labels_z[zunits] + ']')
+        
+        for ax in [self.ax_waist_size, self.ax_waist_z]:
+            ax.minorticks_on()
+            ax.tick_params(which='both', axis='both', direction='in', right=True, top=True)
+            ax.grid(which='both', alpha=0.1)
+            ax.legend(loc='best', fontsize=8)
+        
+        self.figure_sweepH.canvas.draw()
+        self.figure_sweepV.canvas.draw()
+        self.figure_waist.canvas.draw()
+
     def plot_quick_preview(self, filename, scale=0, 
-                            xrange=[0,0], yrange=[0,0], zrange=[0,0], zrangeXZ=[0,0], zrangeYZ=[0,0], xunits=0, yunits=0, zunits=0):
+                            xrange=[0,0], yrange=[0,0], zrange=[0,0], zrangeXZ=[0,0], zrangeYZ=[0,0], xunits=0, yunits=0, zunits=0, verbose=True):
     
-        self.print_date_i()     
+        if(verbose): self.print_date_i()     
         
         if(xunits==0): 
             ylabelXZ = 'mm'
@@ -1223,38 +1781,61 @@ class CausticWidget(LNLSShadowWidgetC):
             xlabelXZ = 'nm'
             zf=1e6
             
-        with h5py.File(filename, 'r+') as f:
+        growing = caustic_util.is_growing_caustic(filename)
+        
+        if(growing): # SWMR file still being written
+            
+            caustic = caustic_util.read_growing_caustic(filename)
+            zStart, zFin, nz = caustic['zStart'], caustic['zFin'], caustic['nz']
+            z_points = np.linspace(zStart, zFin, nz)
+            xmin, xmax = caustic['xStart'], caustic['xFin']
+            ymin, ymax = caustic['yStart'], caustic['yFin']
+            rms_h_array = caustic['rms_h_array']
+            rms_v_array = caustic['rms_v_array']
+            fwhm_h_array = caustic['fwhm_h_array']
+            fwhm_v_array = caustic['fwhm_v_array']
+            fwhm_shadow_h_array = caustic['fwhm_shadow_h_array']
+            fwhm_shadow_v_array = caustic['fwhm_shadow_v_array']
+            histoHZ = caustic['histoXZ']
+            histoVZ = caustic['histoYZ']
+            self.time_string = caustic['begin time']
+            if(verbose): sys.stdout.write('\n{0} of {1} steps written\n'.format(caustic['progress'], nz))
+        
+        else:
+            with h5py.File(filename, 'r+') as f:
             
-            dset_names = list(f.keys())
+                dset_names = self.get_step_names(f)
             
-            if not 'histoXZ' in dset_names:
+                if not 'histoXZ' in f:
                 
-                QtWidgets.QMessageBox.critical(self, "Error",
-                                           "This caustic hdf5 file is not compatible with quick preview.",
-                                           QtWidgets.QMessageBox.Ok) 
-                return 0
+                    QtWidgets.QMessageBox.critical(self, "Error",
+                                               "This caustic hdf5 file is not compatible with quick preview.",
+                                               QtWidgets.QMessageBox.Ok) 
+                    return 0
             
-            zStart = f.attrs['zStart']
-            zFin = f.attrs['zFin']
-            nz = f.attrs['nz']
-            z_points = np.linspace(zStart, zFin, nz)
+                zStart = f.attrs['zStart']
+                zFin = f.attrs['zFin']
+                nz = f.attrs['nz']
+                z_points = np.linspace(zStart, zFin, nz)
 
             
-            xmin = f[dset_names[3]].attrs['xStart'] # [3] is because [0] is a histogram 2D
-            xmax = f[dset_names[3]].attrs['xFin']
-            ymin = f[dset_names[3]].attrs['yStart']
-            ymax = f[dset_names[3]].attrs['yFin']
+                xmin = f[dset_names[0]].attrs['xStart']
+                xmax = f[dset_names[0]].attrs['xFin']
+                ymin = f[dset_names[0]].attrs['yStart']
+                ymax = f[dset_names[0]].attrs['yFin']
             
-            rms_h_array = f.attrs['rms_h_array']
-            rms_v_array = f.attrs['rms_v_array']
-            fwhm_h_array = f.attrs['fwhm_h_array']            
-            fwhm_v_array = f.attrs['fwhm_v_array']        
-            fwhm_shadow_h_array = f.attrs['fwhm_shadow_h_array']            
-            fwhm_shadow_v_array = f.attrs['fwhm_shadow_v_array']
-            histoHZ = np.array(f['histoXZ'])
-            histoVZ = np.array(f['histoYZ'])
+                rms_h_array = f.attrs['rms_h_array']
+                rms_v_array = f.attrs['rms_v_array']
+                fwhm_h_array = f.attrs['fwhm_h_array']            
+                fwhm_v_array = f.attrs['fwhm_v_array']        
+                fwhm_shadow_h_array = f.attrs['fwhm_shadow_h_array']            
+                fwhm_shadow_v_array = f.attrs['fwhm_shadow_v_array']
+                histoHZ = np.array(f['histoXZ'])
+                histoVZ = np.array(f['histoYZ'])
             
-            self.time_string = f.attrs['end time']
+                self.time_string = f.attrs['end time']
+        
+        bootstrap = None if growing else self.read_bootstrap(filename)
             
         self.axXZ.clear()
         self.axXZ.set_xlabel('Z ' + '[' + xlabelXZ + ']')
@@ -1307,6 +1888,7 @@ class CausticWidget(LNLSShadowWidgetC):
         self.ax11.clear()
         self.ax11.plot(z_points*zf, fwhm_h_array*xf, '-o', label='internal', alpha=0.6)
         self.ax11.plot(z_points*zf, fwhm_shadow_h_array*xf, '-o', label='shadow', alpha=0.3)
+        self.plot_bootstrap_band(self.ax11, z_points, bootstrap, 'fwhm_h', xf, zf)
         #if not(popt1[0]==0 and popt1[1]==0 and popt1[2]==0): 
         #    self.ax11.plot(z_points[flXZ]*zf, self.gaussian_beam(z_points[flXZ], popt1[0], popt1[1], popt1[2])*xf, 'C0--', alpha=0.8)
         #if not(popt3[0]==0 and popt3[1]==0 and popt3[2]==0): 
@@ -1323,6 +1905,7 @@ class CausticWidget(LNLSShadowWidgetC):
         self.ax12.clear()
         self.ax12.plot(z_points*zf, fwhm_v_array*yf, '-o', label='internal', alpha=0.6)
         self.ax12.plot(z_points*zf, fwhm_shadow_v_array*yf, '-o', label='shadow', alpha=0.3)
+        self.plot_bootstrap_band(self.ax12, z_points, bootstrap, 'fwhm_v', yf, zf)
         #if not(popt4[0]==0 and popt4[1]==0 and popt4[2]==0): 
         #    self.ax12.plot(z_points[flYZ]*zf, self.gaussian_beam(z_points[flYZ], popt4[0], popt4[1], popt4[2])*yf, 'C0--', alpha=0.8)
         #if not(popt6[0]==0 and popt6[1]==0 and popt6[2]==0): 
@@ -1339,6 +1922,7 @@ class CausticWidget(LNLSShadowWidgetC):
 #        plt.figure()
         self.ax21.clear()
         self.ax21.plot(z_points*zf, rms_h_array*xf, '-o', alpha=0.6)
+        self.plot_bootstrap_band(self.ax21, z_points, bootstrap, 'rms_h', xf, zf)
         #if not(popt2[0]==0 and popt2[1]==0 and popt2[2]==0): 
         #    self.ax21.plot(z_points[flXZ]*zf, self.gaussian_beam(z_points[flXZ], popt2[0], popt2[1], popt2[2])*xf, 'k--', alpha=0.6)
         self.ax21.set_xlabel('Z ' + '[' + xlabelXZ + ']')
@@ -1351,6 +1935,7 @@ class CausticWidget(LNLSShadowWidgetC):
 #        plt.figure()
         self.ax22.clear()
         self.ax22.plot(z_points*zf, rms_v_array*yf, '-o', alpha=0.6)
+        self.plot_bootstrap_band(self.ax22, z_points, bootstrap, 'rms_v', yf, zf)
         #if not(popt5[0]==0 and popt5[1]==0 and popt5[2]==0): 
         #    self.ax22.plot(z_points[flYZ]*zf, self.gaussian_beam(z_points[flYZ], popt5[0], popt5[1], popt5[2])*yf, 'k--', alpha=0.6)
         self.ax22.set_xlabel('Z ' + '[' + xlabelYZ + ']')
@@ -1384,7 +1969,7 @@ class CausticWidget(LNLSShadowWidgetC):
         self.figure21.canvas.draw()
         self.figure22.canvas.draw()
             
-        self.print_date_f()    
+        if(verbose): self.print_date_f()
 
     
     def plot_shadow_caustic(self, filename, cut_pos_x=0.0, cut_pos_y=0.0, cut_pos_z=0.0, nx=0, ny=0, scale=0, 
@@ -1441,8 +2026,7 @@ class CausticWidget(LNLSShadowWidgetC):
             zFin = f.attrs['zFin']
             nz = f.attrs['nz']
             z_points = np.linspace(zStart, zFin, nz)
-            dset_names = list(f.keys())
-            del dset_names[0:2] # bug correction for new caustic
+            dset_names = self.get_step_names(f)
             z_to_plot = z_points[np.abs(z_points - cut_pos_z/zf).argmin()]
             self.time_string = f.attrs['end time']
             
@@ -1690,6 +2274,7 @@ class CausticWidget(LNLSShadowWidgetC):
         self.ax11.clear()
         self.ax11.plot(z_points*zf, x_properties[0]*xf, '-o', label='cut', alpha=0.6)
         self.ax11.plot(z_points*zf, x_properties[4]*xf, '-o', label='histogram', alpha=0.3)
+        self.plot_bootstrap_band(self.ax11, z_points, self.read_bootstrap(filename), 'fwhm_h_shadow', xf, zf, color='C1')
         if not(popt1[0]==0 and popt1[1]==0 and popt1[2]==0): 
             self.ax11.plot(z_points[flXZ]*zf, self.gaussian_beam(z_points[flXZ], popt1[0], popt1[1], popt1[2])*xf, 'C0--', alpha=0.8)
         if not(popt3[0]==0 and popt3[1]==0 and popt3[2]==0): 
@@ -1706,6 +2291,7 @@ class CausticWidget(LNLSShadowWidgetC):
         self.ax12.clear()
         self.ax12.plot(z_points*zf, y_properties[0]*yf, '-o', label='cut', alpha=0.6)
         self.ax12.plot(z_points*zf, y_properties[4]*yf, '-o', label='histogram', alpha=0.3)
+        self.plot_bootstrap_band(self.ax12, z_points, self.read_bootstrap(filename), 'fwhm_v_shadow', yf, zf, color='C1')
         if not(popt4[0]==0 and popt4[1]==0 and popt4[2]==0): 
             self.ax12.plot(z_points[flYZ]*zf, self.gaussian_beam(z_points[flYZ], popt4[0], popt4[1], popt4[2])*yf, 'C0--', alpha=0.8)
         if not(popt6[0]==0 and popt6[1]==0 and popt6[2]==0): 
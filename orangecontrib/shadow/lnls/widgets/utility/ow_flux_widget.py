@@ -4,6 +4,7 @@ import os
 import sys
 import time
 import numpy
+import h5py
 
 
 from orangewidget import gui, widget
@@ -24,23 +25,14 @@ from orangecontrib.shadow.util.shadow_objects import ShadowBeam
 
 import Shadow.ShadowTools as st
 from orangecontrib.shadow.util.shadow_util import ShadowCongruence
+from orangecontrib.shadow.lnls.util import flux_util, history_util
 
 
 try:
-    from scipy.interpolate import interp1d
-    from scipy.integrate import simps
-    from scipy.special import kv
-    from scipy.integrate import quad
     import scipy.constants as codata
 except ImportError:
     raise ImportError('FLUX needs module scipy')
     
-try:    
-    from oasys_srw.srwlib import SRWLMagFldU, SRWLMagFldH, SRWLPartBeam, SRWLStokes, srwl
-    #from oasys_srw.srwlpy import CalcStokesUR
-except ImportError:
-    raise ImportError('FLUX needs module srwlib and srwlpy')
-    
 class FluxWidget(LNLSShadowWidget):
     name = "Flux"
     description = "Calculate flux and power at any position"
@@ -62,6 +54,8 @@ class FluxWidget(LNLSShadowWidget):
     plot_canvas3=None
     plot_canvas4=None    
     input_beam=None
+    accumulator=None
+    beam_version=0
     
     retrive_source_parameters = Setting(False)
 
@@ -82,6 +76,7 @@ class FluxWidget(LNLSShadowWidget):
     en_spread=Setting(0.085e-2)
     max_h=Setting(9)
     prec=Setting(1.0)      
+    harmonic_decomposition=Setting(0)
     
     sigma_x=Setting(19.1e-3)
     sigma_z=Setting(2.0e-3)
@@ -93,6 +88,8 @@ class FluxWidget(LNLSShadowWidget):
     lim_f_z=Setting(0)
       
     number_of_bins=Setting(101)     
+    binning_mode=Setting(0)
+    target_precision=Setting(0.0)
              
     inten=Setting(0)
     nrays=Setting(0)
@@ -105,6 +102,30 @@ class FluxWidget(LNLSShadowWidget):
     showpower=Setting(0)
     output_filename=Setting("output.dat")
     fig_filename=Setting("output.png")
+    use_spectrum_cache=Setting(1)
+    spectrum_cache_size=Setting(500.0)
+    srw_workers=Setting(1)
+    accumulation_grid=Setting(0)
+    accumulation_e_min=Setting(0.0)
+    accumulation_e_max=Setting(0.0)
+    density_maps=Setting(0)
+    map_nbins_h=Setting(101)
+    map_nbins_v=Setting(101)
+    map_range=Setting(0)
+    map_h_min=Setting(0.0)
+    map_h_max=Setting(0.0)
+    map_v_min=Setting(0.0)
+    map_v_max=Setting(0.0)
+    map_filename=Setting("density_maps.h5")
+    scan_start=Setting(9000.0)
+    scan_stop=Setting(11000.0)
+    scan_npoints=Setting(11)
+    scan_source=Setting(1)
+    scan_bandwidth=Setting(10.0)
+    scan_crystals=Setting("")
+    scan_spectrum_points=Setting(2001)
+    scan_workers=Setting(4)
+    scan_filename=Setting("energy_scan.h5")
    
     def __init__(self):
         super().__init__()
@@ -124,6 +145,10 @@ class FluxWidget(LNLSShadowWidget):
         ### Tabs inside control area ###
         tab_gen = oasysgui.createTabPage(self.tabs_setting, "Source Settings")
         tab_config = oasysgui.createTabPage(self.tabs_setting, "Calculation Settings" )
+        tab_cache = oasysgui.createTabPage(self.tabs_setting, "Performance")
+        tab_keep = oasysgui.createTabPage(self.tabs_setting, "Accumulation")
+        tab_maps = oasysgui.createTabPage(self.tabs_setting, "Density Maps")
+        tab_scan = oasysgui.createTabPage(self.tabs_setting, "Energy Scan")
 
         ### Source Setting tab (tab_gen) ###    
         screen_box = oasysgui.widgetBox(tab_gen, "Source Description", addSpace=True, orientation="vertical", height=500)
@@ -214,15 +239,23 @@ class FluxWidget(LNLSShadowWidget):
         self.le_pr = oasysgui.lineEdit(self.kind_of_source_box_1_3, self, "prec", "Precision (>1)",
                            labelWidth=260, valueType=float, orientation="horizontal")
         
+        gui.checkBox(self.kind_of_source_box_1_3, self, "harmonic_decomposition", "Calculate and cache each harmonic separately")
+        
         ### Call set_Source function ###
         self.set_Source()
         
         ### Calculation Settings tab (tab_config) ###  
-        config_box = oasysgui.widgetBox(tab_config, "Define Flux Calculation Settings", addSpace=True, orientation="vertical", height=200)
+        config_box = oasysgui.widgetBox(tab_config, "Define Flux Calculation Settings", addSpace=True, orientation="vertical", height=260)
         
         self.nb = oasysgui.lineEdit(config_box, self, "number_of_bins", "Number of Bins", 
                           labelWidth=220, valueType=int, controlWidth=100, orientation="horizontal")        
         
+        gui.comboBox(config_box, self, "binning_mode", label="Energy Binning", items=["Fixed", "Equal Count", "Bayesian Blocks"],
+                     labelWidth=220, orientation="horizontal")
+        
+        oasysgui.lineEdit(config_box, self, "target_precision", "Target Rel. Error of Transmission (0=off)", 
+                          labelWidth=260, valueType=float, controlWidth=60, orientation="horizontal")
+        
         self.mxa = oasysgui.lineEdit(config_box, self, "lim_i_x", "Source Acceptance -X [rad] ", 
                           labelWidth=220, valueType=float, controlWidth=100, orientation="horizontal") 
         
@@ -235,7 +268,7 @@ class FluxWidget(LNLSShadowWidget):
         self.pxz = oasysgui.lineEdit(config_box, self, "lim_f_z", "Source Acceptance +Z [rad] ", 
                           labelWidth=220, valueType=float, controlWidth=100, orientation="horizontal")
         
-        print_box = oasysgui.widgetBox(tab_config, "Save Data", addSpace=True, orientation="vertical", height=260)
+        print_box = oasysgui.widgetBox(tab_config, "Save Data", addSpace=True, orientation="vertical", height=230)
 
 #        self.flux_is_displayed = False
 #        self.power_is_displayed = False        
@@ -253,6 +286,86 @@ class FluxWidget(LNLSShadowWidget):
                           labelWidth=120, valueType=str, orientation="horizontal")
         gui.button(print_box, self, "Save Figure", callback=self.down_fig, height=35, width=200)
 
+        ### Performance tab (tab_cache) ###
+        cache_box = oasysgui.widgetBox(tab_cache, "Undulator Spectrum Cache", addSpace=True, orientation="vertical", height=150)
+
+        gui.checkBox(cache_box, self, "use_spectrum_cache", "Reuse cached SRW spectra")
+        oasysgui.lineEdit(cache_box, self, "spectrum_cache_size", "Disk cache size [MB]",
+                          labelWidth=220, valueType=float, controlWidth=100, orientation="horizontal")
+        gui.button(cache_box, self, "Clear Cache", callback=self.clear_spectrum_cache, height=35, width=200)
+
+        srw_box = oasysgui.widgetBox(tab_cache, "Parallel SRW", addSpace=True, orientation="vertical", height=80)
+
+        oasysgui.lineEdit(srw_box, self, "srw_workers", "SRW Workers (energy chunks)",
+                          labelWidth=220, valueType=int, controlWidth=100, orientation="horizontal")
+
+        ### Accumulation tab (tab_keep) ###
+        keep_box = oasysgui.widgetBox(tab_keep, "Keep Result", addSpace=True, orientation="vertical", height=230)
+
+        gui.checkBox(keep_box, self, "keep_result", "Accumulate energy histograms of incoming beams", callback=self.reset_accumulation)
+        gui.comboBox(keep_box, self, "accumulation_grid", label="Energy Grid", items=["Auto (extended)", "Fixed"],
+                     callback=self.set_accumulation_grid, labelWidth=220, orientation="horizontal")
+
+        self.accumulation_range_box = oasysgui.widgetBox(keep_box, "", addSpace=False, orientation="vertical")
+        oasysgui.lineEdit(self.accumulation_range_box, self, "accumulation_e_min", "Initial Energy [eV]",
+                          labelWidth=220, valueType=float, controlWidth=100, orientation="horizontal")
+        oasysgui.lineEdit(self.accumulation_range_box, self, "accumulation_e_max", "Final Energy [eV]",
+                          labelWidth=220, valueType=float, controlWidth=100, orientation="horizontal")
+
+        self.accumulation_label = QtWidgets.QLabel("")
+        keep_box.layout().addWidget(self.accumulation_label)
+        gui.button(keep_box, self, "Reset Accumulation", callback=self.reset_accumulation, height=35, width=200)
+        self.set_accumulation_grid()
+
+        ### Density Maps tab (tab_maps) ###
+        maps_box = oasysgui.widgetBox(tab_maps, "Power and Flux Density", addSpace=True, orientation="vertical", height=320)
+
+        gui.checkBox(maps_box, self, "density_maps", "Calculate density maps (X, Z)")
+        oasysgui.lineEdit(maps_box, self, "map_nbins_h", "Number of Bins H",
+                          labelWidth=220, valueType=int, controlWidth=100, orientation="horizontal")
+        oasysgui.lineEdit(maps_box, self, "map_nbins_v", "Number of Bins V",
+                          labelWidth=220, valueType=int, controlWidth=100, orientation="horizontal")
+        gui.comboBox(maps_box, self, "map_range", label="Range", items=["Good rays", "User"],
+                     callback=self.set_map_range, labelWidth=220, orientation="horizontal")
+
+        self.map_range_box = oasysgui.widgetBox(maps_box, "", addSpace=False, orientation="vertical")
+        self.le_map_h_min = oasysgui.lineEdit(self.map_range_box, self, "map_h_min", "H min",
+                                              labelWidth=220, valueType=float, controlWidth=100, orientation="horizontal")
+        self.le_map_h_max = oasysgui.lineEdit(self.map_range_box, self, "map_h_max", "H max",
+                                              labelWidth=220, valueType=float, controlWidth=100, orientation="horizontal")
+        self.le_map_v_min = oasysgui.lineEdit(self.map_range_box, self, "map_v_min", "V min",
+                                              labelWidth=220, valueType=float, controlWidth=100, orientation="horizontal")
+        self.le_map_v_max = oasysgui.lineEdit(self.map_range_box, self, "map_v_max", "V max",
+                                              labelWidth=220, valueType=float, controlWidth=100, orientation="horizontal")
+        self.set_map_range()
+
+        oasysgui.lineEdit(maps_box, self, "map_filename", "File Name",
+                          labelWidth=120, valueType=str, orientation="horizontal")
+        gui.button(maps_box, self, "Save Maps to HDF5", callback=self.save_density_maps, height=35, width=200)
+
+        ### Energy Scan tab (tab_scan) ###
+        gui.button(tab_scan, self, "Run Energy Scan", callback=self.run_energy_scan, height=35, width=200)
+        scan_box = oasysgui.widgetBox(tab_scan, "Monochromator Energy Scan", addSpace=True, orientation="vertical", height=360)
+
+        oasysgui.lineEdit(scan_box, self, "scan_start", "Initial Energy [eV]",
+                          labelWidth=220, valueType=float, controlWidth=100, orientation="horizontal")
+        oasysgui.lineEdit(scan_box, self, "scan_stop", "Final Energy [eV]",
+                          labelWidth=220, valueType=float, controlWidth=100, orientation="horizontal")
+        oasysgui.lineEdit(scan_box, self, "scan_npoints", "Number of Energies",
+                          labelWidth=220, valueType=int, controlWidth=100, orientation="horizontal")
+        gui.checkBox(scan_box, self, "scan_source", "Source energy follows the scan (PH1, PH2)")
+        oasysgui.lineEdit(scan_box, self, "scan_bandwidth", "Source Bandwidth [eV] (0 = single line)",
+                          labelWidth=220, valueType=float, controlWidth=100, orientation="horizontal")
+        oasysgui.lineEdit(scan_box, self, "scan_crystals", "Crystal Elements (e.g. 2, 3)",
+                          labelWidth=220, valueType=str, controlWidth=100, orientation="horizontal")
+        oasysgui.lineEdit(scan_box, self, "scan_spectrum_points", "Source Spectrum Points",
+                          labelWidth=220, valueType=int, controlWidth=100, orientation="horizontal")
+        oasysgui.lineEdit(scan_box, self, "scan_workers", "Worker Processes",
+                          labelWidth=220, valueType=int, controlWidth=100, orientation="horizontal")
+        oasysgui.lineEdit(scan_box, self, "scan_filename", "HDF5 File Name",
+                          labelWidth=120, valueType=str, orientation="horizontal")
+        gui.button(scan_box, self, "List Beamline Elements", callback=self.list_beamline_elements)
+
     
        
         ############### MAIN AREA #####################
@@ -267,6 +380,9 @@ class FluxWidget(LNLSShadowWidget):
         transm_tab = oasysgui.createTabPage(self.tabs_flux, "Beamline Transmittance")
         histo_tab = oasysgui.createTabPage(self.tabs_flux, "Histogram")
         vert_acc_tab = oasysgui.createTabPage(self.tabs_flux, "Source Acceptance")
+        power_density_tab = oasysgui.createTabPage(self.tabs_flux, "Power Density")
+        flux_density_tab = oasysgui.createTabPage(self.tabs_flux, "Flux Density")
+        self.scan_tab = oasysgui.createTabPage(self.tabs_flux, "Energy Scan")
         output_tab = oasysgui.createTabPage(self.tabs_flux, "Ouput")       
         
       
@@ -326,6 +442,30 @@ class FluxWidget(LNLSShadowWidget):
         self.plot_canvas6.setActiveCurveColor(color='blue')
         
                 
+        ### Areas for Power and Flux Density maps ###
+        self.image_box7 = gui.widgetBox(power_density_tab, "Power Density", addSpace=True, orientation="vertical")
+        self.image_box7.setFixedHeight(2*self.IMAGE_HEIGHT)
+        self.image_box7.setFixedWidth(2*self.IMAGE_WIDTH)
+        self.plot_canvas7 = oasysgui.plotWindow(roi=False, control=False, position=True, logScale=False)
+        self.plot_canvas7.setDefaultColormap(self.colormap)
+        self.image_box7.layout().addWidget(self.plot_canvas7)
+
+        self.image_box8 = gui.widgetBox(flux_density_tab, "Flux Density", addSpace=True, orientation="vertical")
+        self.image_box8.setFixedHeight(2*self.IMAGE_HEIGHT)
+        self.image_box8.setFixedWidth(2*self.IMAGE_WIDTH)
+        self.plot_canvas8 = oasysgui.plotWindow(roi=False, control=False, position=True, logScale=False)
+        self.plot_canvas8.setDefaultColormap(self.colormap)
+        self.image_box8.layout().addWidget(self.plot_canvas8)
+
+        ### Area for Energy Scan Plot ###
+        self.image_box9 = gui.widgetBox(self.scan_tab, "Flux vs. Energy", addSpace=True, orientation="vertical")
+        self.image_box9.setFixedHeight(2*self.IMAGE_HEIGHT)
+        self.image_box9.setFixedWidth(2*self.IMAGE_WIDTH)
+        self.plot_canvas9 = oasysgui.plotWindow(roi=False, control=False, position=True, logScale=True)
+        self.plot_canvas9.setDefaultPlotLines(True)
+        self.plot_canvas9.setActiveCurveColor(color='blue')
+        self.image_box9.layout().addWidget(self.plot_canvas9)
+        
         #### Area for output info ############
         self.shadow_output = oasysgui.textArea()
         out_box = oasysgui.widgetBox(output_tab, "System Output", addSpace=True, orientation="horizontal", height=600)
@@ -385,6 +525,9 @@ class FluxWidget(LNLSShadowWidget):
 								controlWidth=100, valueType=str, orientation="horizontal")
         self.powerT.setReadOnly(True)     
         
+        self.spectrum_cache = flux_util.SpectrumCache(name='srw_spectrum', max_disk_mb=self.spectrum_cache_size)
+        self.stages = flux_util.StageGraph()
+
         ### Creates 'Run' function for Flux widget ###
         self.runaction = widget.OWAction("Run", self)
         self.runaction.triggered.connect(self.plot_results)
@@ -427,11 +570,16 @@ class FluxWidget(LNLSShadowWidget):
     def set_beam(self, beam):
         if ShadowCongruence.checkEmptyBeam(beam):
             if ShadowCongruence.checkGoodBeam(beam):
-                if self.keep_result == 1 and not self.input_beam is None:
-                    self.input_beam = ShadowBeam.mergeBeams(self.input_beam, beam)
-                    
-                else:
-                    self.input_beam = beam
+                self.input_beam = beam
+                self.beam_version += 1
+                if self.keep_result == 1:
+                    try:
+                        self.accumulate_beam(beam)
+                    except Exception as exception:
+                        QtWidgets.QMessageBox.critical(self, "Error",
+                                                       str(exception),
+                                                       QtWidgets.QMessageBox.Ok)
+                        return
 
                 if self.is_automatic_run:
                     self.plot_results()
@@ -441,6 +589,28 @@ class FluxWidget(LNLSShadowWidget):
                                            QtWidgets.QMessageBox.Ok)
                 
 
+    ### Accumulation of energy histograms (Keep Result) ###
+    def set_accumulation_grid(self):
+        self.accumulation_range_box.setVisible(self.accumulation_grid == 1)
+        self.reset_accumulation()
+
+    def reset_accumulation(self):
+        self.accumulator = None
+        self.accumulation_label.setText("Accumulated beams: 0")
+
+    def accumulate_beam(self, beam):
+        if self.accumulator is None:
+            self.number_of_bins = congruence.checkStrictlyPositiveNumber(self.number_of_bins, "Number of Bins")
+            energy_range = None
+            if self.accumulation_grid == 1:
+                congruence.checkLessThan(self.accumulation_e_min, self.accumulation_e_max, "Initial Energy", "Final Energy")
+                energy_range = [self.accumulation_e_min, self.accumulation_e_max]
+            self.accumulator = flux_util.EnergyHistogramAccumulator(self.number_of_bins, energy_range)
+
+        self.accumulator.add_beam(beam._beam)
+        self.accumulation_label.setText("Accumulated beams: {0} ({1} energy bins)".format(self.accumulator.n_beams,
+                                                                                           len(self.accumulator.histoI)))
+
     ### Get Source Info - For Bending Magnet, Geometrical Source and Undulator Gaussian ###
     def get_parameters_from_source(self):
         if(hasattr(self, 'input_beam')):
@@ -530,32 +700,95 @@ class FluxWidget(LNLSShadowWidget):
 
 
     def plot_xy(self):
-        beam_to_plot = self.input_beam._beam       
-
-       #Intesity Spectrum at Sample
-        En = beam_to_plot.getshonecol(11, nolost=1)
-        I = beam_to_plot.getshonecol(23, nolost=1)
-        self.histoI = numpy.histogram(En, self.number_of_bins, weights=I)[0]
-        self.En_coord = numpy.linspace(numpy.min(En), numpy.max(En),self.number_of_bins)
-        
-       #Collect intensity from Shadow Source
-        En0 = beam_to_plot.getshonecol(11, nolost=0)
-        I0 = numpy.ones(len(En0))
-        
-       #Creates source histogram from sample energy range
-        I0_new = I0[numpy.logical_and(En0>=numpy.min(En),En0<=numpy.max(En))]
-        En0_new = En0[numpy.logical_and(En0>=numpy.min(En),En0<=numpy.max(En))]
-        self.histoI0 = numpy.histogram(En0_new, self.number_of_bins , weights=I0_new)[0] 
-
-       #Collect beam info       
-        info_beam = beam_to_plot.histo1(1, nolost=1)
-        self.inten = ("{:.2f}".format(info_beam['intensity']))
-        self.nrays = str(int(info_beam['nrays']))
-        self.grays = str(int(info_beam['good_rays']))
-        self.lrays = str(int(info_beam['nrays']-info_beam['good_rays'])) 
-                       
+        """
+        Runs the calculation stages whose inputs changed since the last run; the others keep their results.
+        """
+        sp = '            '
+        self.print_date_i()
         self.current = 0.1 #always normalized to 100 mA
+        self.stages.recomputed = []
+        
+        self.stages.evaluate('histograms', self.calc_histograms,
+                             inputs=[self.beam_version, self.keep_result, 0 if self.accumulator is None else self.accumulator.n_beams,
+                                     self.number_of_bins, self.binning_mode, self.target_precision])
+        self.stages.evaluate('source spectrum', self.calc_source_spectrum,
+                             inputs=[self.source_parameters(), self.harmonic_decomposition], depends=['histograms'])
+        self.stages.evaluate('acceptance', self.calc_acceptance,
+                             inputs=[self.source_type, self.use_vert_acc, self.storage_energy, self.mag_field,
+                                     self.lim_i_z, self.lim_f_z, self.ebeam_vert_sigma], depends=['histograms'])
+        self.stages.evaluate('flux', self.calc_flux, depends=['histograms', 'source spectrum', 'acceptance'])
+        self.stages.evaluate('plots', self.plot_spectra, depends=['flux'])
+        
+        #Power and Flux Density maps
+        if self.density_maps == 1 and self.keep_result == 1 and not self.accumulator is None:
+            # the accumulated flux would be spread over the rays of the last beam only
+            print(sp+'Density maps need the rays of all beams: not calculated while accumulating energy histograms \n')
+        elif self.density_maps == 1:
+            self.stages.evaluate('density maps', self.calc_density_maps,
+                                 inputs=[self.beam_version, self.map_nbins_h, self.map_nbins_v, self.map_range, self.map_h_min,
+                                         self.map_h_max, self.map_v_min, self.map_v_max, self.workspace_units_to_cm], depends=['flux'])
+            self.stages.evaluate('density plots', self.plot_density_maps, depends=['density maps'])
+        
+        if len(self.stages.recomputed) == 0:
+            print(sp+'Nothing changed since the last run: results are up to date \n')
+        else:
+            print(sp+'Recomputed: ' + ', '.join(self.stages.recomputed) + '\n')
+        self.print_date_f() 
+        
+    def calc_histograms(self):
+        adapted_bins = False
+        if self.keep_result == 1 and not self.accumulator is None:
+            
+           #Accumulated histograms of all received beams
+            self.En_coord, self.histoI, self.histoI0, self.histoI2 = self.accumulator.result()
+            self.En_edges = numpy.linspace(self.En_coord[0], self.En_coord[-1], len(self.En_coord) + 1)
+            if self.binning_mode != 0:
+                print('Adaptive binning needs the rays: accumulated histograms use their fixed grid')
+            self.inten = ("{:.2f}".format(self.accumulator.intensity))
+            self.nrays = str(self.accumulator.nrays)
+            self.grays = str(self.accumulator.good_rays)
+            self.lrays = str(self.accumulator.nrays - self.accumulator.good_rays)
+
+        else:
+            beam_to_plot = self.input_beam._beam       
+            energy = beam_to_plot.getshonecol(11, nolost=0)
+            intensity = beam_to_plot.getshonecol(23, nolost=0)
+            flag = beam_to_plot.getshonecol(10, nolost=0)
+    
+           #Intesity Spectrum at Sample and Source histogram in the sample energy range, from one column extraction
+            self.En_coord, self.histoI, self.histoI0, info_beam = flux_util.energy_histograms(energy, intensity, flag, self.number_of_bins)
+            self.histoI2 = info_beam['histoI2']
+            
+           #Collect beam info       
+            self.inten = ("{:.2f}".format(info_beam['intensity']))
+            self.nrays = str(int(info_beam['nrays']))
+            self.grays = str(int(info_beam['good_rays']))
+            self.lrays = str(int(info_beam['nrays']-info_beam['good_rays'])) 
+
+            self.En_edges = numpy.linspace(self.En_coord[0], self.En_coord[-1], len(self.En_coord) + 1)
+            
+           #Adaptive bins following the energy distribution of the good rays
+            if self.binning_mode != 0:
+                method = 'equal count' if self.binning_mode == 1 else 'bayesian blocks'
+                self.En_edges = flux_util.adaptive_energy_edges(energy[flag > 0], self.number_of_bins, method)
+                self.histoI, self.histoI0, self.histoI2 = flux_util.binned_histograms(energy, intensity, flag, self.En_edges)
+                adapted_bins = True
+                
+       #Merges bins until the transmission reaches the target precision
+        if self.target_precision > 0:
+            self.En_edges, self.histoI, self.histoI0, self.histoI2 = flux_util.merge_to_precision(self.En_edges, self.histoI, self.histoI0,
+                                                                                               self.histoI2, self.target_precision)
+            adapted_bins = True
+            
+        # adapted bins are integrated bin by bin (flux_from_histograms)
+        self.integration_edges = self.En_edges if adapted_bins else None
+        if adapted_bins:
+            self.En_coord = 0.5*(self.En_edges[1:] + self.En_edges[:-1])
+            print('Energy bins: {0} (from {1:.2f} to {2:.2f} eV wide)'.format(len(self.En_coord), numpy.min(numpy.diff(self.En_edges)),
+                                                                           numpy.max(numpy.diff(self.En_edges))))
+
         
+    def calc_source_spectrum(self):
         ##### Get source acceptance #####  
         if (self.lim_i_x == 0) or (self.lim_i_z == 0):
             
@@ -568,7 +801,6 @@ class FluxWidget(LNLSShadowWidget):
         self.ver_accep = (self.lim_f_z + self.lim_i_z)*1e3
         
         sp = '            ' # spacing for identation 
-        self.print_date_i()
         print( sp + 'Source parameters:')
         
        #Select source type and calculate spectrum
@@ -585,13 +817,13 @@ class FluxWidget(LNLSShadowWidget):
            print(sp+sp+'E = {0} GeV'.format(self.storage_energy) + '\n' + sp+sp+'I = {0} A'.format(self.current) + '\n' + sp+sp+'B = {0} T'.format(self.mag_field) + '\n' + sp+sp+'N periods = {0} '.format(self.n_periods) + '\n' )
 
         if self.source_type == 2:
-            e = 1.60217662e-19; m_e = 9.10938356e-31; pi = 3.141592654; c = 299792458;
-            B = 2*pi*m_e*c*self.k_value/(e*self.und_period)
-            mag_field=[self.und_period,self.und_length, 0, B, 0, 0, +1, +1]
-            electron_beam=[self.sigma_x*1e-3, self.sigma_z*1e-3, self.div_x, self.div_z, self.storage_energy, self.en_spread, self.current]
-            sampling_mesh=[10.0, round(-self.lim_i_x*10.0, 8), round(self.lim_f_x*10.0, 8), round(-self.lim_i_z*10.0, 8), round(self.lim_f_z*10.0, 8)]    
-            precision = [self.max_h, self.prec, self.prec]
-            energy_grid=[self.En_coord[0],self.En_coord[-1], self.number_of_bins]            
+            source = self.source_parameters()
+            mag_field, electron_beam = source['mag_field'], source['electron_beam']
+            sampling_mesh, precision = source['sampling_mesh'], source['precision']
+            energy_grid=[self.En_coord[0],self.En_coord[-1], len(self.En_coord)]            
+            uniform_grid = numpy.allclose(numpy.diff(self.En_coord), (self.En_coord[-1] - self.En_coord[0])/max(len(self.En_coord) - 1, 1))
+            if not uniform_grid:
+                energy_grid[2] = max(self.number_of_bins, len(self.En_coord)) # SRW grid, interpolated on the adaptive bins
 
             print(sp+sp+"Parameters passed to SRWLMagFldH():")
             print(sp+sp+sp+"_n=1, _h_or_v='v', _B={0}, _ph={1}, _s={2}, _a=1".format(mag_field[3], mag_field[5], mag_field[7]))
@@ -611,8 +843,14 @@ class FluxWidget(LNLSShadowWidget):
             print(sp+sp+"Radiation Sampling array: ")
             print(sp+sp+sp, sampling_mesh, '\n')
            
-            os.write(1, b'########### Running SRW Undulator Spectrum! ############### \n')
-            self.source_spec = self.srw_undulator_spectrum(mag_field, electron_beam, energy_grid, sampling_mesh, precision)
+            if self.harmonic_decomposition == 1:
+                self.harmonic_spectra = self.cached_harmonic_spectra(mag_field, electron_beam, energy_grid, sampling_mesh, precision)
+            else:
+                self.harmonic_spectra = self.cached_undulator_spectrum(mag_field, electron_beam, energy_grid, sampling_mesh, precision)[None, :]
+            if not uniform_grid:
+                srw_energies = numpy.linspace(energy_grid[0], energy_grid[1], energy_grid[2])
+                self.harmonic_spectra = numpy.array([numpy.interp(self.En_coord, srw_energies, spectrum) for spectrum in self.harmonic_spectra])
+            self.source_spec = numpy.sum(self.harmonic_spectra, axis=0)
             os.write(1, b'########### Source Spectrum Done! ############### \n')
         
         
@@ -621,8 +859,8 @@ class FluxWidget(LNLSShadowWidget):
         print(sp+sp+'+X = '+'{:.3e}'.format(self.lim_f_x)+' rad')
         print(sp+sp+'-Z = '+'{:.3e}'.format(-self.lim_i_z)+' rad')
         print(sp+sp+'+Z = '+'{:.3e}'.format(self.lim_f_z)+' rad' + '\n')
-           
-        
+
+    def calc_acceptance(self):
         # Calculates Vertical acceptance for Bending Magnet and Wiggler sources
         self.vert_acc = numpy.ones((len(self.En_coord)))
         if(self.source_type<2 and self.use_vert_acc==1):
@@ -631,31 +869,46 @@ class FluxWidget(LNLSShadowWidget):
                                                  div_limits=[-self.lim_i_z, self.lim_f_z], e_beam_vert_div=self.ebeam_vert_sigma)
             self.vert_acc = self.acc_dict['acceptance']
 
-        
-        #Flux Spectrum at Sample
-        self.T1 = self.histoI/self.histoI0
-        Flux_eV = self.source_spec*(1000.0/self.En_coord)
-        Flux_sample = Flux_eV*self.T1*self.vert_acc
-        Power_sample = Flux_eV*self.T1*self.vert_acc*self.En_coord*1.60217662e-19
- 
-        self.Flux = (simps(Flux_sample,x=self.En_coord)*(0.1/self.current))    #Integrate the Flux and normalize to 100 mA
-        self.Power = (simps(Power_sample,x=self.En_coord)*(0.1/self.current))
+    def calc_flux(self):
+        sp = '            '
+        #Flux Spectrum at Sample, integrated Flux and Power normalized to 100 mA
+        results = flux_util.flux_from_histograms(self.En_coord, self.histoI, self.histoI0, self.histoI2,
+                                                 self.source_spec, self.vert_acc, self.current, self.integration_edges)
+        self.T1, self.T1_err = results['T1'], results['T1_err']
+        self.Flux_sample = results['Flux_sample']
+        self.Flux, self.Flux_err = results['flux'], results['flux_err']
+        self.Power, self.Power_err = results['power'], results['power_err']
+        self.beamline_flux, self.beamline_flux_err = results['beamline_flux'], results['beamline_flux_err']
         
         self.flux_total = ("{:.2e}".format(self.Flux))
         self.power_total = ("{:.2e}".format(self.Power))
         
         print(sp+'### Results ###')
-        print(sp+sp+'Total Flux = {:.3e}'.format(self.Flux) + ' ph/s/100 mA')
-        print(sp+sp+'Total Power = {:.3e}'.format(self.Power)+' W')
+        print(sp+sp+'Total Flux = {:.3e} +/- {:.2e}'.format(self.Flux, self.Flux_err) + ' ph/s/100 mA')
+        print(sp+sp+'Total Power = {:.3e} +/- {:.2e}'.format(self.Power, self.Power_err)+' W')
         print('\n')
-                     
+        
+        if self.source_type == 2 and self.harmonic_decomposition == 1:
+            print(sp+'### Results per Harmonic ###')
+            print(sp+sp+'  n      Flux [ph/s/100 mA]    Power [W]')
+            self.harmonic_flux = numpy.zeros(len(self.harmonic_spectra))
+            self.harmonic_power = numpy.zeros(len(self.harmonic_spectra))
+            for i, spectrum in enumerate(self.harmonic_spectra):
+                # same transmission, acceptance and integration as the total, so the harmonics add up to it
+                results_h = flux_util.flux_from_histograms(self.En_coord, self.histoI, self.histoI0, self.histoI2,
+                                                           spectrum, self.vert_acc, self.current, self.integration_edges)
+                self.harmonic_flux[i] = results_h['flux']
+                self.harmonic_power[i] = results_h['power']
+                print(sp+sp+'{0:3d}      {1:.3e}             {2:.3e}'.format(i + 1, self.harmonic_flux[i], self.harmonic_power[i]))
+            print('\n')
+
+    def plot_spectra(self):
         #Plot Flux after element
-        self.beamline_flux = self.source_spec*self.T1*self.vert_acc
         self.plot_canvas.clear()
         self.plot_canvas.setGraphYLabel("Flux [ph/s/100mA/0.1%bW]")
         self.plot_canvas.setGraphXLabel("Energy [eV]")        
         self.plot_canvas.setGraphTitle('Beamline Spectrum')
-        self.plot_canvas.addCurve(self.En_coord,self.beamline_flux,color='blue',symbol='.',linewidth=2)
+        self.plot_canvas.addCurve(self.En_coord,self.beamline_flux,color='blue',symbol='.',linewidth=2,yerror=numpy.where(numpy.isfinite(self.beamline_flux_err), self.beamline_flux_err, 0.0))
         self.image_box.layout().addWidget(self.plot_canvas)
 #        self.showflux = 0
 #        self.showpower = 0
@@ -668,6 +921,9 @@ class FluxWidget(LNLSShadowWidget):
         self.plot_canvas2.setGraphXLabel("Energy [eV]")
         self.plot_canvas2.setGraphTitle('Source Spectrum')        
         self.plot_canvas2.addCurve(self.En_coord,self.source_spec*self.vert_acc,color='blue',symbol='.',linewidth=2)
+        if self.source_type == 2 and self.harmonic_decomposition == 1:
+            for i, spectrum in enumerate(self.harmonic_spectra):
+                self.plot_canvas2.addCurve(self.En_coord,spectrum*self.vert_acc,legend='n = {0}'.format(i + 1),linewidth=1)
         self.image_box2.layout().addWidget(self.plot_canvas2)
         
 #        
@@ -676,7 +932,7 @@ class FluxWidget(LNLSShadowWidget):
         self.plot_canvas3.setGraphYLabel("Transmission")
         self.plot_canvas3.setGraphXLabel("Energy [eV]")       
         self.plot_canvas3.setGraphTitle('Beamline Transmission')
-        self.plot_canvas3.addCurve(self.En_coord,self.T1,color='blue',symbol='.',linewidth=2)
+        self.plot_canvas3.addCurve(self.En_coord,self.T1,color='blue',symbol='.',linewidth=2,yerror=numpy.where(numpy.isfinite(self.T1_err), self.T1_err, 0.0))
         self.image_box3.layout().addWidget(self.plot_canvas3)
 
 #
@@ -693,7 +949,7 @@ class FluxWidget(LNLSShadowWidget):
         if(self.source_type<2 and self.use_vert_acc==1):
             self.plot_canvas5.clear()            
             self.plot_canvas5.addImage(self.acc_dict["PDF"].transpose(),origin=(numpy.min(self.En_coord),1e3*numpy.min(self.acc_dict["Psi"])),
-                                       scale=((numpy.max(self.En_coord)-numpy.min(self.En_coord))/self.number_of_bins,
+                                       scale=((numpy.max(self.En_coord)-numpy.min(self.En_coord))/len(self.En_coord),
                                               1e3*(numpy.max(self.acc_dict["Psi"])-numpy.min(self.acc_dict["Psi"]))/len(self.acc_dict["PDF"][0,:])))
             self.plot_canvas5.addCurve(self.En_coord,1e3*self.acc_dict["rwhm"],color='black',linewidth=1.5,legend='right')
             self.plot_canvas5.addCurve(self.En_coord,1e3*self.acc_dict["lwhm"],color='black',linewidth=1.5,legend='left')
@@ -724,10 +980,204 @@ class FluxWidget(LNLSShadowWidget):
             self.plot_canvas6.setGraphXLabel("Energy [keV]")
             self.plot_canvas6.setGraphYLabel("Acceptance Factor")    
             self.image_box6.layout().addWidget(self.plot_canvas6)
+        
+        
+    ### Power and Flux Density maps ###
+    def set_map_range(self):
+        self.map_range_box.setVisible(self.map_range == 1)
+
+    def calc_density_maps(self):
+        """
+        Distributes the beamline flux of each energy bin (source spectrum x transmission x
+        vertical acceptance) over the good rays of the input beam and bins it on X, Z.
+        """
+        self.map_nbins_h = congruence.checkStrictlyPositiveNumber(self.map_nbins_h, "Number of Bins H")
+        self.map_nbins_v = congruence.checkStrictlyPositiveNumber(self.map_nbins_v, "Number of Bins V")
+        
+        beam = self.input_beam._beam
+        x = beam.getshonecol(1, nolost=1)
+        z = beam.getshonecol(3, nolost=1)
+        energy = beam.getshonecol(11, nolost=1)
+        intensity = beam.getshonecol(23, nolost=1)
+        
+        if self.map_range == 1:
+            congruence.checkLessThan(self.map_h_min, self.map_h_max, "H min", "H max")
+            congruence.checkLessThan(self.map_v_min, self.map_v_max, "V min", "V max")
+            h_range, v_range = [self.map_h_min, self.map_h_max], [self.map_v_min, self.map_v_max]
+        else:
+            h_range = [numpy.min(x), numpy.max(x)] if numpy.max(x) > numpy.min(x) else [numpy.min(x) - 0.5, numpy.max(x) + 0.5]
+            v_range = [numpy.min(z), numpy.max(z)] if numpy.max(z) > numpy.min(z) else [numpy.min(z) - 0.5, numpy.max(z) + 0.5]
+        
+        to_mm = self.workspace_units_to_cm*10
+        pixel_area = ((h_range[1] - h_range[0])/self.map_nbins_h*to_mm)*((v_range[1] - v_range[0])/self.map_nbins_v*to_mm)
+        
+        flux_per_bin = self.Flux_sample*numpy.diff(self.En_edges)*(0.1/self.current)
+        flux_weights = flux_util.ray_flux_weights(energy, intensity, self.En_edges, flux_per_bin)
+        power_weights = flux_weights*energy*1.60217662e-19
+        
+        self.flux_density, self.map_h, self.map_v = flux_util.density_map(x, z, flux_weights, h_range, v_range,
+                                                                          self.map_nbins_h, self.map_nbins_v, pixel_area)
+        self.power_density = flux_util.density_map(x, z, power_weights, h_range, v_range,
+                                                   self.map_nbins_h, self.map_nbins_v, pixel_area)[0]
+        self.flux_density_stats = flux_util.map_statistics(self.flux_density, self.map_h, self.map_v, pixel_area)
+        self.power_density_stats = flux_util.map_statistics(self.power_density, self.map_h, self.map_v, pixel_area)
+        
+        sp = '            '
+        print(sp + '### Density Maps ###')
+        print(sp+sp+'Peak Power Density = {0:.3e} W/mm^2 at X = {1:.4g}, Z = {2:.4g} {3}'.format(self.power_density_stats['peak'],
+              self.power_density_stats['peak_h'], self.power_density_stats['peak_v'], self.workspace_units_label))
+        print(sp+sp+'Peak Flux Density = {0:.3e} ph/s/mm^2 at X = {1:.4g}, Z = {2:.4g} {3}'.format(self.flux_density_stats['peak'],
+              self.flux_density_stats['peak_h'], self.flux_density_stats['peak_v'], self.workspace_units_label))
+        print(sp+sp+'Integrated Power in map = {0:.3e} W'.format(self.power_density_stats['integrated']))
+        print(sp+sp+'Integrated Flux in map = {0:.3e} ph/s/100 mA'.format(self.flux_density_stats['integrated']) + '\n')
+        
+    def plot_density_maps(self):
+        dh = self.map_h[1] - self.map_h[0] if len(self.map_h) > 1 else 1.0
+        dv = self.map_v[1] - self.map_v[0] if len(self.map_v) > 1 else 1.0
+        
+        for canvas, density, stats, title, unit in [(self.plot_canvas7, self.power_density, self.power_density_stats, 'Power Density', 'W/mm^2'),
+                                                     (self.plot_canvas8, self.flux_density, self.flux_density_stats, 'Flux Density', 'ph/s/mm^2')]:
+            canvas.clear()
+            canvas.addImage(density.transpose(), origin=(self.map_h[0] - dh/2, self.map_v[0] - dv/2), scale=(dh, dv))
+            canvas.setGraphXLabel("X [" + self.workspace_units_label + "]")
+            canvas.setGraphYLabel("Z [" + self.workspace_units_label + "]")
+            canvas.setGraphTitle('{0} [{1}] - peak {2:.3e}, integrated {3:.3e}'.format(title, unit, stats['peak'], stats['integrated']))
             
-        self.print_date_f() 
+    def save_density_maps(self):
+        try:
+            if not hasattr(self, 'power_density'):
+                raise Exception("No density maps: enable them and run the widget")
+            if self.keep_result == 1 and not self.accumulator is None:
+                raise Exception("Density maps are not calculated while accumulating energy histograms")
+            
+            congruence.checkDir(self.map_filename)
+            with h5py.File(self.map_filename, 'w') as f:
+                f.attrs['units'] = self.workspace_units_label
+                f.create_dataset('x', data=self.map_h)
+                f.create_dataset('z', data=self.map_v)
+                for name, density, stats, unit in [('power_density', self.power_density, self.power_density_stats, 'W/mm^2'),
+                                                   ('flux_density', self.flux_density, self.flux_density_stats, 'ph/s/mm^2')]:
+                    dset = f.create_dataset(name, data=density, compression="gzip")
+                    dset.attrs['units'] = unit
+                    for key, value in stats.items():
+                        dset.attrs[key] = value
+                f['power_density'].attrs['integrated units'] = 'W'
+                f['flux_density'].attrs['integrated units'] = 'ph/s/100mA'
+        except Exception as exception:
+            QtWidgets.QMessageBox.critical(self, "Error",
+                                           str(exception),
+                                           QtWidgets.QMessageBox.Ok)
+
+    def source_parameters(self):
+        """
+        Source settings as the source dict of flux_util (current normalized to 100 mA).
+        """
+        if self.source_type == 0:
+            return {'type':'bending magnet', 'E':self.storage_energy, 'I':self.current, 'B':self.mag_field,
+                    'hor_acc_mrad':(self.lim_f_x + self.lim_i_x)*1e3}
+        if self.source_type == 1:
+            return {'type':'wiggler', 'E':self.storage_energy, 'I':self.current, 'B':self.mag_field,
+                    'N_periods':self.n_periods, 'hor_acc_mrad':(self.lim_f_x + self.lim_i_x)*1e3}
+        
+        e = 1.60217662e-19; m_e = 9.10938356e-31; pi = 3.141592654; c = 299792458;
+        B = 2*pi*m_e*c*self.k_value/(e*self.und_period)
+        return {'type':'undulator',
+                'mag_field':[self.und_period,self.und_length, 0, B, 0, 0, +1, +1],
+                'electron_beam':[self.sigma_x*1e-3, self.sigma_z*1e-3, self.div_x, self.div_z, self.storage_energy, self.en_spread, self.current],
+                'sampling_mesh':[10.0, round(-self.lim_i_x*10.0, 8), round(self.lim_f_x*10.0, 8), round(-self.lim_i_z*10.0, 8), round(self.lim_f_z*10.0, 8)],
+                'precision':[self.max_h, self.prec, self.prec]}
+
+    def list_beamline_elements(self):
+        sys.stdout = EmittingStream(textWritten=self.writeStdOut)
         
+        if self.input_beam is None:
+            sys.stdout.write('\nNo input beam.\n')
+            return
+        
+        sys.stdout.write('\nBeamline elements (number: widget):\n')
+        for element in history_util.flatten_oe_history(self.input_beam):
+            sys.stdout.write('   {0}: {1} ({2})\n'.format(element['history_index'], element['name'], element['kind']))
+        self.tabs_flux.setCurrentIndex(self.tabs_flux.count() - 1)
+
+    def run_energy_scan(self):
+        try:
+            sys.stdout = EmittingStream(textWritten=self.writeStdOut)
+            
+            if ShadowCongruence.checkEmptyBeam(self.input_beam):
+                self.number_of_bins = congruence.checkStrictlyPositiveNumber(self.number_of_bins, "Number of Bins")
+                self.scan_npoints = congruence.checkStrictlyPositiveNumber(self.scan_npoints, "Number of Energies")
+                self.scan_workers = congruence.checkStrictlyPositiveNumber(self.scan_workers, "Worker Processes")
+                self.scan_spectrum_points = congruence.checkStrictlyPositiveNumber(self.scan_spectrum_points, "Source Spectrum Points")
+                self.scan_bandwidth = congruence.checkPositiveNumber(self.scan_bandwidth, "Source Bandwidth")
+                self.scan_start = congruence.checkStrictlyPositiveNumber(self.scan_start, "Initial Energy")
+                congruence.checkLessThan(self.scan_start, self.scan_stop, "Initial Energy", "Final Energy")
+                congruence.checkDir(self.scan_filename)
+                self.checkFields()
+                crystals = [int(index) for index in self.scan_crystals.replace(',', ' ').split()]
+                
+                self.current = 0.1 #always normalized to 100 mA
+                source = self.source_parameters()
+                vertical_acceptance = None
+                if self.source_type < 2 and self.use_vert_acc == 1:
+                    vertical_acceptance = {'div_limits':[-self.lim_i_z, self.lim_f_z], 'e_beam_vert_div':self.ebeam_vert_sigma}
+                binning = ['fixed', 'equal count', 'bayesian blocks'][self.binning_mode]
+                energies = numpy.linspace(self.scan_start, self.scan_stop, self.scan_npoints)
+                
+                def progress(k, n_done):
+                    sys.stdout.write('   E = {0:.2f} eV done ({1}/{2})\n'.format(energies[k], n_done, len(energies)))
+                    QtWidgets.QApplication.processEvents()
+                
+                self.print_date_i()
+                sys.stdout.write("Running Energy Scan from {0} to {1} eV...\n".format(self.scan_start, self.scan_stop))
+                sys.stdout.flush()
+                self.scan_results = flux_util.energy_scan(self.input_beam, energies, source,
+                                                         source_index=0 if self.scan_source == 1 else None,
+                                                         bandwidth=self.scan_bandwidth, crystal_indices=crystals,
+                                                         n_workers=self.scan_workers,
+                                                         cache=self.spectrum_cache if self.use_spectrum_cache == 1 else None,
+                                                         spectrum_points=self.scan_spectrum_points, progress=progress,
+                                                         number_of_bins=self.number_of_bins, binning=binning,
+                                                         target_precision=self.target_precision,
+                                                         vertical_acceptance=vertical_acceptance)
+                self.print_energy_scan()
+                self.save_energy_scan()
+                self.plot_energy_scan()
+                self.print_date_f()
         
+        except Exception as exception:
+            QtWidgets.QMessageBox.critical(self, "Error",
+                                       str(exception),
+                                       QtWidgets.QMessageBox.Ok)
+
+    def print_energy_scan(self):
+        sys.stdout.write('\n   Energy [eV]   Flux [ph/s/100mA]       Power [W]   Good Rays     Intensity  Mean E [eV]  RMS E [eV]\n')
+        for k in range(len(self.scan_results['energy'])):
+            sys.stdout.write('   {0:11.2f}   {1:.3e} +/- {2:.1e}   {3:.3e}   {4:9d}   {5:11.2f}   {6:10.2f}   {7:9.3f}\n'.format(
+                             self.scan_results['energy'][k], self.scan_results['flux'][k], self.scan_results['flux_err'][k],
+                             self.scan_results['power'][k], int(self.scan_results['good_rays'][k]), self.scan_results['intensity'][k],
+                             self.scan_results['mean_energy'][k], self.scan_results['rms_energy'][k]))
+        
+    def plot_energy_scan(self):
+        self.plot_canvas9.clear()
+        self.plot_canvas9.addCurve(self.scan_results['energy'], self.scan_results['flux'], yerror=self.scan_results['flux_err'], symbol='o')
+        self.plot_canvas9.setGraphXLabel("Monochromator Energy [eV]")
+        self.plot_canvas9.setGraphYLabel("Flux [ph/s/100mA]")
+        self.plot_canvas9.setGraphTitle("Flux vs. Energy")
+        self.tabs_flux.setCurrentIndex(self.tabs_flux.indexOf(self.scan_tab))
+        
+    def save_energy_scan(self):
+        with h5py.File(self.scan_filename, 'w') as f:
+            f.attrs['source energy driven'] = self.scan_source
+            f.attrs['source bandwidth [eV]'] = self.scan_bandwidth
+            f.attrs['crystal elements'] = self.scan_crystals
+            f.attrs['number of bins'] = self.number_of_bins
+            units = {'energy':'eV', 'flux':'ph/s/100mA', 'flux_err':'ph/s/100mA', 'power':'W', 'power_err':'W',
+                     'mean_energy':'eV', 'rms_energy':'eV'}
+            for key, values in self.scan_results.items():
+                dset = f.create_dataset(key, data=values)
+                if key in units:
+                    dset.attrs['units'] = units[key]
+
     def writeStdOut(self, text):        
         cursor = self.shadow_output.textCursor()
         cursor.movePosition(QTextCursor.End)
@@ -756,6 +1206,52 @@ class FluxWidget(LNLSShadowWidget):
     ############ SOURCE SPECTRUM CALCULATION FUNCTIONS ######################
     #########################################################################
     
+    def cached_undulator_spectrum(self, mag_field, electron_beam, energy_grid, sampling_mesh, precision):
+        """
+        Returns the SRW undulator spectrum from the spectrum cache, calling SRW only if
+        no cached spectrum of the same undulator, electron beam, acceptance and precision
+        covers energy_grid. Arguments as in srw_undulator_spectrum.
+        """
+        key = flux_util.SpectrumCache.make_key(list(mag_field), list(electron_beam), list(sampling_mesh), list(precision))
+
+        if self.use_spectrum_cache == 1:
+            self.spectrum_cache.max_disk_mb = congruence.checkPositiveNumber(self.spectrum_cache_size, "Disk cache size")
+            spectrum = self.spectrum_cache.get(key, energy_grid)
+            if spectrum is not None:
+                print('            Undulator spectrum taken from cache \n')
+                return spectrum
+
+        os.write(1, b'########### Running SRW Undulator Spectrum! ############### \n')
+        spectrum = self.srw_undulator_spectrum(mag_field, electron_beam, energy_grid, sampling_mesh, precision)
+        if self.use_spectrum_cache == 1:
+            self.spectrum_cache.put(key, energy_grid, spectrum)
+        return spectrum
+
+    def cached_harmonic_spectra(self, mag_field, electron_beam, energy_grid, sampling_mesh, precision):
+        """
+        Returns an array (max_h, energy points) with the spectrum of each harmonic 1..precision[0].
+        Each harmonic is cached separately, so only the harmonics missing from the cache
+        are calculated (in parallel with SRW Workers > 1). Arguments as in srw_undulator_spectrum.
+        """
+        cache = None
+        if self.use_spectrum_cache == 1:
+            self.spectrum_cache.max_disk_mb = congruence.checkPositiveNumber(self.spectrum_cache_size, "Disk cache size")
+            cache = self.spectrum_cache
+        self.srw_workers = congruence.checkStrictlyPositiveNumber(self.srw_workers, "SRW Workers")
+        
+        spectra, cached, calculated = flux_util.cached_harmonic_spectra(mag_field, electron_beam, energy_grid, sampling_mesh, precision,
+                                                                        cache, self.srw_workers)
+        print('            Harmonics taken from cache: {0}, calculated: {1} \n'.format(cached, calculated))
+        return spectra
+
+    def clear_spectrum_cache(self):
+        try:
+            self.spectrum_cache.clear()
+        except Exception as exception:
+            QtWidgets.QMessageBox.critical(self, "Error",
+                                           str(exception),
+                                           QtWidgets.QMessageBox.Ok)
+
     def srw_undulator_spectrum(self, mag_field=[], electron_beam=[], energy_grid=[], sampling_mesh=[], precision=[]):
         """
         Calls SRW to calculate spectrum for a planar or elliptical undulator\n
@@ -764,62 +1260,18 @@ class FluxWidget(LNLSShadowWidget):
         :energy_grid: list containing: [initial energy, final energy, number of energy points]
         :sampling_mesh: list containing: [observation plane distance from source [m], range -X [m], , range+X [m], range -Y [m], range +Y [m]]
         :precision: list containing: [h_max: maximum harmonic number to take into account, longitudinal precision factor, azimuthal precision factor (1 is standard, >1 is more accurate]
-        """     
-    
-        #***********Undulator
-        und = SRWLMagFldU([SRWLMagFldH(1, 'v', mag_field[3], mag_field[5], mag_field[7], 1), 
-                           SRWLMagFldH(1, 'h', mag_field[2], mag_field[4], mag_field[6], 1)], 
-                           mag_field[0], int(round(mag_field[1]/mag_field[0])))
-           
-        #***********Electron Beam
-        eBeam = SRWLPartBeam()
-        eBeam.Iavg = electron_beam[6] #average current [A]
-        eBeam.partStatMom1.x = 0. #initial transverse positions [m]
-        eBeam.partStatMom1.y = 0.
-        eBeam.partStatMom1.z = -(mag_field[1]/2 + mag_field[0]*2) #initial longitudinal positions (set in the middle of undulator)
-        eBeam.partStatMom1.xp = 0 #initial relative transverse velocities
-        eBeam.partStatMom1.yp = 0
-        eBeam.partStatMom1.gamma = electron_beam[4]/0.51099890221e-03 #relative energy
-        sigEperE = electron_beam[5] #0.00089 #relative RMS energy spread
-        sigX = electron_beam[0] #33.33e-06 #horizontal RMS size of e-beam [m]
-        sigXp = electron_beam[2] #16.5e-06 #horizontal RMS angular divergence [rad]
-        sigY = electron_beam[1] #2.912e-06 #vertical RMS size of e-beam [m]
-        sigYp = electron_beam[3] #2.7472e-06 #vertical RMS angular divergence [rad]
-        #2nd order stat. moments:
-        eBeam.arStatMom2[0] = sigX*sigX #<(x-<x>)^2> 
-        eBeam.arStatMom2[1] = 0 #<(x-<x>)(x'-<x'>)>
-        eBeam.arStatMom2[2] = sigXp*sigXp #<(x'-<x'>)^2> 
-        eBeam.arStatMom2[3] = sigY*sigY #<(y-<y>)^2>
-        eBeam.arStatMom2[4] = 0 #<(y-<y>)(y'-<y'>)>
-        eBeam.arStatMom2[5] = sigYp*sigYp #<(y'-<y'>)^2>
-        eBeam.arStatMom2[10] = sigEperE*sigEperE #<(E-<E>)^2>/<E>^2
-        
-        #***********Precision Parameters
-        arPrecF = [0]*5 #for spectral flux vs photon energy
-        arPrecF[0] = 1 #initial UR harmonic to take into account
-        arPrecF[1] = precision[0] #final UR harmonic to take into account
-        arPrecF[2] = precision[1] #longitudinal integration precision parameter
-        arPrecF[3] = precision[2] #azimuthal integration precision parameter
-        arPrecF[4] = 1 #calculate flux (1) or flux per unit surface (2)
-            
-        #***********UR Stokes Parameters (mesh) for Spectral Flux
-        stkF = SRWLStokes() #for spectral flux vs photon energy
-        stkF.allocate(energy_grid[2], 1, 1) #numbers of points vs photon energy, horizontal and vertical positions
-        stkF.mesh.zStart = sampling_mesh[0] #longitudinal position [m] at which UR has to be calculated
-        stkF.mesh.eStart = energy_grid[0] #initial photon energy [eV]
-        stkF.mesh.eFin = energy_grid[1] #final photon energy [eV]
-        stkF.mesh.xStart = sampling_mesh[1] #initial horizontal position [m]
-        stkF.mesh.xFin = sampling_mesh[2] #final horizontal position [m]
-        stkF.mesh.yStart = sampling_mesh[3] #initial vertical position [m]
-        stkF.mesh.yFin = sampling_mesh[4] #final vertical position [m]
-               
-        
-        #**********************Calculation (SRWLIB function calls)
-        #print('   Performing Spectral Flux (Stokes parameters) calculation ... ')
-        srwl.CalcStokesUR(stkF, eBeam, und, arPrecF)
-        #print('done')
-        
-        return numpy.array(stkF.arS[0:energy_grid[2]])    
+        """
+
+        self.srw_workers = congruence.checkStrictlyPositiveNumber(self.srw_workers, "SRW Workers")
+        if self.srw_workers > 1:
+            spectrum, mismatch = flux_util.parallel_srw_undulator_spectrum(mag_field, electron_beam, energy_grid, sampling_mesh,
+                                                                          precision, self.srw_workers)
+            print('            Parallel SRW: {0} workers, max. relative difference at chunk boundaries = {1:.2e} \n'.format(self.srw_workers, mismatch))
+            if mismatch > 1e-3:
+                print('            WARNING: chunked spectrum does not match at the boundaries, set SRW Workers to 1 \n')
+            return spectrum
+
+        return flux_util.srw_undulator_spectrum(mag_field, electron_beam, energy_grid, sampling_mesh, precision)
     
     def BM_spectrum(self, E, I, B, ph_energy, hor_acc_mrad=1.0):
         """
@@ -832,18 +1284,7 @@ class FluxWidget(LNLSShadowWidget):
         :hor_acc_mrad: Horizontal acceptance [mrad]
         """
         
-        def bessel_f(y):
-            return kv(5.0/3.0, y)    
-            
-        e_c = 665*(E**2)*B # eV
-        y = ph_energy/e_c
-        int_K53 = numpy.zeros((len(y)))
-        for i in range(len(y)):
-            int_K53[i] = quad(lambda x: kv(5.0/3.0, x), y[i], numpy.inf)[0]
-        G1_y = y*int_K53
-        BM_Flux = (2.457*1e13)*E*I*G1_y*hor_acc_mrad
-        
-        return BM_Flux
+        return flux_util.BM_spectrum(E, I, B, ph_energy, hor_acc_mrad)
     
     def Wiggler_spectrum(self, E, I, B, N_periods, ph_energy, hor_acc_mrad=1.0):
         """
@@ -857,18 +1298,7 @@ class FluxWidget(LNLSShadowWidget):
         :hor_acc_mrad: Horizontal acceptance [mrad]
         """
         
-        def bessel_f(y):
-            return kv(5.0/3.0, y)    
-            
-        e_c = 665*(E**2)*B # eV
-        y = ph_energy/e_c
-        int_K53 = numpy.zeros((len(y)))
-        for i in range(len(y)):
-            int_K53[i] = quad(lambda x: kv(5.0/3.0, x), y[i], numpy.inf)[0]
-        G1_y = y*int_K53
-        W_Flux = (2.457*1e13)*E*I*G1_y*hor_acc_mrad*(2*N_periods)
-        
-        return W_Flux    
+        return flux_util.Wiggler_spectrum(E, I, B, N_periods, ph_energy, hor_acc_mrad)
     
     def print_date_i(self):
         print('\n'+'EXECUTION BEGAN AT: ', end='')
@@ -912,7 +1342,9 @@ class FluxWidget(LNLSShadowWidget):
                                    self.histoI,
                                    self.T1,
                                    self.source_spec*self.vert_acc,
-                                   self.T1*self.source_spec*self.vert_acc]).T, 
+                                   self.T1*self.source_spec*self.vert_acc,
+                                   self.T1_err,
+                                   self.beamline_flux_err]).T, 
                       fmt='%.8e',
                       header='Total Flux [ph/s/100mA]  \n' + self.flux_total + '\n' + 'Total Power [W/100mA] \n' + self.power_total + '\n' +
                              'Energy [eV] \
@@ -920,7 +1352,9 @@ class FluxWidget(LNLSShadowWidget):
                               Beamline Histogram \
                               Transmission \
                               Source Spectrum [ph/s/100mA/0.1%bW] \
-                              Beamline Spectrum [ph/s/100mA/0.1%bW]')       
+                              Beamline Spectrum [ph/s/100mA/0.1%bW] \
+                              Transmission Error \
+                              Beamline Spectrum Error [ph/s/100mA/0.1%bW]')       
     def down_fig(self):
         
         self.plot_canvas.saveGraph(self.fig_filename, fileFormat='png', dpi=400)
@@ -930,7 +1364,7 @@ class FluxWidget(LNLSShadowWidget):
         """
         Calculates the vertical angular flux probability density function (pdf) for \
         a Bending Magnet or Wiggler and compares it to divergence limits to calculate \
-        the relative vertcal acceptance.\n
+        the relative vertcal acceptance. See flux_util.BM_vertical_acc.\n
         Return: Dictionary containing vertical angular distribution, fwhm and acceptance factor (energy-dependent)  \n
         :E: Storage Ring energy [GeV]
         :B: Magnetic Field value [T]    
@@ -939,72 +1373,12 @@ class FluxWidget(LNLSShadowWidget):
         :e_beam_vert_div: electron beam vertical divergence sigma [rad]. Not taken into account if equal to None.
         :plot: boolean: True or False if you want the distribution to be shown.
         """
-        import numpy
-        from scipy.special import kv
-        from scipy.integrate import simps
-        
-        def gaussian_pdf(x, x0, sigma): # gaussian probability density function (PDF)
-            return (1/(numpy.sqrt(2*numpy.pi*sigma**2)))*numpy.exp(-(x-x0)**2/(2*sigma**2))
-        
-        def calc_vert_dist(e_relative):
-            G = (e_relative/2.0)*(gamma_psi**(1.5))    
-            K13_G = kv(1.0/3.0, G)
-            K23_G = kv(2.0/3.0, G)
-              
-            dN_dOmega  = (1.33e13)*(E**2)*I*(e_relative**2)*(gamma_psi**2)
-            dN_dOmega *= ( (K23_G**2) + (((gamma**2) * (psi**2))/(gamma_psi))*(K13_G**2) )   
-            
-            return dN_dOmega
+        output = flux_util.BM_vertical_acc(E, B, ph_energy, div_limits, e_beam_vert_div)
         
-        if(not(hasattr(ph_energy, "__len__"))): # for single energies
-            ph_energy = numpy.array([ph_energy])
-        
-        I = 0.1 # [A] -> result independent
-        gamma = E/0.51099890221e-03
-        e_c = 665*(E**2)*B # [eV]    
-        energy_relative = ph_energy/e_c
-        
-        # calculate graussian approximation to define psi mesh
-        int_K53 = quad(lambda x: kv(5.0/3.0, x), energy_relative[0], numpy.inf)[0]
-        K23 = kv(2.0/3.0, energy_relative[0]/2)
-        vert_angle_sigma = numpy.sqrt(2*numpy.pi/3)/(gamma*energy_relative[0])*int_K53/((K23)**2)
-        if(e_beam_vert_div > 0.0):
-            vert_angle_sigma = numpy.sqrt(vert_angle_sigma**2 + e_beam_vert_div**2) # calculates gaussian PDF of the e-beam vertical divergence
-        
-        psi = numpy.linspace(-vert_angle_sigma*2, vert_angle_sigma*2, 1000) # vertical angle array
-        gamma_psi = 1 + (gamma**2) * (psi**2) # factor dependent on gamma and psi
+        psi, vert_pdf, lwhm, rwhm = output["Psi"], output["PDF"], output["lwhm"], output["rwhm"]
         psi_minus = numpy.abs(psi - div_limits[0]).argmin() # first psi limit index
         psi_plus = numpy.abs(psi - div_limits[1]).argmin() # second psi limit index
         
-        vert_pdf = numpy.zeros((len(ph_energy), len(psi)))
-        vert_acceptance = numpy.zeros((len(ph_energy)))
-        lwhm = numpy.zeros((len(ph_energy)))
-        rwhm = numpy.zeros((len(ph_energy)))
-        fwhm = numpy.zeros((len(ph_energy)))
-        
-        if(e_beam_vert_div > 0.0):
-            e_beam_pdf = gaussian_pdf(psi, 0, e_beam_vert_div) # calculates gaussian PDF of the e-beam vertical divergence
-            
-        for i in range(len(ph_energy)):
-            vert_pdf[i] = calc_vert_dist(energy_relative[i]) 
-            vert_pdf[i] /= simps(y=vert_pdf[i], x=psi)
-            
-            if(e_beam_vert_div > 0.0): # convolves radiation and e-beam angular distributions
-                
-                conv_dist = numpy.convolve(vert_pdf[i], e_beam_pdf, mode='same')
-                conv_dist_norm = simps(y=conv_dist, x=psi)
-                conv_pdf = conv_dist / conv_dist_norm # convolved PDF
-                vert_pdf[i] = conv_pdf
-                
-            vert_acceptance[i] = simps(vert_pdf[i][psi_minus:psi_plus+1], x=psi[psi_minus:psi_plus+1])
-            # calculates FWHM 
-            peak = numpy.max(vert_pdf[i])
-            peak_idx = numpy.abs(vert_pdf[i]-peak).argmin()
-            lwhm[i] = psi[numpy.abs(vert_pdf[i][:peak_idx] - peak/2).argmin()]
-            rwhm[i] = psi[numpy.abs(vert_pdf[i][peak_idx:] - peak/2).argmin() + peak_idx]
-            fwhm[i] = rwhm[i] - lwhm[i]
-    
-       
         if(plot==True and len(vert_pdf)==1):
             from matplotlib import pyplot as plt
             plt.figure()
@@ -1012,7 +1386,8 @@ class FluxWidget(LNLSShadowWidget):
             plt.ylabel('$Flux \ PDF$')
             plt.xlabel('$\psi \ [mrad]$')
             plt.ylim(0, numpy.max(vert_pdf)*1.1)
-            plt.fill_between(psi*1e3, vert_pdf[i], where=numpy.logical_and(psi>=psi[psi_minus], psi<=psi[psi_plus]))
+            peak = numpy.max(vert_pdf[0])
+            plt.fill_between(psi*1e3, vert_pdf[0], where=numpy.logical_and(psi>=psi[psi_minus], psi<=psi[psi_plus]))
             plt.axvline(x=psi[psi_minus]*1e3)
             plt.axvline(x=psi[psi_plus]*1e3)
             plt.plot(lwhm*1e3, peak/2, 'C1+', markersize=12)
@@ -1030,16 +1405,9 @@ class FluxWidget(LNLSShadowWidget):
             plt.axhline(y=div_limits[0]*1e3, color='gray', alpha=0.5)
             plt.axhline(y=div_limits[1]*1e3, color='gray', alpha=0.5)
             plt.minorticks_on()
-            plt.ylim([-vert_angle_sigma*1.75e3, vert_angle_sigma*1.75e3])
+            plt.ylim([psi[0]*0.875e3, psi[-1]*0.875e3])
             plt.show()
     
-        output = {"Psi": psi,
-                  "PDF": vert_pdf,
-                  "acceptance": vert_acceptance,
-                  "lwhm": lwhm,
-                  "rwhm": rwhm,
-                  "fwhm": fwhm}
-    
         return output
 
         
@@ -6,7 +6,6 @@
 # License: BSD Style.
 
 import numpy as np
-import h5py
 import optparse
 from traits.api import HasTraits, Instance, Array, \
     on_trait_change
@@ -20,6 +19,8 @@ from mayavi.core.api import PipelineBase, Source
 from mayavi.core.ui.api import SceneEditor, MayaviScene, \
                                 MlabSceneModel                              
 
+from orangecontrib.shadow.lnls.util.caustic_util import open_caustic, is_growing_caustic
+
 
 
 
@@ -263,27 +264,21 @@ class VolumeSlicer(HasTraits):
                 )
 
 
-if __name__=='__main__':
-
-    p = optparse.OptionParser()
-    p.add_option('-f', '--infile', dest='infile', metavar='FILE', default='', help='input file name')
-    opt, args = p.parse_args()    
+def load_caustic(filename):
     
-    filename=opt.infile
-
-    with h5py.File(filename, 'r+') as f:
+    growing = is_growing_caustic(filename)
+    with open_caustic(filename) as f:
             
         zStart = f.attrs['zStart']
         zFin = f.attrs['zFin']
         nz = f.attrs['nz']
         
-        dset_names = list(f.keys())
+        dset_names = sorted([name for name in f.keys() if name.startswith('step_')])
         
         #####################
         # find maximum ranges
         #####################
-        xy_range = np.zeros((len(dset_names), 4))
-        dset = dset_names[2]
+        dset = dset_names[0]
         xS, xF, nx =  f[dset].attrs['xStart'], f[dset].attrs['xFin'], f[dset].attrs['nx']
         yS, yF, ny =  f[dset].attrs['yStart'], f[dset].attrs['yFin'], f[dset].attrs['ny']
         
@@ -291,9 +286,11 @@ if __name__=='__main__':
         y_array = np.linspace(yS, yF, ny)[::-1]
         z_array = np.linspace(zStart, zFin, nz)
         
-        for i in range(len(dset_names)-2):
+        for i in range(len(dset_names)):
                         
-            dset = dset_names[i+2]
+            dset = dset_names[i]
+            if growing:
+                f[dset].refresh()
             mtx = np.array(f[dset])
             mtx = mtx[:,::-1][::-1,:]            
             
@@ -301,10 +298,37 @@ if __name__=='__main__':
                 values = mtx
             else:
                 values = np.dstack((values,mtx))
+    
+    return values, x_array, y_array, z_array, growing
+
+
+if __name__=='__main__':
+
+    p = optparse.OptionParser()
+    p.add_option('-f', '--infile', dest='infile', metavar='FILE', default='', help='input file name')
+    p.add_option('--follow', dest='follow', action='store_true', default=False, help='refresh while the caustic file is being written')
+    p.add_option('-i', '--interval', dest='interval', type='float', default=2.0, help='refresh interval in seconds (with --follow)')
+    opt, args = p.parse_args()    
+    
+    filename=opt.infile
+
     #x, y, z = np.ogrid[-5:5:64j, -5:5:64j, -5:5:64j]
     #data = np.sin(3*x)/x + 0.05*z**2 + np.cos(3*y)
-    data = values
+    data, x_array, y_array, z_array, growing = load_caustic(filename)
     
     
     m = VolumeSlicer(data=data)
+    
+    if opt.follow and growing:
+        from pyface.timer.api import Timer
+        
+        def refresh():
+            data, x_array, y_array, z_array, growing = load_caustic(filename)
+            m.data_src3d.mlab_source.scalars = data
+            if not growing:
+                timer.Stop()
+                print('Caustic finished.')
+        
+        timer = Timer(int(1000*opt.interval), refresh)
+    
     m.configure_traits()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the Beam Analysis histogram profiles and peak search against the former loop implementation.
+
+    python tests/benchmark_beam_util.py [-n NBINS] [-r NRAYS]
+"""
+
+import time
+import optparse
+
+import numpy
+
+from orangecontrib.shadow.lnls.util.beam_util import integrated_profiles, find_peak
+
+
+def loop_profiles(xz, x_axis, z_axis):
+    z_int = numpy.array([numpy.sum(xz[i,1:]) for i in range(len(z_axis))])
+    x_int = numpy.array([numpy.sum(xz[1:,j]) for j in range(len(x_axis))])
+    return z_int, x_int
+
+def loop_find_peak(xz):
+    zmax = [0, 0]; xmax = [0, 0]
+    for i in range(len(xz[:,0])):
+        for j in range(len(xz[0,:])):
+            if(xz[i,j] > zmax[1]):
+                zmax[0] = j
+                zmax[1] = xz[i,j]
+            if(xz[i,j] > xmax[1]):
+                xmax[0] = i
+                xmax[1] = xz[i,j]
+    return xmax, zmax
+
+def benchmark(nbins=1000, nrays=1000000, seed=0):
+    """
+    Times the loop and the vectorized analysis of a random nbins x nbins histogram and checks
+    that they give identical results.
+    """
+    rng = numpy.random.default_rng(seed)
+    xz = numpy.histogram2d(rng.normal(size=nrays), rng.normal(size=nrays), bins=nbins, weights=rng.random(nrays))[0]
+    x_axis = z_axis = numpy.linspace(-1, 1, nbins)
+
+    t0 = time.time()
+    z_loop, x_loop = loop_profiles(xz, x_axis, z_axis)
+    peak_loop = loop_find_peak(xz)
+    t1 = time.time()
+    z_vec, x_vec = integrated_profiles(xz)
+    peak_vec = find_peak(xz)
+    t2 = time.time()
+
+    identical = numpy.array_equal(z_loop, z_vec) and numpy.array_equal(x_loop, x_vec) and peak_loop == peak_vec
+    print('{0} x {0} histogram: loops {1:.3f} s, vectorized {2:.4f} s ({3:.0f}x), identical: {4}'.format(
+          nbins, t1 - t0, t2 - t1, (t1 - t0)/max(t2 - t1, 1e-9), identical))
+    return identical
+
+
+if __name__ == '__main__':
+
+    p = optparse.OptionParser(usage='python tests/benchmark_beam_util.py [-n NBINS] [-r NRAYS]')
+    p.add_option('-n', '--nbins', dest='nbins', type='int', default=1000, help='number of bins per axis')
+    p.add_option('-r', '--nrays', dest='nrays', type='int', default=1000000, help='number of rays')
+    opt, args = p.parse_args()
+
+    benchmark(opt.nbins, opt.nrays)
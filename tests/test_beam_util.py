@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests of the Beam Analysis binning (bin plans read in chunks, retraced beams) against numpy.histogram2d.
+"""
+
+import unittest
+
+import numpy
+
+from orangecontrib.shadow.lnls.util import beam_util
+
+try:
+    import Shadow
+except ImportError:
+    Shadow = None
+
+
+def model_beam(nrays=10007, seed=5):
+    rng = numpy.random.default_rng(seed)
+    rays = numpy.zeros((nrays, 18))
+    rays[:, 0], rays[:, 2] = rng.normal(0.0, 0.1, nrays), rng.normal(0.0, 0.05, nrays)
+    rays[:, 3], rays[:, 5] = rng.normal(0.0, 1e-3, nrays), rng.normal(0.0, 2e-3, nrays)
+    rays[:, 4] = numpy.sqrt(1.0 - rays[:, 3]**2 - rays[:, 5]**2)
+    rays[:, [6, 7, 8, 15, 16, 17]] = rng.normal(0.0, 0.5, (nrays, 6))
+    rays[:, 9] = numpy.where(rng.random(nrays) < 0.8, 1.0, -5.0)
+    rays[:, 10] = rng.uniform(9000.0, 11000.0, nrays)
+    rays[:, 11] = numpy.arange(1, nrays + 1)
+    beam = Shadow.Beam()
+    beam.rays = rays
+    return beam
+
+
+@unittest.skipIf(Shadow is None, "Shadow is not installed")
+class BinPlanTest(unittest.TestCase):
+
+    nbins = (41, 23)
+
+    def check_plan(self, plan, reference, nolost, ref, xrange, yrange):
+        # reference: Shadow.Beam with the rays of the plan
+        h, v, flag = reference.getshcol((1, 3, 10))
+        selected = beam_util.ray_selection(flag, nolost)
+        if xrange is None:
+            xrange = beam_util.good_range(numpy.min(h[selected]), numpy.max(h[selected]))
+            yrange = beam_util.good_range(numpy.min(v[selected]), numpy.max(v[selected]))
+        weights = None if ref == 0 else reference.getshonecol(ref)[selected]
+        expected, edges_h, edges_v = numpy.histogram2d(h[selected], v[selected], bins=self.nbins, range=[xrange, yrange], weights=weights)
+        numpy.testing.assert_array_equal(plan.edges_h, edges_h)
+        numpy.testing.assert_array_equal(plan.edges_v, edges_v)
+        numpy.testing.assert_array_equal(plan.histogram(ref), expected)
+
+    def test_histogram2d(self):
+        beam = model_beam()
+        nrays = len(beam.rays)
+        for chunk_size in [None, 1000, nrays - 1, nrays, 3*nrays]:
+            for nolost in [0, 1, 2]:
+                for ref in [0, 23, 12]:
+                    # default ranges, and ranges leaving rays outside the histogram
+                    for xrange, yrange in [(None, None), ([-0.1, 0.15], [-0.04, 0.05])]:
+                        with self.subTest(chunk_size=chunk_size, nolost=nolost, ref=ref, xrange=xrange):
+                            plan = beam_util.BinPlan(beam, 1, 3, *self.nbins, nolost=nolost, xrange=xrange, yrange=yrange,
+                                                     chunk_size=chunk_size)
+                            self.check_plan(plan, beam, nolost, ref, xrange, yrange)
+
+    def test_retraced_beam(self):
+        beam = model_beam()
+        nrays = len(beam.rays)
+        rays = beam.rays.copy()
+        # budgets keeping the retraced positions, and too small for them (retraced in every chunk)
+        for memory_budget in [100.0, 0.0]:
+            cache = beam_util.RetraceCache(memory_budget, chunk_size=1000)
+            cache.set_beam(beam, 1)
+            for dist in [-2.5, 40.0, -2.5]:
+                reference = Shadow.Beam()
+                reference.rays = rays.copy()
+                reference.retrace(dist)
+                for chunk_size in [None, 1000, nrays, 3*nrays]:
+                    with self.subTest(memory_budget=memory_budget, dist=dist, chunk_size=chunk_size):
+                        plan = beam_util.BinPlan(cache.retrace(dist), 1, 3, *self.nbins, nolost=1, chunk_size=chunk_size)
+                        self.check_plan(plan, reference, 1, 23, None, None)
+            self.assertLessEqual(cache.nbytes(), memory_budget*1e6)
+        # the input beam is not modified
+        numpy.testing.assert_array_equal(beam.rays, rays)
+
+
+if __name__ == '__main__':
+    unittest.main()
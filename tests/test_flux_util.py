@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests of the Flux widget calculations without SRW (the undulator spectrum is replaced by a model).
+"""
+
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy
+
+from orangecontrib.shadow.lnls.util import flux_util
+
+
+def model_undulator_spectrum(mag_field, electron_beam, energy_grid, sampling_mesh, precision, first_harmonic=1):
+    # one Gaussian line per harmonic first_harmonic..precision[0]
+    energies = numpy.linspace(energy_grid[0], energy_grid[1], int(energy_grid[2]))
+    return sum(1e14/h*numpy.exp(-0.5*((energies - 1000.0*h)/50.0)**2) for h in range(first_harmonic, int(precision[0]) + 1))
+
+
+class HarmonicSpectraTest(unittest.TestCase):
+
+    mag_field = [0.02, 2.0, 0.0, 0.5, 0.0, 0.0, 1, -1]
+    electron_beam = [30e-6, 3e-6, 4e-6, 2e-6, 3.0, 1e-3, 0.1]
+    sampling_mesh = [10.0, -1e-3, 1e-3, -1e-3, 1e-3]
+    precision = [3, 1.0, 1.0]
+    energy_grid = [500.0, 3500.0, 301]
+
+    def test_harmonic_path(self):
+        with tempfile.TemporaryDirectory() as directory, \
+             mock.patch.object(flux_util, 'srw_undulator_spectrum', side_effect=model_undulator_spectrum) as srw:
+            cache = flux_util.SpectrumCache(directory=directory)
+
+            spectra, cached, calculated = flux_util.cached_harmonic_spectra(self.mag_field, self.electron_beam, self.energy_grid,
+                                                                            self.sampling_mesh, self.precision, cache)
+            self.assertEqual(spectra.shape, (3, 301))
+            self.assertEqual((cached, calculated), ([], [1, 2, 3]))
+            self.assertEqual(srw.call_count, 3)
+
+            spectra_again, cached, calculated = flux_util.cached_harmonic_spectra(self.mag_field, self.electron_beam, self.energy_grid,
+                                                                                  self.sampling_mesh, self.precision, cache)
+            self.assertEqual((cached, calculated), ([1, 2, 3], []))
+            self.assertEqual(srw.call_count, 3)
+            numpy.testing.assert_array_equal(spectra, spectra_again)
+
+        # the harmonics add up to the total, with the same vertical acceptance
+        En_coord = numpy.linspace(*self.energy_grid[:2], self.energy_grid[2])
+        histoI0 = numpy.full(len(En_coord), 100.0)
+        histoI = histoI0*numpy.linspace(0.2, 0.8, len(En_coord))
+        histoI2 = histoI*0.01
+        vert_acc = numpy.linspace(1.0, 0.5, len(En_coord))
+        total = flux_util.flux_from_histograms(En_coord, histoI, histoI0, histoI2, spectra.sum(axis=0), vert_acc)
+        harmonics = [flux_util.flux_from_histograms(En_coord, histoI, histoI0, histoI2, spectrum, vert_acc) for spectrum in spectra]
+        self.assertAlmostEqual(sum(h['flux'] for h in harmonics)/total['flux'], 1.0, places=12)
+        self.assertAlmostEqual(sum(h['power'] for h in harmonics)/total['power'], 1.0, places=12)
+
+
+def model_beam(seed, nrays=200000):
+    # white beam: good rays in a window, lost rays over a wider range
+    rng = numpy.random.default_rng(seed)
+    energy = rng.uniform(7000.0, 13000.0, nrays)
+    flag = numpy.where(numpy.logical_and(numpy.abs(energy - 10000.0) < 1000.0, rng.random(nrays) < 0.7), 1.0, -11.0)
+    intensity = rng.random(nrays)
+    return energy, intensity, flag
+
+
+class EnergyHistogramsTest(unittest.TestCase):
+
+    def test_numpy_histogram(self):
+        # histograms of the Flux widget before the single column extraction
+        energy, intensity, flag = model_beam(2)
+        for number_of_bins in [1, 101, 1000]:
+            En_coord, histoI, histoI0, info = flux_util.energy_histograms(energy, intensity, flag, number_of_bins)
+            En, I = energy[flag > 0], intensity[flag > 0]
+            in_range = numpy.logical_and(energy >= numpy.min(En), energy <= numpy.max(En))
+            numpy.testing.assert_array_equal(histoI, numpy.histogram(En, number_of_bins, weights=I)[0])
+            numpy.testing.assert_array_equal(histoI0, numpy.histogram(energy[in_range], number_of_bins, weights=numpy.ones(numpy.count_nonzero(in_range)))[0])
+            numpy.testing.assert_allclose(info['histoI2'], numpy.histogram(En, number_of_bins, weights=I**2)[0], rtol=1e-12)
+            numpy.testing.assert_array_equal(En_coord, numpy.linspace(numpy.min(En), numpy.max(En), number_of_bins))
+            self.assertEqual((info['nrays'], info['good_rays']), (len(energy), len(En)))
+
+    def test_accumulated_halves(self):
+        energy, intensity, flag = model_beam(3)
+        half = len(energy)//2
+        # the first half holds the lowest and highest good energies, so both grids are the same
+        extremes = numpy.flatnonzero(flag > 0)[[numpy.argmin(energy[flag > 0]), numpy.argmax(energy[flag > 0])]]
+        order = numpy.concatenate((extremes, numpy.setdiff1d(numpy.arange(len(energy)), extremes)))
+        energy, intensity, flag = energy[order], intensity[order], flag[order]
+
+        for energy_range in [None, [8500.0, 11500.0]]:
+            single = flux_util.EnergyHistogramAccumulator(101, energy_range)
+            single.add_rays(energy, intensity, flag)
+            merged = flux_util.EnergyHistogramAccumulator(101, energy_range)
+            merged.add_rays(energy[:half], intensity[:half], flag[:half])
+            merged.add_rays(energy[half:], intensity[half:], flag[half:])
+
+            for a, b in zip(single.result(), merged.result()):
+                numpy.testing.assert_allclose(a, b, rtol=1e-12)
+            numpy.testing.assert_array_equal(single.result()[2], merged.result()[2])
+            self.assertEqual((single.nrays, single.good_rays), (merged.nrays, merged.good_rays))
+
+        # a single beam gives the histograms of energy_histograms
+        single = flux_util.EnergyHistogramAccumulator(101)
+        single.add_rays(energy, intensity, flag)
+        En_coord, histoI, histoI0, info = flux_util.energy_histograms(energy, intensity, flag, 101)
+        numpy.testing.assert_allclose(single.result()[0], En_coord, rtol=1e-12)
+        numpy.testing.assert_allclose(single.result()[1], histoI, rtol=1e-12)
+        numpy.testing.assert_array_equal(single.result()[2], histoI0)
+
+    def test_accumulated_grid_extension(self):
+        # halves with different energy windows: the grid grows, histoI0 is the same as a single pass on the final grid
+        energy, intensity, flag = model_beam(4)
+        low = energy < 10000.0
+        merged = flux_util.EnergyHistogramAccumulator(50)
+        merged.add_rays(energy[low], intensity[low], flag[low])
+        merged.add_rays(energy[~low], intensity[~low], flag[~low])
+        En_coord, histoI, histoI0, histoI2 = merged.result()
+        edges = merged.edges[numpy.searchsorted(merged.edges, En_coord[0]):][:len(histoI) + 1]
+        reference0 = numpy.histogram(energy, edges)[0]
+        reference = numpy.histogram(energy[flag > 0], edges, weights=intensity[flag > 0])[0]
+        # rays at the last edge of the first grid stay in the bin below it
+        at_edge = energy == merged.closed_edge
+        k = numpy.searchsorted(edges, merged.closed_edge)
+        reference0[k - 1:k + 1] += [numpy.count_nonzero(at_edge), -numpy.count_nonzero(at_edge)]
+        good_at_edge = numpy.sum(intensity[at_edge & (flag > 0)])
+        reference[k - 1:k + 1] += [good_at_edge, -good_at_edge]
+        numpy.testing.assert_array_equal(histoI0, reference0)
+        numpy.testing.assert_allclose(histoI, reference, rtol=1e-12, atol=1e-9)
+
+
+class IntegratedFluxTest(unittest.TestCase):
+
+    def test_binning_modes(self):
+        # Gaussian energy distribution (cut at 2 sigma, no empty bins), constant transmission and constant
+        # flux per eV: the integral is known exactly
+        energy = numpy.random.default_rng(1).normal(10000.0, 50.0, 100000)
+        energy = energy[numpy.abs(energy - 10000.0) < 100.0]
+        intensity = numpy.full(len(energy), 0.8)
+        flag = numpy.ones(len(energy))
+        source = {'type': 'bending magnet', 'I': 0.1}
+        e_min, e_max = numpy.min(energy), numpy.max(energy)
+        expected_flux = 1e12*0.8*(e_max - e_min)
+        expected_power = 1e12*0.8*1.60217662e-19*(e_max**2 - e_min**2)/2.0
+
+        with mock.patch.object(flux_util, 'source_spectrum', side_effect=lambda source, energies, cache=None: 1e12*energies/1000.0):
+            for binning in ['fixed', 'equal count', 'bayesian blocks']:
+                for number_of_bins in [20, 101]:
+                    for target_precision in [0.0, 0.05]:
+                        result = flux_util.calculate_flux((energy, intensity, flag), source, number_of_bins, binning, target_precision)
+                        self.assertAlmostEqual(result['flux']/expected_flux, 1.0, places=9)
+                        self.assertAlmostEqual(result['power']/expected_power, 1.0, places=9)
+
+
+if __name__ == '__main__':
+    unittest.main()